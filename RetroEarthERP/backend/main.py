@@ -6,14 +6,31 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import os
 from dotenv import load_dotenv
+from sqlalchemy.schema import CreateIndex
 
-from database import engine, Base
-from routers import auth, items, partners, warehouses, inventory, wms, planning, qms, users, bom, workorder, machines, sales, accounting, chart_of_accounts, thai_tax
+from database import engine, Base, SessionLocal
+import models
+from routers import auth, items, partners, warehouses, inventory, wms, planning, qms, users, bom, workorder, machines, sales, accounting, chart_of_accounts, thai_tax, jobs
+from services import bom_closure, low_level_codes, job_runner, inventory_balance
 
 load_dotenv()
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
+# Balance rows written before the balance key existed may repeat a key
+db = SessionLocal()
+try:
+    if inventory_balance.merge_duplicate_balances(db):
+        db.commit()
+finally:
+    db.close()
+# create_all skips tables that already exist, so add the indexes introduced
+# since the table was created. IF NOT EXISTS rather than checkfirst: SQLite
+# reflection does not report expression indexes
+with engine.begin() as connection:
+    for table in (models.InventoryCostLayer.__table__, models.InventoryBalance.__table__):
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -50,6 +67,30 @@ app.include_router(sales.router)
 app.include_router(accounting.router)
 app.include_router(chart_of_accounts.router)
 app.include_router(thai_tax.router)
+app.include_router(jobs.router)
+
+
+@app.on_event("startup")
+def build_bom_structure():
+    """Populate the flattened BOM and low-level codes when empty (new tables, seeded data)"""
+    db = SessionLocal()
+    try:
+        bom_closure.ensure_bom_closure(db)
+        low_level_codes.ensure_low_level_codes(db)
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+def start_job_workers():
+    """Start background job workers; unfinished jobs of a stopped worker are re-queued"""
+    job_runner.start_workers()
+
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    job_runner.stop_workers()
+
 
 @app.get("/")
 def read_root():
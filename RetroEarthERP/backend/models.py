@@ -4,7 +4,7 @@ Includes all 26 tables with multi-language support
 """
 from sqlalchemy import (
     Column, Integer, String, Boolean, DateTime, Date, Numeric,
-    ForeignKey, Enum as SQLEnum, Text, JSON
+    ForeignKey, Enum as SQLEnum, Text, JSON, Index, UniqueConstraint, text
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -93,6 +93,14 @@ class MRPStatus(str, enum.Enum):
     FAILED = "FAILED"
 
 
+class BackgroundJobStatus(str, enum.Enum):
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
+
+
 class SuggestedAction(str, enum.Enum):
     BUY = "BUY"
     MAKE = "MAKE"
@@ -709,6 +717,47 @@ class MasterBOM(Base):
     creator = relationship("User", foreign_keys=[created_by])
 
 
+class BOMClosure(Base):
+    """
+    Flattened BOM (transitive closure) over ACTIVE revisions.
+    One row per (ancestor, ancestor revision, descendant, depth); qty_per is the
+    descendant quantity (scrap included) per ancestor unit, summed over paths.
+    Maintained by services/bom_closure.py
+    """
+    __tablename__ = "bom_closure"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    ancestor_item_id = Column(Integer, ForeignKey("master_items.id"), nullable=False)
+    ancestor_revision = Column(Integer, nullable=False)
+    descendant_item_id = Column(Integer, ForeignKey("master_items.id"), nullable=False)
+    depth = Column(Integer, nullable=False)  # 1 = direct component
+    qty_per = Column(Numeric(24, 8), nullable=False)
+    
+    __table_args__ = (
+        UniqueConstraint("ancestor_item_id", "ancestor_revision", "descendant_item_id", "depth",
+                         name="uq_bom_closure_path"),
+        Index("ix_bom_closure_descendant", "descendant_item_id", "depth"),
+    )
+    
+    ancestor_item = relationship("MasterItem", foreign_keys=[ancestor_item_id])
+    descendant_item = relationship("MasterItem", foreign_keys=[descendant_item_id])
+
+
+class ItemLowLevelCode(Base):
+    """
+    Low-level code per item: the deepest level it appears at in any ACTIVE BOM
+    (0 = end item or not used in a BOM). Items without a row are level 0.
+    Maintained by services/low_level_codes.py
+    """
+    __tablename__ = "item_low_level_code"
+
+    item_id = Column(Integer, ForeignKey("master_items.id"), primary_key=True)
+    low_level_code = Column(Integer, nullable=False, default=0, index=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    item = relationship("MasterItem")
+
+
 class TrnJobOrderHead(Base):
     __tablename__ = "trn_job_order_head"
     
@@ -756,6 +805,24 @@ class MRPScenario(Base):
     status = Column(SQLEnum(MRPStatus), default=MRPStatus.COMPLETED)
     
     user = relationship("User")
+    detail = relationship("MRPScenarioDetail", back_populates="scenario", uselist=False, cascade="all, delete-orphan")
+
+
+class MRPScenarioDetail(Base):
+    """
+    What-if scenario of a plan: the overlay of demand, inventory, BOM and item
+    changes it was simulated with and its summary. Simulations write no mrp_results.
+    """
+    __tablename__ = "mrp_scenario_detail"
+
+    scenario_id = Column(Integer, ForeignKey("mrp_scenarios.id"), primary_key=True)
+    plan_id = Column(Integer, ForeignKey("production_plan.id"), nullable=False, index=True)
+    bucket = Column(String(10), nullable=False, default="day")
+    overlay = Column(JSON, nullable=False)
+    summary = Column(JSON, nullable=True)
+    applied_at = Column(DateTime(timezone=True), nullable=True)
+
+    scenario = relationship("MRPScenario", back_populates="detail")
 
 
 class MRPResult(Base):
@@ -776,6 +843,37 @@ class MRPResult(Base):
     item = relationship("MasterItem")
 
 
+class MRPPlanRun(Base):
+    """
+    Parameters of the last MRP run of a plan, so a net-change run can replan
+    on the same bucket calendar. Maintained by services/mrp_engine.py
+    """
+    __tablename__ = "mrp_plan_run"
+
+    plan_id = Column(Integer, ForeignKey("production_plan.id"), primary_key=True)
+    bucket = Column(String(10), nullable=False, default="day")
+    start_date = Column(Date, nullable=False)
+    run_type = Column(String(20), nullable=False)  # REGENERATIVE / NET_CHANGE / SCENARIO
+    run_at = Column(DateTime(timezone=True), nullable=False)
+    change_seq = Column(Integer, nullable=False, default=0)  # Highest mrp_item_change id the run reflects
+    items_planned = Column(Integer, default=0)
+
+    plan = relationship("ProductionPlan", back_populates="last_run")
+
+
+class MRPItemChange(Base):
+    """
+    Items whose MRP inputs changed (inventory, sales/purchase order lines,
+    BOM). The id is the change sequence: net-change runs replan the items
+    with changes above the change_seq of the plan's last run.
+    """
+    __tablename__ = "mrp_item_change"
+
+    id = Column(Integer, primary_key=True, index=True)
+    item_id = Column(Integer, ForeignKey("master_items.id"), nullable=False, index=True)
+    changed_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
 # Inventory Tables
 class InventoryTransaction(Base):
     __tablename__ = "inventory_transactions"
@@ -809,7 +907,13 @@ class InventoryBalance(Base):
     qty_on_hand = Column(Numeric(15, 4), default=0)
     avg_cost = Column(Numeric(15, 4), default=0)
     last_updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
-    
+
+    __table_args__ = (
+        # One row per stock key, NULL location/lot included (services/inventory_balance.py upserts on it)
+        Index("uq_inventory_balance_key", item_id, warehouse_id,
+              func.coalesce(location_id, text("0")), func.coalesce(lot_number, text("''")), unique=True),
+    )
+
     item = relationship("MasterItem")
     warehouse = relationship("MasterWarehouse")
     location = relationship("LocationMaster") # Added
@@ -830,11 +934,57 @@ class InventoryCostLayer(Base):
     lot_number = Column(String(50), nullable=True)  # New: Lot tracking
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
+    __table_args__ = (
+        # Open layers of a stock key in FIFO order (services/fifo_engine.py)
+        Index("ix_cost_layer_fifo_open", "item_id", "warehouse_id", "location_id", "lot_number", "receipt_date", "id",
+              sqlite_where=text("qty_remaining > 0"), postgresql_where=text("qty_remaining > 0")),
+    )
+    
     item = relationship("MasterItem")
     warehouse = relationship("MasterWarehouse")
     location = relationship("LocationMaster")
 
 
+# Period-end Inventory Snapshots
+class InventorySnapshot(Base):
+    """
+    Closing stock of a period, rolled forward from the previous snapshot and
+    the transactions since (services/inventory_snapshot.py). As-of queries
+    start from the latest snapshot on or before the requested date.
+    """
+    __tablename__ = "inventory_snapshot"
+
+    id = Column(Integer, primary_key=True, index=True)
+    period_end = Column(Date, unique=True, nullable=False)
+    base_period_end = Column(Date, nullable=True)  # Snapshot it was rolled forward from
+    line_count = Column(Integer, default=0)
+    total_qty = Column(Numeric(18, 4), default=0)
+    total_value = Column(Numeric(18, 4), default=0)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=True)  # None when closed by the scheduler
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    lines = relationship("InventorySnapshotLine", back_populates="snapshot", cascade="all, delete-orphan")
+
+
+class InventorySnapshotLine(Base):
+    __tablename__ = "inventory_snapshot_line"
+
+    id = Column(Integer, primary_key=True, index=True)
+    snapshot_id = Column(Integer, ForeignKey("inventory_snapshot.id"), nullable=False)
+    item_id = Column(Integer, ForeignKey("master_items.id"), nullable=False)
+    warehouse_id = Column(Integer, ForeignKey("master_warehouses.id"), nullable=False)
+    location_id = Column(Integer, ForeignKey("location_master.id"), nullable=True)
+    lot_number = Column(String(50), nullable=True)
+    qty = Column(Numeric(15, 4), nullable=False)
+    value = Column(Numeric(18, 4), nullable=False)
+
+    __table_args__ = (
+        Index("ix_inventory_snapshot_line_key", "snapshot_id", "item_id", "warehouse_id"),
+    )
+
+    snapshot = relationship("InventorySnapshot", back_populates="lines")
+
+
 # Production Planning Tables
 class ProductionPlan(Base):
     __tablename__ = "production_plan"
@@ -853,6 +1003,7 @@ class ProductionPlan(Base):
     sales_order = relationship("TrnSalesOrderHead", foreign_keys=[sales_order_id])
     items = relationship("ProductionPlanItem", back_populates="plan", cascade="all, delete-orphan")
     mrp_results = relationship("MRPResult", back_populates="plan", cascade="all, delete-orphan")
+    last_run = relationship("MRPPlanRun", back_populates="plan", uselist=False, cascade="all, delete-orphan")
 
 
 class ProductionPlanItem(Base):
@@ -1080,3 +1231,31 @@ class TrnJournalEntryLine(Base):
     account = relationship("MasterAccount", back_populates="journal_lines")
     partner = relationship("MasterBusinessPartner")
 
+
+# Background Jobs
+class BackgroundJob(Base):
+    """
+    Long-running operation queued from an API call (?async=true).
+    Claimed and executed by services/job_runner.py workers.
+    """
+    __tablename__ = "background_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_type = Column(String(50), nullable=False)
+    params = Column(JSON, nullable=True)
+    status = Column(SQLEnum(BackgroundJobStatus), default=BackgroundJobStatus.QUEUED, nullable=False, index=True)
+    progress = Column(Integer, default=0)  # 0-100
+    progress_message = Column(String(200), nullable=True)
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    output_file = Column(String(255), nullable=True)  # Downloadable result (e.g. CSV export)
+    cancel_requested = Column(Boolean, default=False)
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String(100), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    creator = relationship("User")
@@ -3,10 +3,10 @@ Bill of Materials (BOM) Router - Full CRUD operations with Revision Management
 Supports 4 BOM types: ASSEMBLY, FORMULA, MODULAR, TAILOR_MADE
 Features: Revision control, export, search, location tracking
 """
-from fastapi import APIRouter, Depends, HTTPException, status, Response
-from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, func
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Response, UploadFile, File
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import or_, and_, func, case, select
 from typing import List, Optional
 from decimal import Decimal
 from datetime import datetime, date, timezone
@@ -18,6 +18,8 @@ from database import get_db
 import models
 import schemas
 import auth as auth_utils
+from services import bom_engine, bom_closure, low_level_codes, bom_import, cost_rollup, mrp_engine, job_runner
+from routers.jobs import job_accepted
 
 router = APIRouter()
 
@@ -28,10 +30,39 @@ MAX_REVISIONS = 3
 # ==================== HELPER FUNCTIONS ====================
 def get_bom_line_dict(bom, db):
     """Convert BOM model to dictionary with enriched data"""
-    parent = db.query(models.MasterItem).filter(models.MasterItem.id == bom.parent_item_id).first()
-    child = db.query(models.MasterItem).filter(models.MasterItem.id == bom.child_item_id).first()
-    prod_loc = db.query(models.LocationMaster).filter(models.LocationMaster.id == bom.production_location_id).first() if bom.production_location_id else None
-    stor_loc = db.query(models.LocationMaster).filter(models.LocationMaster.id == bom.storage_location_id).first() if bom.storage_location_id else None
+    return get_bom_line_dicts([bom], db)[0]
+
+
+def get_bom_line_dicts(boms, db):
+    """
+    Convert a page of BOM models to dictionaries with enriched data.
+    Referenced items and locations are loaded with one query each for the whole page.
+    """
+    item_ids = {bom.parent_item_id for bom in boms} | {bom.child_item_id for bom in boms}
+    location_ids = {
+        loc_id for bom in boms
+        for loc_id in (bom.production_location_id, bom.storage_location_id) if loc_id
+    }
+    items = {
+        item.id: item for item in db.query(
+            models.MasterItem.id,
+            models.MasterItem.item_code,
+            models.MasterItem.item_name,
+            models.MasterItem.unit_of_measure
+        ).filter(models.MasterItem.id.in_(item_ids)).all()
+    } if item_ids else {}
+    location_codes = dict(db.query(
+        models.LocationMaster.id,
+        models.LocationMaster.location_code
+    ).filter(models.LocationMaster.id.in_(location_ids)).all()) if location_ids else {}
+    
+    return [_bom_line_dict(bom, items, location_codes) for bom in boms]
+
+
+def _bom_line_dict(bom, items, location_codes):
+    """Dictionary for one BOM line, using preloaded items and location codes"""
+    parent = items.get(bom.parent_item_id)
+    child = items.get(bom.child_item_id)
     
     return {
         "id": bom.id,
@@ -50,9 +81,9 @@ def get_bom_line_dict(bom, db):
         "is_optional": bom.is_optional,
         "scrap_factor": float(bom.scrap_factor) if bom.scrap_factor else 0,
         "production_location_id": bom.production_location_id,
-        "production_location_code": prod_loc.location_code if prod_loc else None,
+        "production_location_code": location_codes.get(bom.production_location_id),
         "storage_location_id": bom.storage_location_id,
-        "storage_location_code": stor_loc.location_code if stor_loc else None,
+        "storage_location_code": location_codes.get(bom.storage_location_id),
         "machine_id": bom.machine_id,
         "production_lead_time_days": float(bom.production_lead_time_days) if bom.production_lead_time_days else 0,
         "capacity_per_hour": float(bom.capacity_per_hour) if bom.capacity_per_hour else 0,
@@ -69,6 +100,23 @@ def get_bom_line_dict(bom, db):
     }
 
 
+def refresh_bom_structure(db: Session, parent_item_ids: List[int]):
+    """Update the flattened BOM and low-level codes for changed parents (before commit)"""
+    bom_closure.refresh_bom_closure(db, parent_item_ids)
+    low_level_codes.refresh_low_level_codes(db, parent_item_ids)
+    mrp_engine.mark_bom_changed(db, parent_item_ids)
+
+
+def reject_circular_bom(db: Session, parent_item_id: int, child_item_ids: List[int]):
+    """Raise 400 if adding these components to the parent would create a BOM loop"""
+    path = low_level_codes.find_cycle(db, parent_item_id, child_item_ids)
+    if path:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Circular BOM reference: {low_level_codes.describe_cycle(db, path)}"
+        )
+
+
 # ==================== SEARCH BOMs ====================
 @router.get("/search", response_model=List[dict])
 def search_boms(
@@ -134,7 +182,7 @@ def search_boms(
         models.MasterBOM.sequence_order
     ).offset(skip).limit(limit).all()
     
-    return [get_bom_line_dict(bom, db) for bom in boms]
+    return get_bom_line_dicts(boms, db)
 
 
 # ==================== LIST BOMs ====================
@@ -180,78 +228,102 @@ def list_boms(
         models.MasterBOM.sequence_order
     ).offset(skip).limit(limit).all()
     
-    return [get_bom_line_dict(bom, db) for bom in boms]
+    return get_bom_line_dicts(boms, db)
 
 
 # ==================== GET PARENT ITEMS WITH BOMs ====================
 @router.get("/parents", response_model=List[dict])
 def get_bom_parents(
     include_inactive: bool = False,
+    search: Optional[str] = None,
+    skip: int = 0,
+    limit: Optional[int] = None,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    """Get list of parent items that have BOMs (grouped by parent and revision)"""
-    query = db.query(models.MasterBOM)
-    
+    """
+    Get list of parent items that have BOMs (grouped by parent and revision).
+    One grouped query; skip/limit page over parent items (all revisions of a
+    parent stay together), search filters on parent item code or name.
+    """
+    line_filters = []
     if not include_inactive:
-        query = query.filter(models.MasterBOM.is_active == True)
+        line_filters.append(models.MasterBOM.is_active == True)
+    
+    # Page of parent ids, ordered by item code
+    page = db.query(models.MasterBOM.parent_item_id).join(
+        models.MasterItem, models.MasterItem.id == models.MasterBOM.parent_item_id
+    ).filter(*line_filters)
+    if search:
+        page = page.filter(or_(
+            models.MasterItem.item_code.ilike(f"%{search}%"),
+            models.MasterItem.item_name.ilike(f"%{search}%")
+        ))
+    page = page.group_by(
+        models.MasterBOM.parent_item_id, models.MasterItem.item_code
+    ).order_by(models.MasterItem.item_code).offset(skip)
+    if limit is not None:
+        page = page.limit(limit)
+    page = page.subquery()
+    
+    # One row per (parent, revision): active line count and first active line
+    revisions = db.query(
+        models.MasterBOM.parent_item_id.label("parent_item_id"),
+        models.MasterBOM.revision.label("revision"),
+        func.sum(case((models.MasterBOM.is_active == True, 1), else_=0)).label("component_count"),
+        func.min(case((models.MasterBOM.is_active == True, models.MasterBOM.id))).label("first_line_id"),
+        func.min(models.MasterBOM.status).label("status"),
+        func.min(models.MasterBOM.revision_date).label("revision_date")
+    ).filter(
+        models.MasterBOM.parent_item_id.in_(select(page.c.parent_item_id)),
+        *line_filters
+    ).group_by(
+        models.MasterBOM.parent_item_id, models.MasterBOM.revision
+    ).subquery()
+    
+    first_line = aliased(models.MasterBOM)
+    rows = db.query(
+        models.MasterItem.id,
+        models.MasterItem.item_code,
+        models.MasterItem.item_name,
+        models.MasterItem.item_type,
+        revisions.c.revision,
+        revisions.c.component_count,
+        revisions.c.status,
+        revisions.c.revision_date,
+        first_line.bom_type,
+        first_line.is_template,
+        first_line.status.label("first_line_status")
+    ).join(
+        revisions, revisions.c.parent_item_id == models.MasterItem.id
+    ).outerjoin(
+        first_line, first_line.id == revisions.c.first_line_id
+    ).order_by(
+        models.MasterItem.item_code, revisions.c.revision.desc()
+    ).all()
     
-    # Get distinct parent items with their revisions
-    bom_parents = query.with_entities(
-        models.MasterBOM.parent_item_id,
-        models.MasterBOM.revision,
-        models.MasterBOM.status,
-        models.MasterBOM.revision_date
-    ).distinct().all()
+    # Revisions with active lines per parent
+    active_revisions = {}
+    for row in rows:
+        if row.component_count:
+            active_revisions.setdefault(row.id, []).append(row.revision)
     
     result = []
-    seen = set()
-    
-    for parent_id, revision, status, revision_date in bom_parents:
-        key = (parent_id, revision)
-        if key in seen:
-            continue
-        seen.add(key)
-        
-        parent = db.query(models.MasterItem).filter(models.MasterItem.id == parent_id).first()
-        if parent:
-            # Count components for this revision
-            component_count = db.query(models.MasterBOM).filter(
-                models.MasterBOM.parent_item_id == parent_id,
-                models.MasterBOM.revision == revision,
-                models.MasterBOM.is_active == True
-            ).count()
-            
-            # Get BOM type (from first component)
-            first_bom = db.query(models.MasterBOM).filter(
-                models.MasterBOM.parent_item_id == parent_id,
-                models.MasterBOM.revision == revision,
-                models.MasterBOM.is_active == True
-            ).first()
-            
-            # Get all revisions for this parent
-            all_revisions = db.query(models.MasterBOM.revision).filter(
-                models.MasterBOM.parent_item_id == parent_id,
-                models.MasterBOM.is_active == True
-            ).distinct().all()
-            revision_list = sorted([r[0] for r in all_revisions], reverse=True)
-            
-            result.append({
-                "id": parent.id,
-                "item_code": parent.item_code,
-                "item_name": parent.item_name,
-                "item_type": parent.item_type.value if hasattr(parent.item_type, 'value') else str(parent.item_type),
-                "bom_type": first_bom.bom_type if first_bom else None,
-                "component_count": component_count,
-                "is_template": first_bom.is_template if first_bom else True,
-                "revision": revision,
-                "revision_date": revision_date,
-                "status": status.value if hasattr(status, 'value') else str(status) if status else "ACTIVE",
-                "all_revisions": revision_list
-            })
-    
-    # Sort by item_code then revision (descending)
-    result.sort(key=lambda x: (x['item_code'], -x['revision']))
+    for row in rows:
+        status = row.first_line_status or row.status
+        result.append({
+            "id": row.id,
+            "item_code": row.item_code,
+            "item_name": row.item_name,
+            "item_type": row.item_type.value if hasattr(row.item_type, 'value') else str(row.item_type),
+            "bom_type": row.bom_type,
+            "component_count": row.component_count or 0,
+            "is_template": row.is_template if row.is_template is not None else True,
+            "revision": row.revision,
+            "revision_date": row.revision_date,
+            "status": status.value if hasattr(status, 'value') else str(status) if status else "ACTIVE",
+            "all_revisions": active_revisions.get(row.id, [])
+        })
     
     return result
 
@@ -347,7 +419,52 @@ def get_bom_by_parent(
         models.MasterBOM.revision == revision
     ).order_by(models.MasterBOM.sequence_order).all()
     
-    return [get_bom_line_dict(bom, db) for bom in boms]
+    return get_bom_line_dicts(boms, db)
+
+
+# ==================== LOW-LEVEL CODES ====================
+# Declared before GET /{bom_id}, which would otherwise capture /low-level-codes
+@router.get("/low-level-codes", response_model=List[dict])
+def list_low_level_codes(
+    min_level: int = 0,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """List items by low-level code (MRP processing order)"""
+    level = func.coalesce(models.ItemLowLevelCode.low_level_code, 0)
+    rows = db.query(
+        models.MasterItem.id,
+        models.MasterItem.item_code,
+        models.MasterItem.item_name,
+        level.label("low_level_code")
+    ).outerjoin(
+        models.ItemLowLevelCode, models.ItemLowLevelCode.item_id == models.MasterItem.id
+    ).filter(
+        level >= min_level
+    ).order_by(level, models.MasterItem.item_code).offset(skip).limit(limit).all()
+
+    return [{
+        "item_id": row.id,
+        "item_code": row.item_code,
+        "item_name": row.item_name,
+        "low_level_code": row.low_level_code
+    } for row in rows]
+
+
+@router.post("/low-level-codes/rebuild", response_model=dict)
+def rebuild_low_level_codes(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """Recompute every item's low-level code from master_bom"""
+    if current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Only Admin/Manager can rebuild low-level codes")
+
+    result = low_level_codes.rebuild_low_level_codes(db)
+
+    return {"message": f"Low-level codes rebuilt for {result['items']} items", **result}
 
 
 # ==================== GET BOM LINE ====================
@@ -389,6 +506,7 @@ def create_bom(
     # Check for circular reference
     if bom_data.parent_item_id == bom_data.child_item_id:
         raise HTTPException(status_code=400, detail="Parent and child cannot be the same item")
+    reject_circular_bom(db, bom_data.parent_item_id, [bom_data.child_item_id])
     
     # Validate locations if provided
     if bom_data.production_location_id:
@@ -448,7 +566,9 @@ def create_bom(
     )
     
     db.add(db_bom)
+    refresh_bom_structure(db, [bom_data.parent_item_id])
     db.commit()
+    bom_engine.bump_bom_version()
     db.refresh(db_bom)
     
     return get_bom_line_dict(db_bom, db)
@@ -480,7 +600,9 @@ def update_bom(
     for field, value in update_data.items():
         setattr(db_bom, field, value)
     
+    refresh_bom_structure(db, [db_bom.parent_item_id])
     db.commit()
+    bom_engine.bump_bom_version()
     db.refresh(db_bom)
     
     return get_bom_line_dict(db_bom, db)
@@ -576,7 +698,9 @@ def create_new_revision(
             models.MasterBOM.revision.in_(old_revisions)
         ).update({"is_active": False}, synchronize_session=False)
     
+    refresh_bom_structure(db, [parent_item_id])
     db.commit()
+    bom_engine.bump_bom_version()
     
     return {
         "message": f"Created revision {new_revision} for {parent.item_code}",
@@ -652,7 +776,9 @@ def set_revision_status(
         else:
             bom.inactive_date = inactive_date or date.today()
     
+    refresh_bom_structure(db, [parent_item_id])
     db.commit()
+    bom_engine.bump_bom_version()
     
     return {
         "message": f"Revision {revision} set to {new_status}",
@@ -678,7 +804,9 @@ def delete_bom(
         raise HTTPException(status_code=404, detail="BOM line not found")
     
     db_bom.is_active = False
+    refresh_bom_structure(db, [db_bom.parent_item_id])
     db.commit()
+    bom_engine.bump_bom_version()
     
     return {"message": "BOM line deleted successfully"}
 
@@ -713,7 +841,9 @@ def delete_entire_bom(
         bom.is_active = False
         count += 1
     
+    refresh_bom_structure(db, [parent_item_id])
     db.commit()
+    bom_engine.bump_bom_version()
     
     msg = f"Deleted {count} BOM lines"
     if revision:
@@ -769,6 +899,8 @@ def copy_bom(
     if existing_bom:
         raise HTTPException(status_code=400, detail="Target item already has a BOM. Delete it first.")
     
+    reject_circular_bom(db, target_parent_id, [source.child_item_id for source in source_boms])
+    
     # Copy BOM lines
     count = 0
     for source in source_boms:
@@ -797,20 +929,100 @@ def copy_bom(
         db.add(new_bom)
         count += 1
     
+    refresh_bom_structure(db, [target_parent_id])
     db.commit()
+    bom_engine.bump_bom_version()
     
     return {"message": f"Copied {count} BOM lines to {target_item.item_code}"}
 
 
 # ==================== EXPORT BOMs ====================
-@router.post("/export")
-def export_boms(
-    request: schemas.BOMExportRequest,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth_utils.get_current_user)
-):
-    """Export BOMs to CSV"""
-    query = db.query(models.MasterBOM)
+EXPORT_COLUMNS = [
+    'Parent Item Code', 'Parent Item Name', 'Child Item Code', 'Child Item Name',
+    'BOM Type', 'Quantity', 'UOM', 'Percentage', 'Scrap Factor', 'Is Optional',
+    'Is Byproduct', 'Production Location', 'Storage Location', 'Remark',
+    'Revision', 'Revision Date', 'Status', 'Active Date', 'Inactive Date'
+]
+
+# Rows fetched per round trip (server-side cursor) and written per CSV chunk
+EXPORT_BATCH_SIZE = 1000
+
+
+def _export_csv_chunks(query):
+    """Yield the CSV header, then one chunk of rows per fetched batch"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_COLUMNS)
+
+    rows_in_chunk = 0
+    for row in query.yield_per(EXPORT_BATCH_SIZE):
+        writer.writerow([
+            row.parent_item_code or '',
+            row.parent_item_name or '',
+            row.child_item_code or '',
+            row.child_item_name or '',
+            row.bom_type,
+            float(row.quantity),
+            row.child_uom or '',
+            float(row.percentage) if row.percentage else '',
+            float(row.scrap_factor) if row.scrap_factor else 0,
+            'Yes' if row.is_optional else 'No',
+            'Yes' if row.is_byproduct else 'No',
+            row.production_location_code or '',
+            row.storage_location_code or '',
+            row.remark or '',
+            row.revision,
+            row.revision_date.strftime('%Y-%m-%d %H:%M') if row.revision_date else '',
+            row.status.value if hasattr(row.status, 'value') else str(row.status) if row.status else 'ACTIVE',
+            row.active_date.strftime('%Y-%m-%d') if row.active_date else '',
+            row.inactive_date.strftime('%Y-%m-%d') if row.inactive_date else ''
+        ])
+        rows_in_chunk += 1
+        if rows_in_chunk >= EXPORT_BATCH_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            rows_in_chunk = 0
+
+    yield output.getvalue()
+
+
+def _export_query(db: Session, request: schemas.BOMExportRequest):
+    """Joined export query; without include_all_revisions only the latest ACTIVE revision of each parent"""
+    parent = aliased(models.MasterItem)
+    child = aliased(models.MasterItem)
+    prod_loc = aliased(models.LocationMaster)
+    stor_loc = aliased(models.LocationMaster)
+    
+    query = db.query(
+        parent.item_code.label("parent_item_code"),
+        parent.item_name.label("parent_item_name"),
+        child.item_code.label("child_item_code"),
+        child.item_name.label("child_item_name"),
+        child.unit_of_measure.label("child_uom"),
+        models.MasterBOM.bom_type,
+        models.MasterBOM.quantity,
+        models.MasterBOM.percentage,
+        models.MasterBOM.scrap_factor,
+        models.MasterBOM.is_optional,
+        models.MasterBOM.is_byproduct,
+        prod_loc.location_code.label("production_location_code"),
+        stor_loc.location_code.label("storage_location_code"),
+        models.MasterBOM.remark,
+        models.MasterBOM.revision,
+        models.MasterBOM.revision_date,
+        models.MasterBOM.status,
+        models.MasterBOM.active_date,
+        models.MasterBOM.inactive_date
+    ).outerjoin(
+        parent, parent.id == models.MasterBOM.parent_item_id
+    ).outerjoin(
+        child, child.id == models.MasterBOM.child_item_id
+    ).outerjoin(
+        prod_loc, prod_loc.id == models.MasterBOM.production_location_id
+    ).outerjoin(
+        stor_loc, stor_loc.id == models.MasterBOM.storage_location_id
+    )
     
     if not request.include_inactive:
         query = query.filter(models.MasterBOM.is_active == True)
@@ -819,62 +1031,58 @@ def export_boms(
         query = query.filter(models.MasterBOM.parent_item_id.in_(request.parent_item_ids))
     
     if not request.include_all_revisions:
-        # Only get latest active revision per parent
-        # This is simplified - in production, use a subquery
-        pass
+        # Only the latest active revision per parent
+        latest = db.query(
+            models.MasterBOM.parent_item_id.label("parent_item_id"),
+            func.max(models.MasterBOM.revision).label("revision")
+        ).filter(
+            models.MasterBOM.status == models.BOMStatus.ACTIVE
+        )
+        if not request.include_inactive:
+            latest = latest.filter(models.MasterBOM.is_active == True)
+        if request.parent_item_ids:
+            latest = latest.filter(models.MasterBOM.parent_item_id.in_(request.parent_item_ids))
+        latest = latest.group_by(models.MasterBOM.parent_item_id).subquery()
+        
+        query = query.join(
+            latest,
+            and_(
+                latest.c.parent_item_id == models.MasterBOM.parent_item_id,
+                latest.c.revision == models.MasterBOM.revision
+            )
+        )
     
-    boms = query.order_by(
+    query = query.order_by(
         models.MasterBOM.parent_item_id,
         models.MasterBOM.revision.desc(),
         models.MasterBOM.sequence_order
-    ).all()
-    
-    # Create CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Header
-    writer.writerow([
-        'Parent Item Code', 'Parent Item Name', 'Child Item Code', 'Child Item Name',
-        'BOM Type', 'Quantity', 'UOM', 'Percentage', 'Scrap Factor', 'Is Optional',
-        'Is Byproduct', 'Production Location', 'Storage Location', 'Remark',
-        'Revision', 'Revision Date', 'Status', 'Active Date', 'Inactive Date'
-    ])
+    )
     
-    # Data
-    for bom in boms:
-        parent = db.query(models.MasterItem).filter(models.MasterItem.id == bom.parent_item_id).first()
-        child = db.query(models.MasterItem).filter(models.MasterItem.id == bom.child_item_id).first()
-        prod_loc = db.query(models.LocationMaster).filter(models.LocationMaster.id == bom.production_location_id).first() if bom.production_location_id else None
-        stor_loc = db.query(models.LocationMaster).filter(models.LocationMaster.id == bom.storage_location_id).first() if bom.storage_location_id else None
-        
-        writer.writerow([
-            parent.item_code if parent else '',
-            parent.item_name if parent else '',
-            child.item_code if child else '',
-            child.item_name if child else '',
-            bom.bom_type,
-            float(bom.quantity),
-            child.unit_of_measure if child else '',
-            float(bom.percentage) if bom.percentage else '',
-            float(bom.scrap_factor) if bom.scrap_factor else 0,
-            'Yes' if bom.is_optional else 'No',
-            'Yes' if bom.is_byproduct else 'No',
-            prod_loc.location_code if prod_loc else '',
-            stor_loc.location_code if stor_loc else '',
-            bom.remark or '',
-            bom.revision,
-            bom.revision_date.strftime('%Y-%m-%d %H:%M') if bom.revision_date else '',
-            bom.status.value if hasattr(bom.status, 'value') else str(bom.status) if bom.status else 'ACTIVE',
-            bom.active_date.strftime('%Y-%m-%d') if bom.active_date else '',
-            bom.inactive_date.strftime('%Y-%m-%d') if bom.inactive_date else ''
-        ])
+    return query
+
+
+@router.post("/export")
+def export_boms(
+    request: schemas.BOMExportRequest,
+    run_async: bool = Query(False, alias="async"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """
+    Export BOMs to CSV.
+    Rows are streamed from one joined query, so memory stays flat for large exports.
+    Without include_all_revisions only the latest ACTIVE revision of each parent is exported.
+    With ?async=true the CSV is written by a background job and downloaded from /api/jobs/{id}/download.
+    """
+    if run_async:
+        job = job_runner.submit_job(db, "bom.export", request.dict(), current_user.id)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job_accepted(job))
     
-    output.seek(0)
+    query = _export_query(db, request)
     
     # Return as downloadable file
     return StreamingResponse(
-        iter([output.getvalue()]),
+        _export_csv_chunks(query),
         media_type="text/csv",
         headers={
             "Content-Disposition": f"attachment; filename=bom_export_{get_utc_now().strftime('%Y%m%d_%H%M%S')}.csv"
@@ -882,6 +1090,62 @@ def export_boms(
     )
 
 
+# ==================== IMPORT BOMs ====================
+@router.post("/import", response_model=dict)
+def import_boms(
+    file: UploadFile = File(...),
+    dry_run: bool = False,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """
+    Bulk import BOM lines from CSV (export columns) or NDJSON (.ndjson/.jsonl, same keys).
+    - Item and location codes are resolved in batches
+    - Circular references are checked for the whole file
+    - All-or-nothing: any row error rejects the import and returns the error report
+    - dry_run validates without writing
+    """
+    if current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Only Admin/Manager can import BOMs")
+    
+    try:
+        rows = bom_import.read_import_file(file.file.read(), file.filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if not rows:
+        raise HTTPException(status_code=400, detail="Import file has no rows")
+    
+    mappings, errors = bom_import.validate_import_rows(db, rows)
+    
+    result = {
+        "dry_run": dry_run,
+        "total_rows": len(rows),
+        "valid_rows": len(mappings),
+        "error_rows": len(errors),
+        "imported": 0,
+        "parents_updated": 0,
+        "errors": errors
+    }
+    
+    if errors:
+        result["message"] = f"Import rejected: {len(errors)} rows have errors"
+        return result
+    if dry_run:
+        result["message"] = f"Dry run passed: {len(mappings)} rows can be imported"
+        return result
+    
+    parent_ids = bom_import.insert_import_rows(db, mappings, current_user.id)
+    refresh_bom_structure(db, parent_ids)
+    db.commit()
+    bom_engine.bump_bom_version()
+    
+    result["imported"] = len(mappings)
+    result["parents_updated"] = len(parent_ids)
+    result["message"] = f"Imported {len(mappings)} BOM lines for {len(parent_ids)} parent items"
+    return result
+
+
 # ==================== GET LOCATIONS FOR DROPDOWN ====================
 @router.get("/locations/list", response_model=List[dict])
 def get_locations_for_bom(
@@ -903,169 +1167,163 @@ def get_locations_for_bom(
     } for loc in locations]
 
 
-# ==================== BOM EXPLOSION ALGORITHM ====================
-def _explode_bom_recursive(
-    db: Session,
-    parent_item_id: int,
-    quantity: Decimal,
-    revision: Optional[int],
-    include_optional: bool,
-    include_byproducts: bool,
-    max_levels: int,
-    current_level: int,
-    visited_items: set,
-    results: list
-) -> None:
+# ==================== WHERE-USED (IMPLOSION) ====================
+@router.get("/where-used/{child_item_id}", response_model=dict)
+def get_where_used(
+    child_item_id: int,
+    max_levels: int = 10,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
     """
-    Recursive BOM explosion helper function.
-    
-    Args:
-        db: Database session
-        parent_item_id: ID of the parent item to explode
-        quantity: Quantity to produce
-        revision: Specific revision to use (None = active revision)
-        include_optional: Whether to include optional components
-        include_byproducts: Whether to include by-products
-        max_levels: Maximum recursion depth
-        current_level: Current level in the BOM tree
-        visited_items: Set of item IDs already visited (circular reference detection)
-        results: List to accumulate explosion results
+    Get every direct and indirect parent that uses a component (active revisions).
+    Used for engineering change impact and shortage analysis.
     """
-    # Check max depth
-    if current_level > max_levels:
-        return
-    
-    # Check for circular reference
-    if parent_item_id in visited_items:
-        return
+    child = db.query(models.MasterItem).filter(models.MasterItem.id == child_item_id).first()
+    if not child:
+        raise HTTPException(status_code=404, detail="Item not found")
     
-    # Add to visited set for this branch
-    visited_items.add(parent_item_id)
+    parents = bom_closure.where_used(db, child_item_id, max_levels=max_levels)
     
-    # Get parent item info
-    parent_item = db.query(models.MasterItem).filter(
-        models.MasterItem.id == parent_item_id
-    ).first()
-    
-    if not parent_item:
-        visited_items.discard(parent_item_id)
-        return
+    return {
+        "child_item_id": child.id,
+        "child_item_code": child.item_code,
+        "child_item_name": child.item_name,
+        "total_parents": len({p["parent_item_id"] for p in parents}),
+        "total_end_items": len({p["parent_item_id"] for p in parents if p["is_end_item"]}),
+        "max_level": max([p["level"] for p in parents], default=0),
+        "parents": parents
+    }
+
+
+# ==================== BOM CLOSURE (FLATTENED BOM) ====================
+@router.post("/closure/rebuild", response_model=dict)
+def rebuild_bom_closure(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """Rebuild the flattened BOM table from master_bom"""
+    if current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Only Admin/Manager can rebuild the BOM closure")
+
+    rows = bom_closure.rebuild_bom_closure(db)
+
+    return {"message": f"BOM closure rebuilt with {rows} rows", "rows": rows}
+
+
+@router.get("/closure/check", response_model=dict)
+def check_bom_closure(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """Compare the flattened BOM table with master_bom and report differences"""
+    if current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Only Admin/Manager can check the BOM closure")
+
+    return bom_closure.check_bom_closure(db)
+
+
+# ==================== COST ROLL-UP ====================
+@router.post("/cost-rollup", response_model=dict)
+def roll_up_costs(
+    request: schemas.CostRollupRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """
+    Roll up assembly standard costs from component costs, quantities and scrap.
+    - Without component_item_ids the whole catalogue is rolled up
+    - With component_item_ids only their ancestors are recomputed
+    - commit=false previews the changes, commit=true writes them to master_items
+    """
+    if request.commit and current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Only Admin/Manager can update standard costs")
     
-    # Build query for BOM components
-    query = db.query(models.MasterBOM).filter(
-        models.MasterBOM.parent_item_id == parent_item_id,
-        models.MasterBOM.is_active == True
+    return cost_rollup.roll_up_standard_costs(
+        db,
+        component_item_ids=request.component_item_ids,
+        commit=request.commit
     )
+
+
+# ==================== BOM EXPLOSION ====================
+@router.get("/cache/stats", response_model=dict)
+def get_explosion_cache_stats(
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """Hit/miss counters of the BOM explosion cache"""
+    return bom_engine.get_explosion_cache_stats()
+
+
+@router.post("/explode/batch", response_model=dict)
+def explode_bom_batch(
+    request: schemas.BOMBatchExplosionRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """
+    Explode several parents together (e.g. all lines of a sales order).
+    The BOM graph is loaded once for all parents and shared sub-assemblies are
+    exploded once. Returns per-parent results plus raw materials consolidated
+    across all parents.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="At least one item is required")
     
-    # Filter by revision
-    if revision:
-        query = query.filter(models.MasterBOM.revision == revision)
-    else:
-        # Get active revision only
-        query = query.filter(models.MasterBOM.status == models.BOMStatus.ACTIVE)
-    
-    # Filter optional items
-    if not include_optional:
-        query = query.filter(models.MasterBOM.is_optional == False)
+    parent_ids = {entry.parent_item_id for entry in request.items}
+    parents = {
+        item.id: item for item in db.query(models.MasterItem).filter(
+            models.MasterItem.id.in_(parent_ids)
+        ).all()
+    }
+    missing = sorted(parent_ids - set(parents))
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Parent items not found: {missing}"
+        )
     
-    # Filter by-products
-    if not include_byproducts:
-        query = query.filter(models.MasterBOM.is_byproduct == False)
+    explosions = bom_engine.get_explosions(
+        db,
+        [(entry.parent_item_id, entry.revision) for entry in request.items],
+        include_optional=request.include_optional,
+        include_byproducts=request.include_byproducts,
+        max_levels=request.max_levels
+    )
     
-    # Order by sequence
-    bom_lines = query.order_by(models.MasterBOM.sequence_order).all()
+    no_bom = sorted({parents[e.parent_item_id].item_code for e in explosions if not e.has_bom})
+    if no_bom:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No BOM found for items: {', '.join(no_bom)}"
+        )
     
-    for bom in bom_lines:
-        # Get child item info
-        child_item = db.query(models.MasterItem).filter(
-            models.MasterItem.id == bom.child_item_id
-        ).first()
-        
-        if not child_item:
-            continue
-        
-        # Calculate quantities based on BOM type
-        if bom.bom_type == 'FORMULA' and bom.percentage:
-            # Formula: percentage-based calculation
-            bom_qty = Decimal(str(bom.percentage)) / Decimal("100")
-            required_qty = quantity * bom_qty
-        else:
-            # Assembly, Modular, Tailor-Made: fixed quantity
-            bom_qty = Decimal(str(bom.quantity))
-            required_qty = quantity * bom_qty
-        
-        # Calculate scrap
-        scrap_factor = Decimal(str(bom.scrap_factor)) if bom.scrap_factor else Decimal("0")
-        scrap_qty = required_qty * (scrap_factor / Decimal("100"))
-        total_qty = required_qty + scrap_qty
-        
-        # Get location info
-        prod_loc = None
-        stor_loc = None
-        if bom.production_location_id:
-            loc = db.query(models.LocationMaster).filter(
-                models.LocationMaster.id == bom.production_location_id
-            ).first()
-            prod_loc = loc.location_code if loc else None
-        if bom.storage_location_id:
-            loc = db.query(models.LocationMaster).filter(
-                models.LocationMaster.id == bom.storage_location_id
-            ).first()
-            stor_loc = loc.location_code if loc else None
-        
-        # Create explosion line
-        explosion_line = {
-            "level": current_level,
-            "item_id": child_item.id,
-            "item_code": child_item.item_code,
-            "item_name": child_item.item_name,
-            "item_type": child_item.item_type.value if hasattr(child_item.item_type, 'value') else str(child_item.item_type),
-            "unit_of_measure": child_item.unit_of_measure,
-            "bom_quantity": float(bom_qty),
-            "required_quantity": float(required_qty),
-            "scrap_factor": float(scrap_factor),
-            "scrap_quantity": float(scrap_qty),
-            "total_quantity": float(total_qty),
-            "bom_type": bom.bom_type,
-            "is_optional": bom.is_optional,
-            "is_byproduct": bom.is_byproduct,
-            "sequence_order": bom.sequence_order,
-            "percentage": float(bom.percentage) if bom.percentage else None,
-            "production_location": prod_loc,
-            "storage_location": stor_loc,
-            "parent_item_id": parent_item_id,
-            "parent_item_code": parent_item.item_code,
-            "bom_id": bom.id,
-            "revision": bom.revision,
-            "remark": bom.remark
-        }
-        
-        results.append(explosion_line)
-        
-        # Check if child item has its own BOM (sub-assembly)
-        # Only recurse if item is WIP or FINISHED_GOOD (can have sub-BOMs)
-        child_has_bom = db.query(models.MasterBOM).filter(
-            models.MasterBOM.parent_item_id == child_item.id,
-            models.MasterBOM.is_active == True
-        ).first()
-        
-        if child_has_bom and child_item.id not in visited_items:
-            # Recursively explode this component
-            _explode_bom_recursive(
-                db=db,
-                parent_item_id=child_item.id,
-                quantity=total_qty,  # Use total qty (including scrap) for sub-explosion
-                revision=None,  # Use active revision for sub-components
-                include_optional=include_optional,
-                include_byproducts=include_byproducts,
-                max_levels=max_levels,
-                current_level=current_level + 1,
-                visited_items=visited_items.copy(),  # Copy to allow different branches
-                results=results
-            )
+    results = []
+    raw_materials = {}
+    for entry, explosion in zip(request.items, explosions):
+        result = _explosion_result(parents[entry.parent_item_id], entry.quantity, explosion)
+        for raw in result["raw_materials_only"]:
+            total = raw_materials.setdefault(raw["item_id"], {
+                "item_id": raw["item_id"],
+                "item_code": raw["item_code"],
+                "item_name": raw["item_name"],
+                "unit_of_measure": raw["unit_of_measure"],
+                "total_quantity": 0.0,
+                "parent_item_ids": []
+            })
+            total["total_quantity"] += raw["total_quantity"]
+            if entry.parent_item_id not in total["parent_item_ids"]:
+                total["parent_item_ids"].append(entry.parent_item_id)
+        if not request.include_lines:
+            result.pop("lines")
+        results.append(result)
     
-    # Remove from visited set after processing this branch
-    visited_items.discard(parent_item_id)
+    return {
+        "explosion_date": get_utc_now(),
+        "total_parents": len(results),
+        "results": results,
+        "consolidated_raw_materials": sorted(raw_materials.values(), key=lambda x: x["item_code"])
+    }
 
 
 @router.post("/explode", response_model=dict)
@@ -1079,7 +1337,8 @@ def explode_bom(
     
     This algorithm:
     1. Takes a parent item and desired quantity
-    2. Recursively traverses the BOM tree
+    2. Traverses the BOM tree (loaded in set-based queries, walked iteratively)
+       Per-unit results are cached until the next BOM write
     3. Calculates total quantities needed (with scrap factors)
     4. Handles different BOM types (Assembly, Formula, Modular, Tailor-Made)
     5. Returns flat list of all materials needed
@@ -1102,59 +1361,39 @@ def explode_bom(
             detail=f"Parent item with ID {request.parent_item_id} not found"
         )
     
-    # Check if parent item has a BOM
-    bom_exists = db.query(models.MasterBOM).filter(
-        models.MasterBOM.parent_item_id == request.parent_item_id,
-        models.MasterBOM.is_active == True
-    ).first()
+    # Per-unit explosion (cached until the next BOM write), scaled to the requested quantity
+    explosion = bom_engine.get_explosion(
+        db,
+        parent_item_id=request.parent_item_id,
+        revision=request.revision,
+        include_optional=request.include_optional,
+        include_byproducts=request.include_byproducts,
+        max_levels=request.max_levels
+    )
     
-    if not bom_exists:
+    # Check if parent item has a BOM
+    if not explosion.has_bom:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No BOM found for item {parent_item.item_code}"
         )
     
-    # Determine revision to use
-    revision = request.revision
-    if not revision:
-        # Get active revision
-        active_bom = db.query(models.MasterBOM).filter(
-            models.MasterBOM.parent_item_id == request.parent_item_id,
-            models.MasterBOM.is_active == True,
-            models.MasterBOM.status == models.BOMStatus.ACTIVE
-        ).first()
-        revision = active_bom.revision if active_bom else 1
-    
-    # Run explosion algorithm
-    results = []
-    visited = set()
+    return _explosion_result(parent_item, request.quantity, explosion)
+
+
+def _explosion_result(parent_item, quantity: Decimal, explosion) -> dict:
+    """Explosion response for one parent: lines, statistics, consolidated and raw materials"""
+    # Revision used: requested, else active revision, else 1
+    revision = explosion.revision
     
-    _explode_bom_recursive(
-        db=db,
-        parent_item_id=request.parent_item_id,
-        quantity=request.quantity,
-        revision=revision,
-        include_optional=request.include_optional,
-        include_byproducts=request.include_byproducts,
-        max_levels=request.max_levels,
-        current_level=1,
-        visited_items=visited,
-        results=results
-    )
+    results = explosion.lines(quantity)
     
     # Calculate statistics
     total_levels = max([r["level"] for r in results], default=0)
     total_components = len(results)
     
     # Find raw materials (items that don't have their own BOMs)
-    raw_materials = []
-    for r in results:
-        child_bom = db.query(models.MasterBOM).filter(
-            models.MasterBOM.parent_item_id == r["item_id"],
-            models.MasterBOM.is_active == True
-        ).first()
-        if not child_bom:
-            raw_materials.append(r)
+    raw_materials = [r for r in results if r["item_id"] in explosion.raw_item_ids]
     
     has_optional = any(r["is_optional"] for r in results)
     has_byproducts = any(r["is_byproduct"] for r in results)
@@ -1179,10 +1418,7 @@ def explode_bom(
                 "required_quantity": r["required_quantity"],
                 "scrap_quantity": r["scrap_quantity"],
                 "occurrences": 1,
-                "is_raw_material": not db.query(models.MasterBOM).filter(
-                    models.MasterBOM.parent_item_id == r["item_id"],
-                    models.MasterBOM.is_active == True
-                ).first()
+                "is_raw_material": r["item_id"] in explosion.raw_item_ids
             }
     
     consolidated_list = sorted(
@@ -1194,7 +1430,7 @@ def explode_bom(
         "parent_item_id": parent_item.id,
         "parent_item_code": parent_item.item_code,
         "parent_item_name": parent_item.item_name,
-        "requested_quantity": float(request.quantity),
+        "requested_quantity": float(quantity),
         "revision": revision,
         "explosion_date": get_utc_now(),
         "total_levels": total_levels,
@@ -1235,3 +1471,19 @@ def explode_bom_simple(
         include_optional=include_optional
     )
     return explode_bom(request, db, current_user)
+
+
+# ==================== BACKGROUND JOBS ====================
+@job_runner.register_job("bom.export")
+def export_boms_job(db: Session, params: dict, context: job_runner.JobContext):
+    """Write the export CSV to the job's output file"""
+    query = _export_query(db, schemas.BOMExportRequest(**params))
+    total = query.order_by(None).count()
+    written = 0
+    path = context.output_path(f"bom_export_{get_utc_now().strftime('%Y%m%d_%H%M%S')}.csv")
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        for chunk in _export_csv_chunks(query):
+            f.write(chunk)
+            written = min(written + EXPORT_BATCH_SIZE, total)
+            context.progress(written * 100 // total if total else 100, f"{written} of {total} rows")
+    return {"rows": total, "file": context.output_file}
@@ -1,13 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List
+from sqlalchemy import and_, func
+from typing import List, Optional
 from decimal import Decimal
 from datetime import date
+import json
 import models
 import schemas
 from database import get_db
 from routers.auth import get_current_active_user
+from routers.jobs import job_accepted
+from services import inventory_snapshot, job_runner, stock_posting
 
 router = APIRouter(
     prefix="/api/inventory",
@@ -16,192 +20,27 @@ router = APIRouter(
 )
 
 
-def apply_fifo_costing(db: Session, item_id: int, warehouse_id: int, location_id: int, qty: Decimal):
-    """
-    Apply FIFO (First-In, First-Out) costing when issuing inventory
-    Returns: total_cost, avg_cost
-    """
-    # Get all cost layers for this item/warehouse/location, ordered by receipt date (FIFO)
-    cost_layers = db.query(models.InventoryCostLayer).filter(
-        models.InventoryCostLayer.item_id == item_id,
-        models.InventoryCostLayer.warehouse_id == warehouse_id,
-        models.InventoryCostLayer.location_id == location_id,
-        models.InventoryCostLayer.qty_remaining > 0
-    ).order_by(models.InventoryCostLayer.receipt_date).all()
-    
-    if not cost_layers:
-        raise HTTPException(
-            status_code=400,
-            detail=f"No cost layers available for FIFO calculation. Item may not have been received yet."
-        )
-    
-    remaining_to_issue = qty
-    total_cost = Decimal(0)
-    
-    for layer in cost_layers:
-        if remaining_to_issue <= 0:
-            break
-        
-        # Take from this layer
-        qty_to_take = min(layer.qty_remaining, remaining_to_issue)
-        cost_from_layer = qty_to_take * layer.unit_cost
-        
-        total_cost += cost_from_layer
-        layer.qty_remaining -= qty_to_take
-        remaining_to_issue -= qty_to_take
-    
-    if remaining_to_issue > 0:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Insufficient inventory for FIFO costing. Short by {remaining_to_issue}"
-        )
-    
-    avg_cost = total_cost / qty if qty > 0 else Decimal(0)
-    return total_cost, avg_cost
-
-
-def create_cost_layer(db: Session, item_id: int, warehouse_id: int, location_id: int, 
-                      qty: Decimal, unit_cost: Decimal, receipt_date: date, transaction_id: int, lot_number: str = None):
-    """Create a new cost layer when receiving inventory"""
-    cost_layer = models.InventoryCostLayer(
-        item_id=item_id,
-        warehouse_id=warehouse_id,
-        location_id=location_id,
-        receipt_date=receipt_date,
-        qty_remaining=qty,
-        unit_cost=unit_cost,
-        receipt_transaction_id=transaction_id,
-        lot_number=lot_number
-    )
-    db.add(cost_layer)
-    return cost_layer
-
 @router.post("/transactions", status_code=status.HTTP_201_CREATED)
 def create_inventory_transaction(
     transaction: schemas.StockTransactionCreate,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_active_user)
 ):
-    # Validate items and warehouses exist
-    for item in transaction.items:
-        # Lookup Item
-        db_item = db.query(models.MasterItem).filter(models.MasterItem.item_code == item.item_code).first()
-        if not db_item:
-            # Try by ID if code fails (frontend sends ID as value)
-            try:
-                item_id = int(item.item_code)
-                db_item = db.query(models.MasterItem).filter(models.MasterItem.id == item_id).first()
-            except ValueError:
-                pass
-            
-            if not db_item:
-                raise HTTPException(status_code=404, detail=f"Item not found: {item.item_code}")
-        
-        # Lookup Warehouse
-        db_warehouse = db.query(models.MasterWarehouse).filter(models.MasterWarehouse.warehouse_code == item.warehouse_code).first()
-        if not db_warehouse:
-             raise HTTPException(status_code=404, detail=f"Warehouse not found: {item.warehouse_code}")
-
-        # Lookup Location (Optional)
-        db_location = None
-        if item.location_code:
-            db_location = db.query(models.LocationMaster).filter(
-                models.LocationMaster.warehouse_id == db_warehouse.id,
-                models.LocationMaster.location_code == item.location_code
-            ).first()
-            if not db_location:
-                raise HTTPException(status_code=404, detail=f"Location not found: {item.location_code} in warehouse {db_warehouse.warehouse_code}")
-
-        # Validate Lot Control
-        if db_item.lot_control and not item.lot_number:
-            raise HTTPException(status_code=400, detail=f"Item {item.item_code} requires Lot Number")
-
-        # Create Transaction Record
-        db_txn = models.InventoryTransaction(
-            transaction_date=transaction.transaction_date,
-            item_id=db_item.id,
-            warehouse_id=db_warehouse.id,
-            location_id=db_location.id if db_location else None,
-            lot_number=item.lot_number,
-            transaction_type=transaction.type,
-            reference_no=transaction.reference_no,
-            qty=item.qty, 
-            created_by=current_user.id
-        )
-        db.add(db_txn)
-        db.flush()  # Get transaction ID
-
-        # Update Balance (by Lot)
-        balance_query = db.query(models.InventoryBalance).filter(
-            models.InventoryBalance.item_id == db_item.id,
-            models.InventoryBalance.warehouse_id == db_warehouse.id,
-            models.InventoryBalance.location_id == (db_location.id if db_location else None)
-        )
-        
-        if item.lot_number:
-            balance_query = balance_query.filter(models.InventoryBalance.lot_number == item.lot_number)
-        else:
-            balance_query = balance_query.filter(models.InventoryBalance.lot_number == None)
-            
-        balance = balance_query.first()
-
-        if not balance:
-            balance = models.InventoryBalance(
-                item_id=db_item.id,
-                warehouse_id=db_warehouse.id,
-                location_id=db_location.id if db_location else None,
-                lot_number=item.lot_number,
-                qty_on_hand=0,
-                avg_cost=0
-            )
-            db.add(balance)
-        
-        if transaction.type == 'receipt':
-            # RECEIPT: Create cost layer and update balance
-            unit_cost = db_item.standard_cost or Decimal(0)  # Use standard cost or get from PO
-            
-            create_cost_layer(
-                db, 
-                db_item.id, 
-                db_warehouse.id, 
-                db_location.id if db_location else None,
-                item.qty,
-                unit_cost,
-                transaction.transaction_date.date() if hasattr(transaction.transaction_date, 'date') else transaction.transaction_date,
-                db_txn.id,
-                item.lot_number
-            )
-            
-            # Update balance with moving average
-            old_total_cost = balance.qty_on_hand * balance.avg_cost
-            new_total_cost = old_total_cost + (item.qty * unit_cost)
-            balance.qty_on_hand += item.qty
-            balance.avg_cost = new_total_cost / balance.qty_on_hand if balance.qty_on_hand > 0 else Decimal(0)
-            
-        elif transaction.type == 'issue':
-            # ISSUE: Apply FIFO costing
-            if balance.qty_on_hand < item.qty:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Insufficient inventory. Available: {balance.qty_on_hand}, Requested: {item.qty}"
-                )
-            
-            try:
-                total_cost, avg_cost_issued = apply_fifo_costing(
-                    db,
-                    db_item.id,
-                    db_warehouse.id,
-                    db_location.id if db_location else None,
-                    item.qty
-                )
-                
-                # Update balance quantity (avg_cost stays same - it's the overall average)
-                balance.qty_on_hand -= item.qty
-                
-            except HTTPException:
-                # If FIFO fails (no cost layers), just update quantity with warning
-                balance.qty_on_hand -= item.qty
-            
+    """
+    Post a stock receipt or issue. Codes and balances are resolved in batches;
+    if any line is invalid nothing is posted and every failing line is reported.
+    """
+    try:
+        stock_posting.post_stock_transaction(db, transaction, current_user.id)
+    except stock_posting.StockPostingError as e:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={
+            "detail": f"{e}: " + "; ".join(
+                f"Line {error['line']}: {', '.join(error['errors'])}" for error in e.errors
+            ),
+            "errors": e.errors
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     db.commit()
     return {"message": "Transaction recorded successfully"}
 
@@ -244,64 +83,317 @@ def get_cost_layers(
     }
 
 
+# ==================== VALUATION ====================
+VALUATION_GROUP_BY = ("item", "warehouse", "category")
+
+# Rows fetched per round trip and written per response chunk
+VALUATION_BATCH_SIZE = 1000
+
+
+def _valuation_base(db: Session, warehouse_id: Optional[int]):
+    """
+    Positive balances with their FIFO value: open layers are summed per stock
+    key in SQL and joined to the balance of the same key (NULL location and
+    lot match NULL, as in the balance key).
+    """
+    layer = models.InventoryCostLayer
+    balance = models.InventoryBalance
+    layer_location = func.coalesce(layer.location_id, 0)
+    layer_lot = func.coalesce(layer.lot_number, '')
+    layers = db.query(
+        layer.item_id.label("item_id"),
+        layer.warehouse_id.label("warehouse_id"),
+        layer_location.label("location_key"),
+        layer_lot.label("lot_key"),
+        func.sum(layer.qty_remaining * layer.unit_cost).label("fifo_value")
+    ).filter(layer.qty_remaining > 0)
+    if warehouse_id:
+        layers = layers.filter(layer.warehouse_id == warehouse_id)
+    layers = layers.group_by(layer.item_id, layer.warehouse_id, layer_location, layer_lot).subquery()
+
+    query = db.query(
+        balance.id.label("balance_id"),
+        balance.item_id.label("item_id"),
+        balance.warehouse_id.label("warehouse_id"),
+        balance.qty_on_hand.label("qty_on_hand"),
+        balance.avg_cost.label("avg_cost"),
+        (balance.qty_on_hand * balance.avg_cost).label("moving_avg_value"),
+        func.coalesce(layers.c.fifo_value, 0).label("fifo_value")
+    ).outerjoin(
+        layers, and_(
+            layers.c.item_id == balance.item_id,
+            layers.c.warehouse_id == balance.warehouse_id,
+            layers.c.location_key == func.coalesce(balance.location_id, 0),
+            layers.c.lot_key == func.coalesce(balance.lot_number, '')
+        )
+    ).filter(balance.qty_on_hand > 0)
+    if warehouse_id:
+        query = query.filter(balance.warehouse_id == warehouse_id)
+    return query
+
+
+def _valuation_query(db: Session, warehouse_id: Optional[int], group_by: Optional[str]):
+    """One row per balance, or per group with the totals summed in SQL"""
+    base = _valuation_base(db, warehouse_id)
+    if group_by is None:
+        return base.order_by(models.InventoryBalance.item_id, models.InventoryBalance.warehouse_id, models.InventoryBalance.id)
+
+    rows = base.subquery()
+    totals = (
+        func.count().label("balance_count"),
+        func.sum(rows.c.qty_on_hand).label("qty_on_hand"),
+        func.sum(rows.c.fifo_value).label("fifo_value"),
+        func.sum(rows.c.moving_avg_value).label("moving_avg_value")
+    )
+    if group_by == "warehouse":
+        warehouse = models.MasterWarehouse
+        keys = (rows.c.warehouse_id, warehouse.warehouse_code, warehouse.warehouse_name)
+        return db.query(*keys, *totals).join(
+            warehouse, warehouse.id == rows.c.warehouse_id
+        ).group_by(*keys).order_by(warehouse.warehouse_code)
+
+    item = models.MasterItem
+    if group_by == "item":
+        keys = (rows.c.item_id, item.item_code, item.item_name, item.category)
+        order = item.item_code
+    else:
+        keys = (item.category,)
+        order = item.category
+    return db.query(*keys, *totals).join(item, item.id == rows.c.item_id).group_by(*keys).order_by(order)
+
+
+def _valuation_entry(row, group_by: Optional[str]) -> dict:
+    qty = row.qty_on_hand or Decimal(0)
+    fifo_value = row.fifo_value or Decimal(0)
+    moving_avg_value = row.moving_avg_value or Decimal(0)
+    variance = fifo_value - moving_avg_value
+    if group_by is None:
+        entry = {"item_id": row.item_id, "warehouse_id": row.warehouse_id}
+        moving_avg_unit_cost = row.avg_cost or Decimal(0)
+    else:
+        entry = {key: getattr(row, key) for key in row._fields[:-4]}
+        entry["balance_count"] = row.balance_count
+        moving_avg_unit_cost = moving_avg_value / qty if qty > 0 else Decimal(0)
+    entry.update({
+        "qty_on_hand": float(qty),
+        "fifo_unit_cost": float(fifo_value / qty) if qty > 0 else 0,
+        "fifo_total_value": float(fifo_value),
+        "moving_avg_unit_cost": float(moving_avg_unit_cost),
+        "moving_avg_total_value": float(moving_avg_value),
+        "variance": float(variance),
+        "variance_pct": float((variance / moving_avg_value * 100) if moving_avg_value > 0 else 0)
+    })
+    return entry
+
+
+def _valuation_details(query, group_by: Optional[str], totals: dict):
+    """Yield report rows batch by batch, adding them to totals as they go"""
+    for row in query.yield_per(VALUATION_BATCH_SIZE):
+        totals["balances"] += row.balance_count if group_by else 1
+        totals["fifo"] += row.fifo_value or Decimal(0)
+        totals["moving_avg"] += row.moving_avg_value or Decimal(0)
+        yield _valuation_entry(row, group_by)
+
+
+def _valuation_summary(totals: dict) -> dict:
+    total_fifo, total_moving_avg = totals["fifo"], totals["moving_avg"]
+    return {
+        "total_items": totals["balances"],
+        "total_fifo_value": float(total_fifo),
+        "total_moving_avg_value": float(total_moving_avg),
+        "total_variance": float(total_fifo - total_moving_avg),
+        "variance_pct": float(((total_fifo - total_moving_avg) / total_moving_avg * 100) if total_moving_avg > 0 else 0)
+    }
+
+
+def _new_valuation_totals() -> dict:
+    return {"balances": 0, "fifo": Decimal(0), "moving_avg": Decimal(0)}
+
+
+def build_inventory_valuation(db: Session, warehouse_id: Optional[int] = None, group_by: Optional[str] = None) -> dict:
+    """Whole valuation report in memory (background jobs)"""
+    totals = _new_valuation_totals()
+    details = list(_valuation_details(_valuation_query(db, warehouse_id, group_by), group_by, totals))
+    return {"group_by": group_by, "summary": _valuation_summary(totals), "details": details}
+
+
+def _valuation_json_chunks(query, group_by: Optional[str]):
+    """Yield the report as JSON, one chunk of details per fetched batch; the summary comes last"""
+    totals = _new_valuation_totals()
+    yield '{"group_by": %s, "details": [' % json.dumps(group_by)
+    chunk = []
+    first = True
+    for entry in _valuation_details(query, group_by, totals):
+        chunk.append(json.dumps(entry))
+        if len(chunk) >= VALUATION_BATCH_SIZE:
+            yield ("" if first else ",") + ",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ("" if first else ",") + ",".join(chunk)
+    yield '], "summary": %s}' % json.dumps(_valuation_summary(totals))
+
+
 @router.get("/valuation")
 def get_inventory_valuation(
     warehouse_id: int = None,
+    group_by: Optional[str] = None,
+    run_async: bool = Query(False, alias="async"),
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_active_user)
 ):
     """
     Get inventory valuation report
-    Shows: FIFO Cost vs Moving Average comparison
+    Shows: FIFO Cost vs Moving Average comparison, per balance or grouped by
+    item, warehouse or category. FIFO values come from one grouped join of
+    balances and cost layers and the rows are streamed as they are read.
     """
-    query = db.query(models.InventoryBalance).filter(
-        models.InventoryBalance.qty_on_hand > 0
+    if group_by is not None and group_by not in VALUATION_GROUP_BY:
+        raise HTTPException(status_code=400, detail=f"Invalid group_by. Must be one of: {list(VALUATION_GROUP_BY)}")
+    if run_async:
+        job = job_runner.submit_job(
+            db, "inventory.valuation", {"warehouse_id": warehouse_id, "group_by": group_by}, current_user.id
+        )
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job_accepted(job))
+
+    return StreamingResponse(
+        _valuation_json_chunks(_valuation_query(db, warehouse_id, group_by), group_by),
+        media_type="application/json"
     )
-    
-    if warehouse_id:
-        query = query.filter(models.InventoryBalance.warehouse_id == warehouse_id)
-    
-    balances = query.all()
-    
-    valuation_data = []
-    total_fifo = Decimal(0)
-    total_moving_avg = Decimal(0)
-    
-    for balance in balances:
-        # Get FIFO cost
-        cost_layers = db.query(models.InventoryCostLayer).filter(
-            models.InventoryCostLayer.item_id == balance.item_id,
-            models.InventoryCostLayer.warehouse_id == balance.warehouse_id,
-            models.InventoryCostLayer.location_id == balance.location_id,
-            models.InventoryCostLayer.qty_remaining > 0
-        ).all()
-        
-        fifo_value = sum(layer.qty_remaining * layer.unit_cost for layer in cost_layers)
-        moving_avg_value = balance.qty_on_hand * balance.avg_cost
-        variance = fifo_value - moving_avg_value
-        
-        total_fifo += fifo_value
-        total_moving_avg += moving_avg_value
-        
-        valuation_data.append({
-            "item_id": balance.item_id,
-            "warehouse_id": balance.warehouse_id,
-            "qty_on_hand": float(balance.qty_on_hand),
-            "fifo_unit_cost": float(fifo_value / balance.qty_on_hand) if balance.qty_on_hand > 0 else 0,
-            "fifo_total_value": float(fifo_value),
-            "moving_avg_unit_cost": float(balance.avg_cost),
-            "moving_avg_total_value": float(moving_avg_value),
-            "variance": float(variance),
-            "variance_pct": float((variance / moving_avg_value * 100) if moving_avg_value > 0 else 0)
+
+
+# ==================== PERIOD SNAPSHOTS ====================
+def _snapshot_summary(snapshot: models.InventorySnapshot) -> dict:
+    return {
+        "id": snapshot.id,
+        "period_end": snapshot.period_end,
+        "base_period_end": snapshot.base_period_end,
+        "line_count": snapshot.line_count,
+        "total_qty": float(snapshot.total_qty or 0),
+        "total_value": float(snapshot.total_value or 0),
+        "created_by": snapshot.created_by,
+        "created_at": snapshot.created_at
+    }
+
+
+@router.post("/snapshots", status_code=status.HTTP_201_CREATED)
+def create_inventory_snapshot(
+    period_end: Optional[date] = None,
+    run_async: bool = Query(False, alias="async"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Snapshot a period: write its closing qty and value per stock key.
+    Defaults to the last month end; the scheduler also snapshots each month on its own.
+    Periods stay open: a later posting dated in the period drops the snapshot again.
+    """
+    period_end = period_end or inventory_snapshot.last_period_end()
+    if run_async:
+        job = job_runner.submit_job(db, "inventory.snapshot", {"period_end": period_end}, current_user.id)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job_accepted(job))
+
+    try:
+        snapshot = inventory_snapshot.create_snapshot(db, period_end, current_user.id if current_user else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db.commit()
+    db.refresh(snapshot)
+    return _snapshot_summary(snapshot)
+
+
+@router.get("/snapshots")
+def list_inventory_snapshots(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Period snapshots, latest first"""
+    snapshots = db.query(models.InventorySnapshot).order_by(models.InventorySnapshot.period_end.desc()).all()
+    return [_snapshot_summary(snapshot) for snapshot in snapshots]
+
+
+@router.delete("/snapshots/{snapshot_id}")
+def delete_inventory_snapshot(
+    snapshot_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Drop a snapshot (Admin/Manager); the scheduler writes missing month ends again"""
+    if current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=403, detail="Only Admin/Manager can delete inventory snapshots")
+    snapshot = db.query(models.InventorySnapshot).filter(models.InventorySnapshot.id == snapshot_id).first()
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Inventory snapshot not found")
+    period_end = snapshot.period_end
+    inventory_snapshot.drop_snapshots(db, [snapshot_id])
+    db.commit()
+    return {"message": f"Inventory snapshot for {period_end} deleted"}
+
+
+@router.get("/as-of")
+def get_inventory_as_of(
+    as_of: date,
+    item_id: int = None,
+    warehouse_id: int = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Stock on hand and its value at the end of a day: the latest period
+    snapshot on or before it plus only the transactions posted after it.
+    """
+    base, position, applied = inventory_snapshot.position_as_of(db, as_of, item_id, warehouse_id)
+
+    details = []
+    total_qty = Decimal(0)
+    total_value = Decimal(0)
+    for (key_item_id, key_warehouse_id, location_id, lot_number), (qty, value) in sorted(
+        position.items(), key=lambda entry: (entry[0][0], entry[0][1], entry[0][2] or 0, entry[0][3] or '')
+    ):
+        if not qty and not value:
+            continue
+        total_qty += qty
+        total_value += value
+        details.append({
+            "item_id": key_item_id,
+            "warehouse_id": key_warehouse_id,
+            "location_id": location_id,
+            "lot_number": lot_number,
+            "qty_on_hand": float(qty),
+            "total_value": float(value),
+            "unit_cost": float(value / qty) if qty else 0
         })
-    
+
     return {
+        "as_of": as_of,
+        "snapshot_period_end": base.period_end if base is not None else None,
+        "transactions_applied": applied,
         "summary": {
-            "total_items": len(valuation_data),
-            "total_fifo_value": float(total_fifo),
-            "total_moving_avg_value": float(total_moving_avg),
-            "total_variance": float(total_fifo - total_moving_avg),
-            "variance_pct": float(((total_fifo - total_moving_avg) / total_moving_avg * 100) if total_moving_avg > 0 else 0)
+            "total_lines": len(details),
+            "total_qty": float(total_qty),
+            "total_value": float(total_value)
         },
-        "details": valuation_data
+        "details": details
     }
+
+
+# ==================== BACKGROUND JOBS ====================
+@job_runner.register_job("inventory.valuation")
+def inventory_valuation_job(db: Session, params: dict, context: job_runner.JobContext):
+    context.progress(5, "Valuing inventory")
+    return build_inventory_valuation(db, params.get("warehouse_id"), params.get("group_by"))
+
+
+@job_runner.register_job("inventory.snapshot")
+def inventory_snapshot_job(db: Session, params: dict, context: job_runner.JobContext):
+    context.progress(5, "Closing inventory period")
+    return create_inventory_snapshot(
+        period_end=date.fromisoformat(params["period_end"]), run_async=False, db=db,
+        current_user=db.query(models.User).filter(models.User.id == context.created_by).first()
+    )
+
+
+@job_runner.register_periodic(inventory_snapshot.SNAPSHOT_CHECK_SECONDS)
+def snapshot_inventory_periods(db: Session):
+    """Snapshot each month shortly after it ends, and month ends dropped by backdated postings"""
+    inventory_snapshot.close_due_periods(db)
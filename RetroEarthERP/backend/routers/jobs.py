@@ -0,0 +1,100 @@
+"""
+Background Jobs API
+Progress, result, cancellation and output download of jobs queued with ?async=true
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional
+import os
+import models
+import schemas
+from database import get_db
+from routers.auth import get_current_active_user
+from services import job_runner
+
+router = APIRouter(
+    prefix="/api/jobs",
+    tags=["Background Jobs"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+def get_job_or_404(db: Session, job_id: int, current_user: models.User) -> models.BackgroundJob:
+    """A job visible to the user: their own, or any job for admins and managers"""
+    job = db.query(models.BackgroundJob).filter(models.BackgroundJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.created_by != current_user.id and current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def job_accepted(job: models.BackgroundJob) -> dict:
+    """Response body for an endpoint called with ?async=true"""
+    return {
+        "job_id": job.id,
+        "job_type": job.job_type,
+        "status": job.status.value if hasattr(job.status, 'value') else str(job.status),
+        "status_url": f"/api/jobs/{job.id}"
+    }
+
+
+@router.get("/", response_model=List[schemas.JobResponse])
+def list_jobs(
+    job_status: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Recent jobs of the current user (all users' jobs for admins and managers)"""
+    query = db.query(models.BackgroundJob)
+    if current_user.role not in [models.UserRole.ADMIN, models.UserRole.MANAGER]:
+        query = query.filter(models.BackgroundJob.created_by == current_user.id)
+    if job_status:
+        try:
+            query = query.filter(models.BackgroundJob.status == models.BackgroundJobStatus(job_status.upper()))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {[s.value for s in models.BackgroundJobStatus]}")
+    return query.order_by(models.BackgroundJob.id.desc()).offset(skip).limit(limit).all()
+
+
+@router.get("/{job_id}", response_model=schemas.JobResponse)
+def get_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Status, progress and (when finished) result or error of a job"""
+    return get_job_or_404(db, job_id, current_user)
+
+
+@router.post("/{job_id}/cancel", response_model=schemas.JobResponse)
+def cancel_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Cancel a queued job, or ask a running job to stop at its next progress step"""
+    job = get_job_or_404(db, job_id, current_user)
+    try:
+        return job_runner.cancel_job(db, job)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/{job_id}/download")
+def download_job_output(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Download the file a finished job produced (e.g. a BOM export)"""
+    job = get_job_or_404(db, job_id, current_user)
+    if job.status != models.BackgroundJobStatus.SUCCEEDED or not job.output_file:
+        raise HTTPException(status_code=404, detail="Job has no output file")
+    path = os.path.join(job_runner.JOB_OUTPUT_DIR, job.output_file)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Output file no longer exists")
+    return FileResponse(path, filename=job.output_file.split("_", 1)[-1])
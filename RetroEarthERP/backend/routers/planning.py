@@ -2,10 +2,13 @@
 Production Planning & MRP Engine
 Implements the planning calculation logic to generate PRs and Work Orders
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.orm import Session, contains_eager
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError
+from typing import List, Optional
 from datetime import datetime, date, timedelta, timezone
 from decimal import Decimal
 from utils.datetime_utils import get_utc_now
@@ -13,6 +16,8 @@ import models
 import schemas
 from database import get_db
 from routers.auth import get_current_active_user
+from services import mrp_engine, job_runner, capacity_planning, production_calendar
+from routers.jobs import job_accepted
 
 router = APIRouter(
     prefix="/api/planning",
@@ -95,13 +100,29 @@ def add_plan_items(
 @router.post("/{plan_id}/calculate", response_model=schemas.ProductionPlanResponse)
 def calculate_plan(
     plan_id: int,
+    bucket: str = "day",
+    run_async: bool = Query(False, alias="async"),
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_active_user)
 ):
     """
     Pre-Calculation: Run MRP Calculation for a specific plan.
     Generates MRP Results (Material Availability Report) but does NOT create PRs/WOs.
+    
+    Multi-level and time-phased: demand is bucketed by day or week and
+    exploded through the BOM, each item netted against on-hand, open POs and
+    safety stock, and planned orders offset by lead time.
     """
+    db_plan = _plan_to_calculate(db, plan_id, bucket)
+    
+    if run_async:
+        job = job_runner.submit_job(db, "planning.calculate", {"plan_id": plan_id, "bucket": bucket}, current_user.id)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job_accepted(job))
+    
+    return _calculate(db, db_plan, bucket)
+
+
+def _plan_to_calculate(db: Session, plan_id: int, bucket: str) -> models.ProductionPlan:
     db_plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.id == plan_id).first()
     if not db_plan:
         raise HTTPException(status_code=404, detail="Plan not found")
@@ -109,100 +130,19 @@ def calculate_plan(
     if db_plan.status != 'DRAFT':
         raise HTTPException(status_code=400, detail="Plan already calculated")
     
-    # Clear existing results if any (though status check prevents this)
-    db.query(models.MRPResult).filter(models.MRPResult.plan_id == plan_id).delete()
-    
-    # Step 1: Get Demand
-    demands = []
-    
-    if db_plan.source_type == 'ACTUAL':
-        # Get from Confirmed Sales Orders
-        sales_orders = db.query(models.TrnSalesOrderHead).filter(
-            models.TrnSalesOrderHead.status.in_(['CONFIRMED', 'PARTIAL_DELIVERED'])
-        ).all()
-        
-        for so in sales_orders:
-            for detail in so.details:
-                remaining_qty = detail.qty_ordered - detail.qty_delivered
-                if remaining_qty > 0:
-                    demands.append({
-                        'item_id': detail.item_id,
-                        'required_qty': remaining_qty,
-                        'required_date': so.delivery_date or so.so_date
-                    })
-                    
-    elif db_plan.source_type == 'MANUAL' or db_plan.source_type == 'FORECAST':
-        # Get from Plan Items
-        for item in db_plan.items:
-            demands.append({
-                'item_id': item.item_id,
-                'required_qty': item.quantity,
-                'required_date': item.delivery_date
-            })
-    
-    # Step 2: Calculate Net Requirements
-    for demand in demands:
-        item = db.query(models.MasterItem).filter(
-            models.MasterItem.id == demand['item_id']
-        ).first()
-        
-        if not item:
-            continue
-        
-        # Get current inventory (all warehouses)
-        on_hand = db.query(func.sum(models.InventoryBalance.qty_on_hand)).filter(
-            models.InventoryBalance.item_id == demand['item_id']
-        ).scalar() or Decimal(0)
-        
-        # Get incoming PO qty (not yet received)
-        incoming_po = db.query(func.sum(models.TrnPurchaseOrderDetail.qty_ordered - models.TrnPurchaseOrderDetail.qty_received)).filter(
-            models.TrnPurchaseOrderDetail.item_id == demand['item_id'],
-            models.TrnPurchaseOrderDetail.qty_ordered > models.TrnPurchaseOrderDetail.qty_received
-        ).scalar() or Decimal(0)
-        
-        # Net Requirement
-        net_requirement = demand['required_qty'] - (on_hand + incoming_po)
-        
-        if net_requirement > 0:
-            # Check if item is produced or purchased
-            has_bom = db.query(models.MasterBOM).filter(
-                models.MasterBOM.parent_item_id == demand['item_id'],
-                models.MasterBOM.is_active == True
-            ).first()
-            
-            action = models.SuggestedAction.MAKE if has_bom else models.SuggestedAction.BUY
-            
-            # Create MRP Result
-            mrp_result = models.MRPResult(
-                plan_id=db_plan.id,
-                item_id=demand['item_id'],
-                required_date=demand['required_date'],
-                gross_requirement=demand['required_qty'],
-                on_hand_qty=on_hand,
-                open_po_qty=incoming_po,
-                net_requirement=net_requirement,
-                suggested_action=action,
-                suggested_qty=net_requirement
-            )
-            db.add(mrp_result)
-        else:
-            # Requirement met
-            mrp_result = models.MRPResult(
-                plan_id=db_plan.id,
-                item_id=demand['item_id'],
-                required_date=demand['required_date'],
-                gross_requirement=demand['required_qty'],
-                on_hand_qty=on_hand,
-                open_po_qty=incoming_po,
-                net_requirement=Decimal(0),
-                suggested_action=models.SuggestedAction.NONE,
-                suggested_qty=Decimal(0)
-            )
-            db.add(mrp_result)
+    if bucket not in mrp_engine.BUCKET_DAYS:
+        raise HTTPException(status_code=400, detail=f"Invalid bucket. Must be one of: {list(mrp_engine.BUCKET_DAYS)}")
+    return db_plan
+
+
+def _calculate(db: Session, db_plan: models.ProductionPlan, bucket: str, progress=None) -> dict:
+    """Run MRP for a plan and commit; progress is a job's (percent, message) callback"""
+    # Demand, time-phased netting and BOM explosion, lowest level code first
+    run, mrp_results = mrp_engine.run_regenerative(db, db_plan, bucket, progress)
             
     # Update plan status
     db_plan.status = 'CALCULATED'
-    db_plan.calculated_date = get_utc_now()
+    db_plan.calculated_date = db_plan.last_run.run_at
     
     db.commit()
     db.refresh(db_plan)
@@ -211,22 +151,18 @@ def calculate_plan(
     temp_work_orders = []
     temp_purchase_reqs = []
     
-    for result in db_plan.mrp_results:
-        item = db.query(models.MasterItem).filter(models.MasterItem.id == result.item_id).first()
-        if result.suggested_action == models.SuggestedAction.MAKE:
-            temp_work_orders.append({
-                'item_code': item.item_code if item else f'Item-{result.item_id}',
-                'item_name': item.item_name if item else '',
-                'quantity': float(result.suggested_qty),
-                'required_date': result.required_date.isoformat() if result.required_date else None
-            })
-        elif result.suggested_action == models.SuggestedAction.BUY:
-            temp_purchase_reqs.append({
-                'item_code': item.item_code if item else f'Item-{result.item_id}',
-                'item_name': item.item_name if item else '',
-                'quantity': float(result.suggested_qty),
-                'required_date': result.required_date.isoformat() if result.required_date else None
-            })
+    for result in mrp_results:
+        item = run.items.get(result['item_id'])
+        suggestion = {
+            'item_code': item.item_code if item else f"Item-{result['item_id']}",
+            'item_name': item.item_name if item else '',
+            'quantity': float(result['suggested_qty']),
+            'required_date': result['required_date'].isoformat() if result['required_date'] else None
+        }
+        if result['suggested_action'] == models.SuggestedAction.MAKE:
+            temp_work_orders.append(suggestion)
+        elif result['suggested_action'] == models.SuggestedAction.BUY:
+            temp_purchase_reqs.append(suggestion)
     
     return {
         **schemas.ProductionPlanResponse.from_orm(db_plan).dict(),
@@ -235,79 +171,186 @@ def calculate_plan(
     }
 
 
-@router.post("/{plan_id}/process", response_model=schemas.ProductionPlanResponse)
-def process_plan(
+@router.post("/{plan_id}/net-change")
+def net_change_plan(
     plan_id: int,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_active_user)
 ):
     """
-    Post-Calculation: Process MRP Results to create PRs and WOs.
+    Net-change MRP: replan only the items whose inventory, orders or BOM
+    changed since the plan's last run, plus their components.
     """
     db_plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.id == plan_id).first()
     if not db_plan:
         raise HTTPException(status_code=404, detail="Plan not found")
     
     if db_plan.status != 'CALCULATED':
-        raise HTTPException(status_code=400, detail="Plan must be calculated first")
+        raise HTTPException(status_code=400, detail="Only calculated plans can be replanned")
+    
+    if db_plan.last_run is not None and db_plan.last_run.run_type == "SCENARIO":
+        raise HTTPException(status_code=400, detail="Plan holds an applied what-if scenario; apply or recalculate it instead")
+    
+    if db_plan.last_run is None:
+        # Calculated before runs were recorded: regenerate once on daily buckets
+        run, mrp_results = mrp_engine.run_regenerative(db, db_plan, "day")
+        summary = {"changed_items": None, "items_replanned": len(run.plans), "results_written": len(mrp_results)}
+        mode = "regenerative"
+    else:
+        summary = mrp_engine.run_net_change(db, db_plan)
+        mode = "net_change"
+    db_plan.calculated_date = db_plan.last_run.run_at
+    db.commit()
     
-    results = db.query(models.MRPResult).filter(
-        models.MRPResult.plan_id == plan_id,
-        models.MRPResult.suggested_action.in_([models.SuggestedAction.BUY, models.SuggestedAction.MAKE])
-    ).all()
+    return {
+        "plan_id": db_plan.id,
+        "mode": mode,
+        **summary
+    }
+
+
+# Allocations tried when concurrent processing takes the same job numbers first
+JOB_NO_ATTEMPTS = 5
+
+
+def _allocate_job_numbers(db: Session, date_code: str, count: int) -> List[str]:
+    """
+    Next `count` job numbers in the work order numbering (WO-date-sequence from
+    the work order count), skipping numbers already taken. Numbers are not
+    reserved: the unique job_no rejects a batch that raced another one.
+    """
+    next_no = db.query(func.count(models.TrnJobOrderHead.id)).scalar() + 1
+    job_nos: List[str] = []
+    while len(job_nos) < count:
+        candidates = [f"WO-{date_code}-{no:05d}" for no in range(next_no, next_no + count - len(job_nos))]
+        next_no += len(candidates)
+        taken = {
+            job_no for (job_no,) in db.query(models.TrnJobOrderHead.job_no).filter(
+                models.TrnJobOrderHead.job_no.in_(candidates)
+            ).all()
+        }
+        job_nos.extend(job_no for job_no in candidates if job_no not in taken)
+    return job_nos
+
+
+@router.post("/{plan_id}/process", response_model=schemas.ProductionPlanResponse)
+def process_plan(
+    plan_id: int,
+    run_async: bool = Query(False, alias="async"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Post-Calculation: Process MRP Results to create PRs and WOs.
+    All documents of the plan are bulk-inserted in one transaction.
+    """
+    db_plan = _plan_to_process(db, plan_id)
     
-    pr_counter = 1
-    wo_counter = 1
+    if run_async:
+        job = job_runner.submit_job(db, "planning.process", {"plan_id": plan_id}, current_user.id)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job_accepted(job))
     
-    for result in results:
-        if result.suggested_action == models.SuggestedAction.BUY:
-            # Create Draft PR
-            vendor = db.query(models.MasterBusinessPartner).filter(
-                models.MasterBusinessPartner.partner_type.in_(['VENDOR', 'BOTH']),
-                models.MasterBusinessPartner.is_active == True
-            ).first()
-            
-            if vendor:
-                total_lead_time = (vendor.lead_time_production_days or 0) + (vendor.lead_time_transit_days or 0)
-                suggested_order_date = result.required_date - timedelta(days=int(total_lead_time))
-                
-                pr_no = f"PR-{get_utc_now().strftime('%Y%m%d')}-{db_plan.id}-{pr_counter:04d}"
-                db_pr = models.DraftPurchaseRequisition(
-                    pr_no=pr_no,
-                    plan_id=db_plan.id,
-                    vendor_id=vendor.id,
-                    item_id=result.item_id,
-                    required_qty=result.suggested_qty,
-                    required_date=result.required_date,
-                    suggested_order_date=suggested_order_date,
-                    status='DRAFT'
-                )
-                db.add(db_pr)
-                pr_counter += 1
-                
-        elif result.suggested_action == models.SuggestedAction.MAKE:
-            # Create Planned Work Order
-            # Generate Job No
-            job_count = db.query(func.count(models.TrnJobOrderHead.id)).scalar()
-            job_no = f"WO-{get_utc_now().strftime('%Y%m%d')}-{job_count + wo_counter:05d}"
-            
-            # Default warehouse (Main)
-            warehouse = db.query(models.MasterWarehouse).filter(models.MasterWarehouse.warehouse_type == 'Main').first()
-            warehouse_id = warehouse.id if warehouse else 1
-            
-            wo = models.TrnJobOrderHead(
-                job_no=job_no,
-                item_id=result.item_id,
-                qty_planned=result.suggested_qty,
-                qty_produced=Decimal(0),
-                start_date=date.today(), # Should be calculated based on lead time
-                end_date=result.required_date,
-                status=models.JobStatus.PLANNED,
-                warehouse_id=warehouse_id,
-                created_by=current_user.id
-            )
-            db.add(wo)
-            wo_counter += 1
+    return _process(db, db_plan, current_user.id)
+
+
+def _plan_to_process(db: Session, plan_id: int) -> models.ProductionPlan:
+    # Locked so a concurrent processing of the same plan waits, then sees it PROCESSED
+    db_plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.id == plan_id).with_for_update().first()
+    if not db_plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    
+    if db_plan.status != 'CALCULATED':
+        raise HTTPException(status_code=400, detail="Plan must be calculated first")
+    return db_plan
+
+
+def _process(db: Session, db_plan: models.ProductionPlan, user_id: int, progress=None) -> dict:
+    """
+    Create the PRs and WOs of a calculated plan and commit. progress is a job's
+    (percent, message) callback; it may raise between the PRs and the WOs, and
+    nothing is committed before both are written.
+    """
+    results = db.query(
+        models.MRPResult.item_id,
+        models.MRPResult.required_date,
+        models.MRPResult.suggested_action,
+        models.MRPResult.suggested_qty
+    ).filter(
+        models.MRPResult.plan_id == db_plan.id,
+        models.MRPResult.suggested_action.in_([models.SuggestedAction.BUY, models.SuggestedAction.MAKE]),
+        models.MRPResult.suggested_qty > 0
+    ).order_by(models.MRPResult.id).all()
+    buys = [result for result in results if result.suggested_action == models.SuggestedAction.BUY]
+    makes = [result for result in results if result.suggested_action == models.SuggestedAction.MAKE]
+    
+    today = date.today()
+    date_code = get_utc_now().strftime('%Y%m%d')
+    created_pr_ids = []
+    created_wo_ids = []
+    
+    # Draft PRs: one vendor for the whole batch
+    vendor = db.query(models.MasterBusinessPartner).filter(
+        models.MasterBusinessPartner.partner_type.in_(['VENDOR', 'BOTH']),
+        models.MasterBusinessPartner.is_active == True
+    ).first() if buys else None
+    if vendor:
+        total_lead_time = (vendor.lead_time_production_days or 0) + (vendor.lead_time_transit_days or 0)
+        pr_rows = [{
+            'pr_no': f"PR-{date_code}-{db_plan.id}-{pr_counter:04d}",
+            'plan_id': db_plan.id,
+            'vendor_id': vendor.id,
+            'item_id': result.item_id,
+            'required_qty': result.suggested_qty,
+            'required_date': result.required_date,
+            'suggested_order_date': result.required_date - timedelta(days=int(total_lead_time)),
+            'status': 'DRAFT'
+        } for pr_counter, result in enumerate(buys, start=1)]
+        created_pr_ids = list(db.scalars(
+            insert(models.DraftPurchaseRequisition).returning(
+                models.DraftPurchaseRequisition.id, sort_by_parameter_order=True
+            ),
+            pr_rows
+        ))
+    
+    if progress is not None:
+        progress(50, f"{len(created_pr_ids)} purchase requisitions, creating work orders")
+    
+    # Planned WOs: job numbers allocated per batch, started one lead time before they are due
+    if makes:
+        warehouse = db.query(models.MasterWarehouse).filter(models.MasterWarehouse.warehouse_type == 'Main').first()
+        warehouse_id = warehouse.id if warehouse else 1
+        lead_times = mrp_engine.make_lead_days(db, {result.item_id for result in makes})
+        wo_rows = [{
+            'item_id': result.item_id,
+            'qty_planned': result.suggested_qty,
+            'qty_produced': Decimal(0),
+            'start_date': max(result.required_date - timedelta(days=lead_times.get(result.item_id, 0)), today),
+            'end_date': result.required_date,
+            'status': models.JobStatus.PLANNED,
+            'warehouse_id': warehouse_id,
+            'created_by': user_id
+        } for result in makes]
+        for attempt in range(1, JOB_NO_ATTEMPTS + 1):
+            for row, job_no in zip(wo_rows, _allocate_job_numbers(db, date_code, len(makes))):
+                row['job_no'] = job_no
+            try:
+                # Savepoint: a rejected batch leaves the PRs of this transaction in place
+                with db.begin_nested():
+                    created_wo_ids = list(db.scalars(
+                        insert(models.TrnJobOrderHead).returning(
+                            models.TrnJobOrderHead.id, sort_by_parameter_order=True
+                        ),
+                        wo_rows
+                    ))
+                break
+            except IntegrityError:
+                # Another processing committed some of these numbers since they were allocated
+                if attempt == JOB_NO_ATTEMPTS:
+                    raise HTTPException(
+                        status_code=409, detail="Work order numbers are being allocated concurrently, try again"
+                    )
+    if progress is not None:
+        progress(90, f"{len(created_wo_ids)} work orders, saving")
             
     # Update plan status
     db_plan.status = 'PROCESSED'
@@ -315,36 +358,42 @@ def process_plan(
     db.commit()
     db.refresh(db_plan)
     
-    # Prepare created WOs and PRs for response
-    created_work_orders = []
-    created_purchase_reqs = []
-    
-    # Get the PRs and WOs that were just created
+    # Prepare created WOs and PRs for response, from the ids just inserted
     prs = db.query(models.DraftPurchaseRequisition).filter(
-        models.DraftPurchaseRequisition.plan_id == plan_id
-    ).all()
+        models.DraftPurchaseRequisition.id.in_(created_pr_ids)
+    ).order_by(models.DraftPurchaseRequisition.id).all() if created_pr_ids else []
     
     wos = db.query(models.TrnJobOrderHead).filter(
-        models.TrnJobOrderHead.status == models.JobStatus.PLANNED
-    ).order_by(models.TrnJobOrderHead.id.desc()).limit(wo_counter).all()
+        models.TrnJobOrderHead.id.in_(created_wo_ids)
+    ).order_by(models.TrnJobOrderHead.id).all() if created_wo_ids else []
+    
+    item_ids = {pr.item_id for pr in prs} | {wo.item_id for wo in wos}
+    items = {
+        item.id: item for item in db.query(
+            models.MasterItem.id, models.MasterItem.item_code, models.MasterItem.item_name
+        ).filter(models.MasterItem.id.in_(item_ids)).all()
+    } if item_ids else {}
     
+    created_purchase_reqs = []
     for pr in prs:
-        item = db.query(models.MasterItem).filter(models.MasterItem.id == pr.item_id).first()
+        item = items.get(pr.item_id)
         created_purchase_reqs.append({
             'pr_no': pr.pr_no,
             'item_code': item.item_code if item else f'Item-{pr.item_id}',
             'item_name': item.item_name if item else '',
-            'quantity': float(pr.quantity),
+            'quantity': float(pr.required_qty),
             'required_date': pr.required_date.isoformat() if pr.required_date else None
         })
     
+    created_work_orders = []
     for wo in wos:
-        item = db.query(models.MasterItem).filter(models.MasterItem.id == wo.item_id).first()
+        item = items.get(wo.item_id)
         created_work_orders.append({
             'job_no': wo.job_no,
             'item_code': item.item_code if item else f'Item-{wo.item_id}',
             'item_name': item.item_name if item else '',
             'quantity': float(wo.qty_planned),
+            'start_date': wo.start_date.isoformat() if wo.start_date else None,
             'required_date': wo.end_date.isoformat() if wo.end_date else None
         })
     
@@ -490,3 +539,202 @@ def convert_pr_to_po(
     db.commit()
     
     return {"message": "PR converted to PO successfully", "po_no": po_no}
+
+
+# ==================== CALENDAR ====================
+@router.get("/calendar")
+def get_production_calendar(
+    date_from: date,
+    date_to: date,
+    group_by: str = "item",
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Production calendar for a date window: per day, the quantity of plans not
+    yet processed, work order quantity and count, and overdue open work
+    orders, grouped by item or machine. Cached per window until a plan or
+    work order changes.
+    """
+    try:
+        return production_calendar.get_calendar(db, date_from, date_to, group_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# ==================== CAPACITY ====================
+@router.get("/capacity")
+def get_capacity_plan(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    machine_id: Optional[List[int]] = Query(None),
+    hours_per_day: float = capacity_planning.CRP_HOURS_PER_DAY,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Capacity requirements of open work orders: per-machine daily load against
+    capacity, overloaded days, and start/end dates proposed by finite
+    scheduling (released work first, then earliest due date).
+    """
+    try:
+        return capacity_planning.plan_capacity(
+            db, date_from=date_from, date_to=date_to,
+            machine_ids=machine_id, hours_per_day=hours_per_day
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# ==================== WHAT-IF SCENARIOS ====================
+def _scenario_response(scenario: models.MRPScenario) -> dict:
+    detail = scenario.detail
+    return {
+        "id": scenario.id,
+        "scenario_name": scenario.scenario_name,
+        "run_date": scenario.run_date,
+        "run_by": scenario.run_by,
+        "status": scenario.status.value if scenario.status else None,
+        "plan_id": detail.plan_id if detail else None,
+        "bucket": detail.bucket if detail else None,
+        "summary": detail.summary if detail else None,
+        "applied_at": detail.applied_at if detail else None
+    }
+
+
+@router.post("/{plan_id}/scenarios/simulate")
+def simulate_plan_scenarios(
+    plan_id: int,
+    request: schemas.MRPScenarioRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    What-if MRP: plan each scenario's demand, inventory, BOM and item changes
+    in memory on top of the plan's inputs and compare the results side by
+    side. No mrp_results are written; scenarios are saved so the chosen one
+    can be applied to the plan.
+    """
+    db_plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.id == plan_id).first()
+    if not db_plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    
+    if not request.scenarios and not request.include_baseline:
+        raise HTTPException(status_code=400, detail="Nothing to simulate")
+    
+    try:
+        results = mrp_engine.simulate_scenarios(
+            db, db_plan, [spec.dict() for spec in request.scenarios],
+            bucket=request.bucket,
+            include_baseline=request.include_baseline,
+            include_orders=request.include_orders
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    scenario_results = results[1:] if request.include_baseline else results
+    saved = []
+    for spec, result in zip(request.scenarios, scenario_results):
+        summary = {key: value for key, value in result["summary"].items() if key != "orders"}
+        scenario = models.MRPScenario(
+            scenario_name=spec.scenario_name,
+            run_by=current_user.id,
+            status=models.MRPStatus.COMPLETED,
+            detail=models.MRPScenarioDetail(
+                plan_id=db_plan.id,
+                bucket=request.bucket,
+                overlay=jsonable_encoder(spec),
+                summary=summary
+            )
+        )
+        db.add(scenario)
+        saved.append(scenario)
+    db.commit()
+    
+    for scenario, result in zip(saved, scenario_results):
+        result["scenario_id"] = scenario.id
+    if request.include_baseline:
+        results[0]["scenario_id"] = None
+    
+    return {
+        "plan_id": db_plan.id,
+        "bucket": request.bucket,
+        "scenarios": results
+    }
+
+
+@router.get("/scenarios", response_model=List[schemas.MRPScenarioResponse])
+def get_scenarios(
+    plan_id: int = None,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """List saved what-if scenarios, newest first"""
+    query = db.query(models.MRPScenario).outerjoin(models.MRPScenarioDetail).options(
+        contains_eager(models.MRPScenario.detail)
+    )
+    if plan_id is not None:
+        query = query.filter(models.MRPScenarioDetail.plan_id == plan_id)
+    scenarios = query.order_by(models.MRPScenario.id.desc()).offset(skip).limit(limit).all()
+    return [_scenario_response(scenario) for scenario in scenarios]
+
+
+@router.post("/scenarios/{scenario_id}/apply", response_model=schemas.ProductionPlanResponse)
+def apply_scenario(
+    scenario_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """
+    Store a simulated scenario as its plan's MRP results (plan becomes
+    CALCULATED), so process_plan turns it into PRs and WOs.
+    """
+    scenario = db.query(models.MRPScenario).filter(models.MRPScenario.id == scenario_id).first()
+    if not scenario or scenario.detail is None:
+        raise HTTPException(status_code=404, detail="Scenario not found")
+    
+    detail = scenario.detail
+    db_plan = db.query(models.ProductionPlan).filter(models.ProductionPlan.id == detail.plan_id).first()
+    if not db_plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    
+    if db_plan.status not in ('DRAFT', 'CALCULATED'):
+        raise HTTPException(status_code=400, detail="Plan already processed")
+    
+    spec = schemas.MRPScenarioSpec(**detail.overlay)
+    try:
+        mrp_engine.run_scenario(db, db_plan, spec.dict(), detail.bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    db_plan.status = 'CALCULATED'
+    db_plan.calculated_date = db_plan.last_run.run_at
+    detail.applied_at = db_plan.last_run.run_at
+    db.commit()
+    db.refresh(db_plan)
+    return db_plan
+
+
+# ==================== BACKGROUND JOBS ====================
+# Handlers report progress between MRP levels and between PR and WO creation;
+# a cancel request stops them there and nothing of the run is committed
+@job_runner.register_job("planning.calculate")
+def calculate_plan_job(db: Session, params: dict, context: job_runner.JobContext):
+    context.progress(5, "Running MRP")
+    bucket = params.get("bucket", "day")
+    return _calculate(db, _plan_to_calculate(db, params["plan_id"], bucket), bucket, context.progress)
+
+
+@job_runner.register_job("planning.process")
+def process_plan_job(db: Session, params: dict, context: job_runner.JobContext):
+    context.progress(5, "Creating purchase requisitions")
+    return _process(db, _plan_to_process(db, params["plan_id"]), context.created_by, context.progress)
+
+
+@job_runner.register_periodic(mrp_engine.MRP_CHANGE_PRUNE_SECONDS)
+def prune_mrp_changes(db: Session):
+    """Drop net-change records no calculated plan needs, also when no MRP runs"""
+    if mrp_engine.prune_changes(db):
+        db.commit()
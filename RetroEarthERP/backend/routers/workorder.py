@@ -14,6 +14,7 @@ from database import get_db
 import models
 import schemas
 import auth as auth_utils
+from services import bom_engine, fifo_engine, inventory_balance
 
 router = APIRouter()
 
@@ -172,10 +173,9 @@ def generate_work_order_from_bom(
     
     # Generate material lines from BOM explosion
     if request.auto_generate_material_lines:
-        # Import BOM explosion function
-        from routers import bom as bom_router
-        
-        explosion_request = schemas.BOMExplosionRequest(
+        # Consolidated raw materials (items without their own BOM)
+        requirements = bom_engine.get_leaf_requirements(
+            db,
             parent_item_id=request.item_id,
             quantity=request.qty_planned,
             revision=request.bom_revision,
@@ -184,19 +184,14 @@ def generate_work_order_from_bom(
             max_levels=10
         )
         
-        explosion_result = bom_router.explode_bom(explosion_request, db, current_user)
-        
-        # Use consolidated view to avoid duplicate materials
-        for material in explosion_result.get("consolidated", []):
-            # Only add if it's a raw material (doesn't have its own BOM)
-            if material.get("is_raw_material", False):
-                detail = models.TrnJobOrderDetail(
-                    job_id=work_order.id,
-                    item_id=material["item_id"],
-                    qty_required=Decimal(str(material["total_quantity"])),
-                    qty_consumed=Decimal("0")
-                )
-                db.add(detail)
+        for item_id, qty_required in requirements:
+            detail = models.TrnJobOrderDetail(
+                job_id=work_order.id,
+                item_id=item_id,
+                qty_required=qty_required,
+                qty_consumed=Decimal("0")
+            )
+            db.add(detail)
     
     db.commit()
     db.refresh(work_order)
@@ -485,6 +480,10 @@ def complete_work_order(
     
     # Post to inventory (create inventory transaction)
     if request.post_to_inventory:
+        unit_cost = db.query(models.MasterItem.standard_cost).filter(
+            models.MasterItem.id == wo.item_id
+        ).scalar() or Decimal(0)
+
         # Create FG Receipt
         fg_txn = models.InventoryTransaction(
             transaction_date=get_utc_now(),
@@ -495,46 +494,21 @@ def complete_work_order(
             transaction_type="receipt",
             reference_no=wo.job_no,
             qty=wo.qty_produced,
+            unit_cost=unit_cost,
             created_by=current_user.id
         )
         db.add(fg_txn)
         
-        # Update Balance
-        balance = db.query(models.InventoryBalance).filter(
-            models.InventoryBalance.item_id == wo.item_id,
-            models.InventoryBalance.warehouse_id == wo.warehouse_id,
-            models.InventoryBalance.lot_number == wo.lot_number
-        ).first()
-        
-        if not balance:
-            balance = models.InventoryBalance(
-                item_id=wo.item_id,
-                warehouse_id=wo.warehouse_id,
-                lot_number=wo.lot_number,
-                qty_on_hand=0,
-                avg_cost=0
-            )
-            db.add(balance)
-            
         # Update balance and cost layer (standard cost)
-        item = db.query(models.MasterItem).filter(models.MasterItem.id == wo.item_id).first()
-        unit_cost = item.standard_cost or Decimal(0)
-        
-        balance.qty_on_hand += wo.qty_produced
-        # Simplified avg cost update
-        balance.avg_cost = unit_cost 
-        
-        # Create Cost Layer
-        cost_layer = models.InventoryCostLayer(
-            item_id=wo.item_id,
-            warehouse_id=wo.warehouse_id,
-            receipt_date=date.today(),
-            qty_remaining=wo.qty_produced,
-            unit_cost=unit_cost,
-            receipt_transaction_id=None, # Linked via reference? Or need flush
-            lot_number=wo.lot_number
+        inventory_balance.post_balance_changes(db, [(
+            inventory_balance.balance_key(wo.item_id, wo.warehouse_id, None, wo.lot_number),
+            wo.qty_produced,
+            unit_cost
+        )])
+        fifo_engine.add_layer(
+            db, wo.item_id, wo.warehouse_id, None, wo.qty_produced, unit_cost, date.today(),
+            lot_number=wo.lot_number or None
         )
-        db.add(cost_layer)
     
     db.commit()
     
@@ -8,7 +8,7 @@ DATETIME CONVENTION:
 - Document numbers use client's local date for generation
 """
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List
+from typing import Optional, List, Any
 from datetime import datetime, date, timezone
 from decimal import Decimal
 
@@ -402,6 +402,52 @@ class ProductionPlanResponse(BaseModel):
         from_attributes = True
 
 
+class ScenarioDemandChange(BaseModel):
+    item_id: int
+    required_date: date
+    qty_change: Decimal  # added to the plan's demand on that date; negative reduces it
+
+class ScenarioInventoryChange(BaseModel):
+    item_id: int
+    qty_change: Decimal
+    receipt_date: Optional[date] = None  # set = extra scheduled receipt, else on-hand adjustment
+
+class ScenarioBOMChange(BaseModel):
+    parent_item_id: int
+    child_item_id: int
+    qty_per: Optional[Decimal] = None  # None = remove the line
+
+class ScenarioItemChange(BaseModel):
+    item_id: int
+    lead_time_days: Optional[int] = None
+    safety_stock: Optional[Decimal] = None
+    standard_cost: Optional[Decimal] = None
+
+class MRPScenarioSpec(BaseModel):
+    scenario_name: str = Field(..., max_length=100)
+    demand: List[ScenarioDemandChange] = []
+    inventory: List[ScenarioInventoryChange] = []
+    bom: List[ScenarioBOMChange] = []
+    items: List[ScenarioItemChange] = []
+
+class MRPScenarioRequest(BaseModel):
+    bucket: str = "day"
+    scenarios: List[MRPScenarioSpec] = []
+    include_baseline: bool = True
+    include_orders: bool = False
+
+class MRPScenarioResponse(BaseModel):
+    id: int
+    scenario_name: str
+    run_date: Optional[datetime] = None
+    run_by: int
+    status: str
+    plan_id: Optional[int] = None
+    bucket: Optional[str] = None
+    summary: Optional[Any] = None
+    applied_at: Optional[datetime] = None
+
+
 # Purchase Requisition Schemas
 class DraftPRCreate(BaseModel):
     vendor_id: int
@@ -535,6 +581,34 @@ class BOMExportRequest(BaseModel):
     include_inactive: bool = False
 
 
+class CostRollupRequest(BaseModel):
+    """Standard cost roll-up request"""
+    component_item_ids: Optional[List[int]] = None  # Changed components; None = whole catalogue
+    commit: bool = False  # False = preview only
+
+
+# Background Job Schemas
+class JobResponse(BaseModel):
+    """Status, progress and result of a background job"""
+    id: int
+    job_type: str
+    status: str
+    progress: int = 0
+    progress_message: Optional[str] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    output_file: Optional[str] = None
+    cancel_requested: bool = False
+    attempts: int = 0
+    created_by: int
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
+
 # BOM Explosion Schemas
 class BOMExplosionRequest(BaseModel):
     """Request for BOM explosion"""
@@ -546,6 +620,22 @@ class BOMExplosionRequest(BaseModel):
     max_levels: int = 10  # Maximum depth to prevent infinite loops
 
 
+class BOMBatchExplosionItem(BaseModel):
+    """One parent in a batch explosion"""
+    parent_item_id: int
+    quantity: Decimal = Decimal("1.0")
+    revision: Optional[int] = None  # Specific revision, or None for active
+
+
+class BOMBatchExplosionRequest(BaseModel):
+    """Request for exploding several parents together"""
+    items: List[BOMBatchExplosionItem]
+    include_optional: bool = False
+    include_byproducts: bool = False
+    max_levels: int = 10
+    include_lines: bool = True  # False = summaries and raw materials only
+
+
 class BOMExplosionLine(BaseModel):
     """Single line in BOM explosion result"""
     level: int  # 0 = top level, 1 = first sub-level, etc.
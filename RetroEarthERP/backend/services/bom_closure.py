@@ -0,0 +1,360 @@
+"""
+BOM Closure Table Maintenance
+Keeps bom_closure (the flattened BOM over ACTIVE revisions) in sync with master_bom:
+full rebuild, incremental refresh after BOM edits, consistency check and
+where-used lookups as a single indexed SELECT.
+
+Usage:
+    python -m services.bom_closure rebuild
+    python -m services.bom_closure check
+"""
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import insert, exists, and_
+from decimal import Decimal
+from typing import Dict, Iterable, List
+import sys
+import models
+from services.bom_engine import unit_quantity
+
+
+# Paths longer than this are not stored (bounds circular BOMs)
+BOM_CLOSURE_MAX_DEPTH = 20
+
+# Stored precision of bom_closure.qty_per
+QTY_PER_PLACES = Decimal("0.00000001")
+
+# Relative tolerance when checking stored qty_per; incremental refreshes
+# compose already-rounded child rows, so deep paths drift in the last digits
+QTY_PER_TOLERANCE = Decimal("0.0000001")
+
+
+def _load_edges(db: Session, parent_item_ids: Iterable[int] = None) -> Dict[int, List[tuple]]:
+    """ACTIVE BOM edges: parent_item_id -> [(revision, child_item_id, qty_per_parent)]"""
+    query = db.query(
+        models.MasterBOM.parent_item_id,
+        models.MasterBOM.child_item_id,
+        models.MasterBOM.revision,
+        models.MasterBOM.bom_type,
+        models.MasterBOM.quantity,
+        models.MasterBOM.percentage,
+        models.MasterBOM.scrap_factor
+    ).filter(
+        models.MasterBOM.is_active == True,
+        models.MasterBOM.status == models.BOMStatus.ACTIVE
+    )
+    if parent_item_ids is not None:
+        query = query.filter(models.MasterBOM.parent_item_id.in_(parent_item_ids))
+
+    edges: Dict[int, List[tuple]] = {}
+    for row in query.all():
+        edges.setdefault(row.parent_item_id, []).append((
+            row.revision,
+            row.child_item_id,
+            unit_quantity(row.bom_type, row.quantity, row.percentage, row.scrap_factor)
+        ))
+    return edges
+
+
+def _load_stored(db: Session, ancestor_item_ids: Iterable[int]) -> Dict[int, Dict[tuple, Decimal]]:
+    """Stored closure of items, summed over revisions: ancestor -> {(descendant, depth): qty_per}"""
+    stored: Dict[int, Dict[tuple, Decimal]] = {}
+    ancestor_item_ids = set(ancestor_item_ids)
+    if not ancestor_item_ids:
+        return stored
+
+    for row in db.query(
+        models.BOMClosure.ancestor_item_id,
+        models.BOMClosure.descendant_item_id,
+        models.BOMClosure.depth,
+        models.BOMClosure.qty_per
+    ).filter(models.BOMClosure.ancestor_item_id.in_(ancestor_item_ids)).all():
+        paths = stored.setdefault(row.ancestor_item_id, {})
+        key = (row.descendant_item_id, row.depth)
+        paths[key] = paths.get(key, Decimal("0")) + Decimal(str(row.qty_per))
+    return stored
+
+
+def _compute_closures(
+    targets: set,
+    edges: Dict[int, List[tuple]],
+    stored: Dict[int, Dict[tuple, Decimal]]
+) -> Dict[int, Dict[tuple, Decimal]]:
+    """
+    Closure rows for each target item: item -> {(revision, descendant, depth): qty_per}.
+
+    Targets are finished children-first (iterative post-order) so a parent reuses
+    its children's closures. Children outside targets are read from stored.
+    A child that is still on the walk (circular BOM) contributes only its direct edge.
+    """
+    computed: Dict[int, Dict[tuple, Decimal]] = {}
+    collapsed: Dict[int, Dict[tuple, Decimal]] = {}
+    on_walk = set()
+
+    def children(item_id):
+        return list({child for _, child, _ in edges.get(item_id, [])})
+
+    def finish(item_id):
+        rows: Dict[tuple, Decimal] = {}
+        for revision, child, qty in edges.get(item_id, []):
+            if child == item_id:
+                continue
+            key = (revision, child, 1)
+            rows[key] = rows.get(key, Decimal("0")) + qty
+            sub_closure = collapsed.get(child)
+            if sub_closure is None:
+                sub_closure = stored.get(child, {}) if child not in on_walk else {}
+            for (descendant, depth), sub_qty in sub_closure.items():
+                if depth + 1 > BOM_CLOSURE_MAX_DEPTH or descendant == item_id:
+                    continue
+                key = (revision, descendant, depth + 1)
+                rows[key] = rows.get(key, Decimal("0")) + qty * sub_qty
+        computed[item_id] = rows
+
+        summed: Dict[tuple, Decimal] = {}
+        for (_, descendant, depth), qty in rows.items():
+            summed[(descendant, depth)] = summed.get((descendant, depth), Decimal("0")) + qty
+        collapsed[item_id] = summed
+
+    for root in targets:
+        if root in computed:
+            continue
+        on_walk.add(root)
+        stack = [(root, iter(children(root)))]
+        while stack:
+            item_id, pending = stack[-1]
+            child = next(pending, None)
+            if child is None:
+                stack.pop()
+                on_walk.discard(item_id)
+                finish(item_id)
+                continue
+            if child in targets and child not in computed and child not in on_walk:
+                on_walk.add(child)
+                stack.append((child, iter(children(child))))
+
+    return computed
+
+
+def _closure_mappings(computed: Dict[int, Dict[tuple, Decimal]]) -> List[dict]:
+    """Insert mappings for computed closure rows"""
+    return [
+        {
+            "ancestor_item_id": ancestor,
+            "ancestor_revision": revision,
+            "descendant_item_id": descendant,
+            "depth": depth,
+            "qty_per": qty.quantize(QTY_PER_PLACES)
+        }
+        for ancestor, rows in computed.items()
+        for (revision, descendant, depth), qty in rows.items()
+    ]
+
+
+def rebuild_bom_closure(db: Session) -> int:
+    """
+    Rebuild bom_closure from master_bom and commit.
+
+    Args:
+        db: Database session
+
+    Returns:
+        int: Number of closure rows written
+    """
+    edges = _load_edges(db)
+    computed = _compute_closures(set(edges), edges, {})
+    mappings = _closure_mappings(computed)
+
+    db.query(models.BOMClosure).delete(synchronize_session=False)
+    if mappings:
+        db.execute(insert(models.BOMClosure), mappings)
+    db.commit()
+    return len(mappings)
+
+
+def refresh_bom_closure(db: Session, parent_item_ids: Iterable[int]) -> int:
+    """
+    Incrementally refresh bom_closure after the BOM lines of some parents changed.
+    Call before committing the BOM change; does not commit.
+
+    Only the changed parents and their ancestors are recomputed; closures of
+    untouched sub-assemblies are reused from the table.
+
+    Args:
+        db: Database session
+        parent_item_ids: Parents whose BOM lines were created, changed or removed
+
+    Returns:
+        int: Number of closure rows written
+    """
+    changed = set(parent_item_ids)
+    if not changed:
+        return 0
+
+    # Pending BOM changes must be visible to the queries below
+    db.flush()
+
+    ancestors = {
+        ancestor for (ancestor,) in db.query(models.BOMClosure.ancestor_item_id).filter(
+            models.BOMClosure.descendant_item_id.in_(changed)
+        ).distinct().all()
+    }
+    affected = changed | ancestors
+
+    edges = _load_edges(db, affected)
+    outside_children = {child for lines in edges.values() for _, child, _ in lines} - affected
+    stored = _load_stored(db, outside_children)
+    computed = _compute_closures(affected, edges, stored)
+    mappings = _closure_mappings(computed)
+
+    db.query(models.BOMClosure).filter(
+        models.BOMClosure.ancestor_item_id.in_(affected)
+    ).delete(synchronize_session=False)
+    if mappings:
+        db.execute(insert(models.BOMClosure), mappings)
+    return len(mappings)
+
+
+def ensure_bom_closure(db: Session) -> int:
+    """Build bom_closure if it is empty but active BOM lines exist (first start, seeded data)"""
+    has_closure = db.query(models.BOMClosure.id).first()
+    has_bom = db.query(models.MasterBOM.id).filter(models.MasterBOM.is_active == True).first()
+    if has_closure or not has_bom:
+        return 0
+    return rebuild_bom_closure(db)
+
+
+def check_bom_closure(db: Session, sample_size: int = 20) -> dict:
+    """
+    Compare bom_closure with a fresh computation from master_bom.
+
+    Args:
+        db: Database session
+        sample_size: Maximum number of differing rows to return
+
+    Returns:
+        dict: Row counts, missing/extra/mismatched rows and samples
+    """
+    edges = _load_edges(db)
+    expected = {
+        (m["ancestor_item_id"], m["ancestor_revision"], m["descendant_item_id"], m["depth"]): m["qty_per"]
+        for m in _closure_mappings(_compute_closures(set(edges), edges, {}))
+    }
+    actual = {
+        (row.ancestor_item_id, row.ancestor_revision, row.descendant_item_id, row.depth): Decimal(str(row.qty_per))
+        for row in db.query(
+            models.BOMClosure.ancestor_item_id,
+            models.BOMClosure.ancestor_revision,
+            models.BOMClosure.descendant_item_id,
+            models.BOMClosure.depth,
+            models.BOMClosure.qty_per
+        ).all()
+    }
+
+    missing = [key for key in expected if key not in actual]
+    extra = [key for key in actual if key not in expected]
+    mismatched = [
+        key for key in expected
+        if key in actual and abs(expected[key] - actual[key]) > max(abs(expected[key]), 1) * QTY_PER_TOLERANCE
+    ]
+
+    def sample(keys, reason):
+        return [
+            {
+                "ancestor_item_id": key[0],
+                "ancestor_revision": key[1],
+                "descendant_item_id": key[2],
+                "depth": key[3],
+                "expected_qty_per": float(expected[key]) if key in expected else None,
+                "stored_qty_per": float(actual[key]) if key in actual else None,
+                "reason": reason
+            }
+            for key in keys[:sample_size]
+        ]
+
+    return {
+        "consistent": not (missing or extra or mismatched),
+        "expected_rows": len(expected),
+        "stored_rows": len(actual),
+        "missing_rows": len(missing),
+        "extra_rows": len(extra),
+        "qty_mismatches": len(mismatched),
+        "samples": (sample(missing, "MISSING") + sample(extra, "EXTRA") + sample(mismatched, "QTY_MISMATCH"))[:sample_size]
+    }
+
+
+def where_used(db: Session, child_item_id: int, max_levels: int = 10) -> List[dict]:
+    """
+    Every direct and indirect parent that uses a component, read from bom_closure.
+
+    effective_quantity is the component quantity (scrap included) needed per
+    one unit of the parent, summed over all paths of that length.
+
+    Args:
+        db: Database session
+        child_item_id: Component to look up
+        max_levels: Maximum number of levels to walk up
+
+    Returns:
+        List[dict]: One row per (parent, level, revision)
+    """
+    used_by = aliased(models.BOMClosure)
+    is_end_item = ~exists().where(and_(
+        used_by.descendant_item_id == models.BOMClosure.ancestor_item_id,
+        used_by.depth == 1
+    ))
+
+    rows = db.query(
+        models.BOMClosure.ancestor_item_id,
+        models.BOMClosure.ancestor_revision,
+        models.BOMClosure.depth,
+        models.BOMClosure.qty_per,
+        models.MasterItem.item_code,
+        models.MasterItem.item_name,
+        models.MasterItem.item_type,
+        is_end_item.label("is_end_item")
+    ).join(
+        models.MasterItem, models.MasterItem.id == models.BOMClosure.ancestor_item_id
+    ).filter(
+        models.BOMClosure.descendant_item_id == child_item_id,
+        models.BOMClosure.depth <= max_levels
+    ).order_by(
+        models.BOMClosure.depth,
+        models.MasterItem.item_code,
+        models.BOMClosure.ancestor_revision
+    ).all()
+
+    return [
+        {
+            "parent_item_id": row.ancestor_item_id,
+            "parent_item_code": row.item_code,
+            "parent_item_name": row.item_name,
+            "item_type": row.item_type.value if hasattr(row.item_type, 'value') else str(row.item_type),
+            "level": row.depth,
+            "revision": row.ancestor_revision,
+            "effective_quantity": float(row.qty_per),
+            "is_end_item": bool(row.is_end_item)
+        }
+        for row in rows
+    ]
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, engine, Base
+
+    Base.metadata.create_all(bind=engine)
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    session = SessionLocal()
+    try:
+        if command == "rebuild":
+            print(f"bom_closure rebuilt: {rebuild_bom_closure(session)} rows")
+        elif command == "check":
+            report = check_bom_closure(session)
+            print(f"consistent={report['consistent']} expected={report['expected_rows']} "
+                  f"stored={report['stored_rows']} missing={report['missing_rows']} "
+                  f"extra={report['extra_rows']} qty_mismatches={report['qty_mismatches']}")
+            sys.exit(0 if report["consistent"] else 1)
+        else:
+            print("Usage: python -m services.bom_closure [rebuild|check]")
+            sys.exit(2)
+    finally:
+        session.close()
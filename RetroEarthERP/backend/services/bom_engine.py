@@ -0,0 +1,684 @@
+"""
+BOM Explosion Engine
+Loads master_bom, master_items and location_master with set-based queries
+into a compact adjacency structure, then walks it iteratively.
+
+Per-unit explosions are cached in process against a BOM version stamp.
+Session listeners bump the stamp after any committed write to BOM lines,
+items or locations (the explosion carries item codes, names, units and
+costs, and location codes), so writes made through this process show at
+once. The stamp is not shared between processes (several API workers, the
+standalone job worker), so entries also expire after
+EXPLOSION_CACHE_SECONDS: writes made elsewhere show within that time.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import event
+from collections import OrderedDict
+from decimal import Decimal
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+import threading
+import time
+import models
+
+
+# Maximum number of per-unit explosions kept in memory
+EXPLOSION_CACHE_SIZE = 512
+# Seconds a cached explosion is served; bounds staleness from writes of other processes
+EXPLOSION_CACHE_SECONDS = int(os.getenv("BOM_EXPLOSION_CACHE_SECONDS", "60"))
+# Rows an explosion is built from
+EXPLOSION_MODELS = (models.MasterBOM, models.MasterItem, models.LocationMaster)
+
+# Quantity fields that scale linearly with the requested quantity
+SCALED_FIELDS = ("required_quantity", "scrap_quantity", "total_quantity")
+
+
+class BOMGraph:
+    """
+    In-memory adjacency structure over master_bom.
+
+    lines_by_parent maps parent_item_id -> BOM line rows (every revision and
+    status, soft-deleted lines excluded) ordered by sequence_order.
+    items and locations hold only the columns the explosion output needs.
+    """
+
+    def __init__(self):
+        self.lines_by_parent: Dict[int, list] = {}
+        self.items: Dict[int, object] = {}
+        self.locations: Dict[int, str] = {}
+
+    def has_bom(self, item_id: int) -> bool:
+        """True if the item has at least one active (not soft-deleted) BOM line"""
+        return bool(self.lines_by_parent.get(item_id))
+
+    def active_revision(self, parent_item_id: int) -> Optional[int]:
+        """Revision of the first ACTIVE BOM line of a parent, None if there is none"""
+        active = [
+            line for line in self.lines_by_parent.get(parent_item_id, [])
+            if line.status == models.BOMStatus.ACTIVE
+        ]
+        if not active:
+            return None
+        return min(active, key=lambda line: line.id).revision
+
+    def component_lines(
+        self,
+        parent_item_id: int,
+        revision: Optional[int],
+        include_optional: bool,
+        include_byproducts: bool
+    ) -> list:
+        """
+        BOM lines used to explode a parent.
+        A specific revision is used as-is, otherwise only ACTIVE lines are used.
+        """
+        lines = []
+        for line in self.lines_by_parent.get(parent_item_id, []):
+            if revision:
+                if line.revision != revision:
+                    continue
+            elif line.status != models.BOMStatus.ACTIVE:
+                continue
+            if not include_optional and line.is_optional:
+                continue
+            if not include_byproducts and line.is_byproduct:
+                continue
+            lines.append(line)
+        return lines
+
+
+def load_bom_graph(db: Session, root_item_ids: Iterable[int], max_levels: int) -> BOMGraph:
+    """
+    Load the BOM sub-graph reachable from root items.
+
+    Issues one master_bom query per BOM level (for the whole level at once),
+    then one master_items and one location_master query.
+    Parents are loaded one level beyond max_levels so has_bom() is accurate
+    for the deepest exploded components.
+
+    Args:
+        db: Database session
+        root_item_ids: Items to explode
+        max_levels: Maximum explosion depth
+
+    Returns:
+        BOMGraph: Loaded adjacency structure
+    """
+    graph = BOMGraph()
+    item_ids = set(root_item_ids)
+    location_ids = set()
+    frontier = set(item_ids)
+
+    for _ in range(max(max_levels, 0) + 1):
+        if not frontier:
+            break
+
+        rows = db.query(
+            models.MasterBOM.id,
+            models.MasterBOM.parent_item_id,
+            models.MasterBOM.child_item_id,
+            models.MasterBOM.bom_type,
+            models.MasterBOM.sequence_order,
+            models.MasterBOM.quantity,
+            models.MasterBOM.percentage,
+            models.MasterBOM.is_optional,
+            models.MasterBOM.scrap_factor,
+            models.MasterBOM.production_location_id,
+            models.MasterBOM.storage_location_id,
+            models.MasterBOM.is_byproduct,
+            models.MasterBOM.remark,
+            models.MasterBOM.revision,
+            models.MasterBOM.status
+        ).filter(
+            models.MasterBOM.parent_item_id.in_(frontier),
+            models.MasterBOM.is_active == True
+        ).all()
+
+        for parent_id in frontier:
+            graph.lines_by_parent.setdefault(parent_id, [])
+
+        next_frontier = set()
+        for row in rows:
+            graph.lines_by_parent[row.parent_item_id].append(row)
+            item_ids.add(row.child_item_id)
+            if row.production_location_id:
+                location_ids.add(row.production_location_id)
+            if row.storage_location_id:
+                location_ids.add(row.storage_location_id)
+            if row.child_item_id not in graph.lines_by_parent:
+                next_frontier.add(row.child_item_id)
+
+        frontier = next_frontier
+
+    for lines in graph.lines_by_parent.values():
+        lines.sort(key=lambda line: (line.sequence_order or 0, line.id))
+
+    if item_ids:
+        for row in db.query(
+            models.MasterItem.id,
+            models.MasterItem.item_code,
+            models.MasterItem.item_name,
+            models.MasterItem.item_type,
+            models.MasterItem.unit_of_measure
+        ).filter(models.MasterItem.id.in_(item_ids)).all():
+            graph.items[row.id] = row
+
+    if location_ids:
+        for loc_id, loc_code in db.query(
+            models.LocationMaster.id,
+            models.LocationMaster.location_code
+        ).filter(models.LocationMaster.id.in_(location_ids)).all():
+            graph.locations[loc_id] = loc_code
+
+    return graph
+
+
+def _line_row(graph: BOMGraph, bom, child_item, parent_item, parent_qty: Decimal, level: int) -> dict:
+    """Explosion line for one BOM line; scaled quantity fields are Decimal"""
+    # Calculate quantities based on BOM type
+    if bom.bom_type == 'FORMULA' and bom.percentage:
+        # Formula: percentage-based calculation
+        bom_qty = Decimal(str(bom.percentage)) / Decimal("100")
+    else:
+        # Assembly, Modular, Tailor-Made: fixed quantity
+        bom_qty = Decimal(str(bom.quantity))
+    required_qty = parent_qty * bom_qty
+
+    # Calculate scrap
+    scrap_factor = Decimal(str(bom.scrap_factor)) if bom.scrap_factor else Decimal("0")
+    scrap_qty = required_qty * (scrap_factor / Decimal("100"))
+    total_qty = required_qty + scrap_qty
+
+    return {
+        "level": level,
+        "item_id": child_item.id,
+        "item_code": child_item.item_code,
+        "item_name": child_item.item_name,
+        "item_type": child_item.item_type.value if hasattr(child_item.item_type, 'value') else str(child_item.item_type),
+        "unit_of_measure": child_item.unit_of_measure,
+        "bom_quantity": float(bom_qty),
+        "required_quantity": required_qty,
+        "scrap_factor": float(scrap_factor),
+        "scrap_quantity": scrap_qty,
+        "total_quantity": total_qty,
+        "bom_type": bom.bom_type,
+        "is_optional": bom.is_optional,
+        "is_byproduct": bom.is_byproduct,
+        "sequence_order": bom.sequence_order,
+        "percentage": float(bom.percentage) if bom.percentage else None,
+        "production_location": graph.locations.get(bom.production_location_id),
+        "storage_location": graph.locations.get(bom.storage_location_id),
+        "parent_item_id": parent_item.id,
+        "parent_item_code": parent_item.item_code,
+        "bom_id": bom.id,
+        "revision": bom.revision,
+        "remark": bom.remark
+    }
+
+
+def _walk_graph(
+    graph: BOMGraph,
+    parent_item_id: int,
+    quantity: Decimal,
+    revision: Optional[int],
+    include_optional: bool,
+    include_byproducts: bool,
+    max_levels: int
+) -> List[dict]:
+    """
+    Walk a loaded BOMGraph depth-first without recursion.
+
+    Lines are emitted in the same pre-order as a recursive explosion:
+    each component is followed directly by its own sub-components.
+    Circular references are skipped per branch (an item is never exploded
+    inside its own sub-tree). Scaled quantity fields are kept as Decimal.
+    """
+    results = []
+    if max_levels < 1 or parent_item_id not in graph.items:
+        return results
+
+    # Each frame: (iterator over BOM lines, parent item, quantity, level, items on the path)
+    root_lines = graph.component_lines(parent_item_id, revision, include_optional, include_byproducts)
+    stack = [(iter(root_lines), graph.items[parent_item_id], quantity, 1, frozenset([parent_item_id]))]
+
+    while stack:
+        lines, parent_item, parent_qty, level, path = stack[-1]
+        bom = next(lines, None)
+        if bom is None:
+            stack.pop()
+            continue
+
+        child_item = graph.items.get(bom.child_item_id)
+        if not child_item:
+            continue
+
+        row = _line_row(graph, bom, child_item, parent_item, parent_qty, level)
+        total_qty = row["total_quantity"]
+        results.append(row)
+
+        # Explode sub-assemblies with their active revision, using total qty (including scrap)
+        if graph.has_bom(child_item.id) and child_item.id not in path and level < max_levels:
+            child_lines = graph.component_lines(child_item.id, None, include_optional, include_byproducts)
+            stack.append((iter(child_lines), child_item, total_qty, level + 1, path | {child_item.id}))
+
+    return results
+
+
+def scale_lines(unit_lines: List[dict], quantity: Decimal) -> List[dict]:
+    """Scale per-unit explosion lines to a quantity, returning new dicts with float quantities"""
+    scaled = []
+    for line in unit_lines:
+        out = dict(line)
+        for field in SCALED_FIELDS:
+            out[field] = float(quantity * line[field])
+        scaled.append(out)
+    return scaled
+
+
+def explode_graph(
+    graph: BOMGraph,
+    parent_item_id: int,
+    quantity: Decimal,
+    revision: Optional[int],
+    include_optional: bool,
+    include_byproducts: bool,
+    max_levels: int
+) -> List[dict]:
+    """
+    Explode a loaded BOMGraph for a quantity.
+
+    Args:
+        graph: Loaded BOM graph
+        parent_item_id: Item to explode
+        quantity: Quantity to produce
+        revision: Revision for the top level (None = active revision)
+        include_optional: Whether to include optional components
+        include_byproducts: Whether to include by-products
+        max_levels: Maximum explosion depth
+
+    Returns:
+        List[dict]: Explosion lines
+    """
+    unit_lines = _walk_graph(
+        graph, parent_item_id, Decimal("1"), revision,
+        include_optional, include_byproducts, max_levels
+    )
+    return scale_lines(unit_lines, quantity)
+
+
+# ==================== EXPLOSION CACHE ====================
+class Explosion:
+    """
+    Per-unit explosion of one parent item.
+
+    revision is the top-level revision actually used (requested, active or 1).
+    raw_item_ids holds the exploded items that have no BOM of their own.
+    """
+
+    def __init__(self, parent_item_id: int, has_bom: bool, revision: int,
+                 unit_lines: List[dict], raw_item_ids: set):
+        self.parent_item_id = parent_item_id
+        self.has_bom = has_bom
+        self.revision = revision
+        self.unit_lines = unit_lines
+        self.raw_item_ids = raw_item_ids
+        self._unit_leaves: Optional[List[Tuple[int, Decimal]]] = None
+
+    def lines(self, quantity: Decimal) -> List[dict]:
+        """Explosion lines scaled to a quantity"""
+        return scale_lines(self.unit_lines, quantity)
+
+    def leaf_requirements(self, quantity: Decimal) -> List[Tuple[int, Decimal]]:
+        """
+        Consolidated raw-material needs scaled to a quantity:
+        [(item_id, total quantity incl. scrap)] ordered by item code.
+        """
+        if self._unit_leaves is None:
+            totals: Dict[int, Decimal] = {}
+            codes: Dict[int, str] = {}
+            for line in self.unit_lines:
+                if line["item_id"] in self.raw_item_ids:
+                    totals[line["item_id"]] = totals.get(line["item_id"], Decimal("0")) + line["total_quantity"]
+                    codes[line["item_id"]] = line["item_code"]
+            self._unit_leaves = sorted(totals.items(), key=lambda entry: codes[entry[0]])
+        return [(item_id, quantity * unit_qty) for item_id, unit_qty in self._unit_leaves]
+
+
+_cache_lock = threading.Lock()
+_bom_version = 0
+_explosion_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_cache_hits = 0
+_cache_misses = 0
+
+
+def get_bom_version() -> int:
+    """Current BOM version stamp (in-process)"""
+    return _bom_version
+
+
+def bump_bom_version() -> int:
+    """
+    Invalidate cached explosions after a master_bom write.
+    Call after the write is committed.
+    """
+    global _bom_version
+    with _cache_lock:
+        _bom_version += 1
+        _explosion_cache.clear()
+        return _bom_version
+
+
+@event.listens_for(Session, "before_flush")
+def _track_explosion_flush(session, flush_context, instances):
+    if any(isinstance(obj, EXPLOSION_MODELS) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info["explosion_changed"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_explosion_statements(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and issubclass(mapper.class_, EXPLOSION_MODELS):
+        orm_execute_state.session.info["explosion_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_explosions(session):
+    if session.info.pop("explosion_changed", False):
+        bump_bom_version()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_explosion_changes(session):
+    session.info.pop("explosion_changed", None)
+
+
+def get_explosion_cache_stats() -> dict:
+    """Hit/miss counters and size of the explosion cache"""
+    with _cache_lock:
+        lookups = _cache_hits + _cache_misses
+        return {
+            "bom_version": _bom_version,
+            "entries": len(_explosion_cache),
+            "max_entries": EXPLOSION_CACHE_SIZE,
+            "hits": _cache_hits,
+            "misses": _cache_misses,
+            "hit_rate": round(_cache_hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def _cached_explosion(key: tuple) -> Optional[Explosion]:
+    """Unexpired cache entry for key (caller holds _cache_lock)"""
+    cached = _explosion_cache.get(key)
+    if cached is None:
+        return None
+    expires_at, explosion = cached
+    if time.monotonic() >= expires_at:
+        del _explosion_cache[key]
+        return None
+    _explosion_cache.move_to_end(key)
+    return explosion
+
+
+def _cache_explosion(key: tuple, explosion: Explosion, expires_at: float):
+    """Store an entry, dropping the least recently used (caller holds _cache_lock)"""
+    _explosion_cache[key] = (expires_at, explosion)
+    while len(_explosion_cache) > EXPLOSION_CACHE_SIZE:
+        _explosion_cache.popitem(last=False)
+
+
+def get_explosion(
+    db: Session,
+    parent_item_id: int,
+    revision: Optional[int] = None,
+    include_optional: bool = False,
+    include_byproducts: bool = False,
+    max_levels: int = 10
+) -> Explosion:
+    """
+    Get the per-unit explosion of a parent item, from cache when possible.
+
+    Cache key: (parent item, revision, include_optional, include_byproducts,
+    max_levels) plus the BOM version stamp, so any BOM, item or location
+    write in this process makes older entries unreachable; entries also
+    expire after EXPLOSION_CACHE_SECONDS.
+
+    Args:
+        db: Database session
+        parent_item_id: Item to explode
+        revision: Specific top-level revision (None = active revision)
+        include_optional: Whether to include optional components
+        include_byproducts: Whether to include by-products
+        max_levels: Maximum explosion depth
+
+    Returns:
+        Explosion: Per-unit explosion, scale with Explosion.lines(quantity)
+    """
+    global _cache_hits, _cache_misses
+
+    # Read the version before loading so a concurrent write can only make this entry stale
+    version = _bom_version
+    key = (version, parent_item_id, revision, include_optional, include_byproducts, max_levels)
+
+    with _cache_lock:
+        cached = _cached_explosion(key)
+        if cached is not None:
+            _cache_hits += 1
+            return cached
+        _cache_misses += 1
+
+    expires_at = time.monotonic() + EXPLOSION_CACHE_SECONDS
+
+    graph = load_bom_graph(db, [parent_item_id], max_levels)
+    used_revision = revision or graph.active_revision(parent_item_id) or 1
+    unit_lines = _walk_graph(
+        graph, parent_item_id, Decimal("1"), used_revision,
+        include_optional, include_byproducts, max_levels
+    )
+    explosion = Explosion(
+        parent_item_id=parent_item_id,
+        has_bom=graph.has_bom(parent_item_id),
+        revision=used_revision,
+        unit_lines=unit_lines,
+        raw_item_ids={line["item_id"] for line in unit_lines if not graph.has_bom(line["item_id"])}
+    )
+
+    with _cache_lock:
+        if version == _bom_version:
+            _cache_explosion(key, explosion, expires_at)
+
+    return explosion
+
+
+def get_leaf_requirements(
+    db: Session,
+    parent_item_id: int,
+    quantity: Decimal,
+    revision: Optional[int] = None,
+    include_optional: bool = False,
+    include_byproducts: bool = False,
+    max_levels: int = 10
+) -> List[Tuple[int, Decimal]]:
+    """
+    Consolidated raw-material requirements for producing a quantity of a parent.
+    Uses the cached per-unit explosion; no per-line payload is built.
+
+    Args:
+        db: Database session
+        parent_item_id: Item to produce
+        quantity: Quantity to produce
+        revision: Specific top-level revision (None = active revision)
+        include_optional: Whether to include optional components
+        include_byproducts: Whether to include by-products
+        max_levels: Maximum explosion depth
+
+    Returns:
+        List[Tuple[int, Decimal]]: (item_id, total quantity incl. scrap), ordered by item code
+    """
+    explosion = get_explosion(
+        db,
+        parent_item_id=parent_item_id,
+        revision=revision,
+        include_optional=include_optional,
+        include_byproducts=include_byproducts,
+        max_levels=max_levels
+    )
+    return explosion.leaf_requirements(quantity)
+
+
+# ==================== BATCH EXPLOSION ====================
+def _splice(out: List[dict], sub_lines: List[dict], quantity: Decimal):
+    """Append a per-unit sub-assembly explosion one level deeper, scaled to quantity"""
+    for line in sub_lines:
+        spliced = dict(line)
+        spliced["level"] = line["level"] + 1
+        for field in SCALED_FIELDS:
+            spliced[field] = line[field] * quantity
+        out.append(spliced)
+
+
+def _memoized_unit_lines(
+    graph: BOMGraph,
+    parent_item_id: int,
+    revision: Optional[int],
+    include_optional: bool,
+    include_byproducts: bool,
+    max_levels: int,
+    memo: Dict[tuple, List[dict]]
+) -> List[dict]:
+    """
+    Per-unit explosion lines of a parent, reusing memoized sub-assembly explosions.
+
+    memo maps (item_id, levels) -> per-unit lines of a sub-assembly's ACTIVE
+    revision exploded levels deep, so a sub-assembly shared by several parents
+    (or used several times in one tree) is walked once. Lines and order match
+    _walk_graph; an item already on the path is not exploded again (legacy
+    circular BOMs), and its memo entry reflects that first path.
+    """
+    if max_levels < 1 or parent_item_id not in graph.items:
+        return []
+
+    def open_frame(item_id, frame_revision, levels):
+        lines = graph.component_lines(item_id, frame_revision, include_optional, include_byproducts)
+        return {
+            "item": graph.items[item_id],
+            "levels": levels,
+            "lines": iter(lines),
+            "out": [],
+            "pending_qty": None,
+            "memo_key": (item_id, levels) if frame_revision is None else None
+        }
+
+    stack = [open_frame(parent_item_id, revision, max_levels)]
+    on_path = {parent_item_id}
+
+    while True:
+        frame = stack[-1]
+        bom = next(frame["lines"], None)
+        if bom is None:
+            stack.pop()
+            on_path.discard(frame["item"].id)
+            if frame["memo_key"]:
+                memo[frame["memo_key"]] = frame["out"]
+            if not stack:
+                return frame["out"]
+            caller = stack[-1]
+            _splice(caller["out"], frame["out"], caller["pending_qty"])
+            caller["pending_qty"] = None
+            continue
+
+        child_item = graph.items.get(bom.child_item_id)
+        if not child_item:
+            continue
+
+        row = _line_row(graph, bom, child_item, frame["item"], Decimal("1"), 1)
+        frame["out"].append(row)
+
+        if graph.has_bom(child_item.id) and child_item.id not in on_path and frame["levels"] > 1:
+            sub_lines = memo.get((child_item.id, frame["levels"] - 1))
+            if sub_lines is not None:
+                _splice(frame["out"], sub_lines, row["total_quantity"])
+            else:
+                frame["pending_qty"] = row["total_quantity"]
+                on_path.add(child_item.id)
+                stack.append(open_frame(child_item.id, None, frame["levels"] - 1))
+
+
+def get_explosions(
+    db: Session,
+    parents: List[Tuple[int, Optional[int]]],
+    include_optional: bool = False,
+    include_byproducts: bool = False,
+    max_levels: int = 10
+) -> List[Explosion]:
+    """
+    Per-unit explosions for several parents at once.
+
+    Cached explosions are reused; the rest share one graph load (one query per
+    level for all parents) and one sub-assembly memo, and are cached afterwards.
+
+    Args:
+        db: Database session
+        parents: (parent_item_id, revision) pairs, revision None = active revision
+        include_optional: Whether to include optional components
+        include_byproducts: Whether to include by-products
+        max_levels: Maximum explosion depth
+
+    Returns:
+        List[Explosion]: One per entry of parents, in the same order
+    """
+    global _cache_hits, _cache_misses
+
+    version = _bom_version
+    found: Dict[tuple, Explosion] = {}
+    missing = []
+
+    with _cache_lock:
+        for parent_item_id, revision in dict.fromkeys(parents):
+            key = (version, parent_item_id, revision, include_optional, include_byproducts, max_levels)
+            cached = _cached_explosion(key)
+            if cached is not None:
+                _cache_hits += 1
+                found[(parent_item_id, revision)] = cached
+            else:
+                _cache_misses += 1
+                missing.append((parent_item_id, revision))
+
+    if missing:
+        expires_at = time.monotonic() + EXPLOSION_CACHE_SECONDS
+        graph = load_bom_graph(db, {parent_item_id for parent_item_id, _ in missing}, max_levels)
+        memo: Dict[tuple, List[dict]] = {}
+        for parent_item_id, revision in missing:
+            used_revision = revision or graph.active_revision(parent_item_id) or 1
+            unit_lines = _memoized_unit_lines(
+                graph, parent_item_id, used_revision,
+                include_optional, include_byproducts, max_levels, memo
+            )
+            found[(parent_item_id, revision)] = Explosion(
+                parent_item_id=parent_item_id,
+                has_bom=graph.has_bom(parent_item_id),
+                revision=used_revision,
+                unit_lines=unit_lines,
+                raw_item_ids={line["item_id"] for line in unit_lines if not graph.has_bom(line["item_id"])}
+            )
+
+        with _cache_lock:
+            if version == _bom_version:
+                for parent_item_id, revision in missing:
+                    key = (version, parent_item_id, revision, include_optional, include_byproducts, max_levels)
+                    _cache_explosion(key, found[(parent_item_id, revision)], expires_at)
+
+    return [found[(parent_item_id, revision)] for parent_item_id, revision in parents]
+
+
+# ==================== LINE QUANTITY ====================
+def unit_quantity(bom_type, quantity, percentage, scrap_factor) -> Decimal:
+    """Child quantity per one parent unit for a BOM line, including scrap"""
+    if bom_type == 'FORMULA' and percentage:
+        bom_qty = Decimal(str(percentage)) / Decimal("100")
+    else:
+        bom_qty = Decimal(str(quantity))
+    scrap = Decimal(str(scrap_factor)) if scrap_factor else Decimal("0")
+    return bom_qty + bom_qty * (scrap / Decimal("100"))
@@ -0,0 +1,268 @@
+"""
+BOM Bulk Import
+Parses CSV or NDJSON files laid out like the BOM export, validates every row
+with batched lookups (items, locations, existing lines, circular references)
+and inserts the accepted lines with bulk inserts.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import insert
+from decimal import Decimal, InvalidOperation
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+import csv
+import io
+import json
+import models
+from services import low_level_codes
+
+
+# Codes resolved and lines inserted per round trip
+IMPORT_BATCH_SIZE = 1000
+
+VALID_BOM_TYPES = ['ASSEMBLY', 'FORMULA', 'MODULAR', 'TAILOR_MADE']
+VALID_STATUSES = ['ACTIVE', 'INACTIVE']
+YES_VALUES = {'yes', 'y', 'true', '1'}
+NO_VALUES = {'no', 'n', 'false', '0', ''}
+
+
+def read_import_file(content: bytes, filename: str) -> List[Tuple[int, dict]]:
+    """
+    Parse an import file into (line number, row) pairs keyed by export column name.
+    Files ending in .ndjson, .jsonl or .json are read as one JSON object per line,
+    anything else as CSV with a header row.
+
+    Raises:
+        ValueError: If the file cannot be decoded or a JSON line is malformed
+    """
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("File must be UTF-8 encoded")
+
+    if (filename or "").lower().endswith((".ndjson", ".jsonl", ".json")):
+        rows = []
+        for line_no, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {line_no}: invalid JSON ({e.msg})")
+            if not isinstance(row, dict):
+                raise ValueError(f"Line {line_no}: expected a JSON object")
+            rows.append((line_no, row))
+        return rows
+
+    reader = csv.DictReader(io.StringIO(text))
+    return [(reader.line_num, row) for row in reader]
+
+
+def _text(row: dict, column: str) -> str:
+    value = row.get(column)
+    return str(value).strip() if value is not None else ""
+
+
+def _decimal(row: dict, column: str, errors: List[str], default=None):
+    value = _text(row, column)
+    if value == "":
+        return default
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        errors.append(f"{column} must be a number")
+        return default
+
+
+def _flag(row: dict, column: str, errors: List[str]) -> bool:
+    value = _text(row, column).lower()
+    if value in YES_VALUES:
+        return True
+    if value not in NO_VALUES:
+        errors.append(f"{column} must be Yes or No")
+    return False
+
+
+def _date(row: dict, column: str, errors: List[str]):
+    value = _text(row, column)
+    if value == "":
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        errors.append(f"{column} must be YYYY-MM-DD")
+        return None
+
+
+def _resolve_codes(db: Session, column, codes: Iterable[str]) -> Dict[str, int]:
+    """code -> id for a unique code column, one query per IMPORT_BATCH_SIZE codes"""
+    codes = sorted(set(codes))
+    resolved = {}
+    for start in range(0, len(codes), IMPORT_BATCH_SIZE):
+        batch = codes[start:start + IMPORT_BATCH_SIZE]
+        model = column.class_
+        for row in db.query(model.id, column).filter(column.in_(batch)).all():
+            resolved[row[1]] = row[0]
+    return resolved
+
+
+def validate_import_rows(db: Session, rows: List[Tuple[int, dict]]) -> Tuple[List[dict], List[dict]]:
+    """
+    Validate parsed rows and build insert mappings.
+
+    Args:
+        db: Database session
+        rows: (line number, row) pairs from read_import_file
+
+    Returns:
+        Tuple: (mappings for valid rows, per-row error entries)
+    """
+    parsed = []
+    for line_no, row in rows:
+        errors: List[str] = []
+        parent_code = _text(row, 'Parent Item Code')
+        child_code = _text(row, 'Child Item Code')
+        if not parent_code:
+            errors.append("Parent Item Code is required")
+        if not child_code:
+            errors.append("Child Item Code is required")
+        if parent_code and parent_code == child_code:
+            errors.append("Parent and child cannot be the same item")
+
+        bom_type = _text(row, 'BOM Type').upper() or 'ASSEMBLY'
+        if bom_type not in VALID_BOM_TYPES:
+            errors.append(f"Invalid BOM type. Must be one of: {VALID_BOM_TYPES}")
+
+        quantity = _decimal(row, 'Quantity', errors)
+        if quantity is None and 'Quantity must be a number' not in errors:
+            errors.append("Quantity is required")
+        elif quantity is not None and quantity <= 0:
+            errors.append("Quantity must be greater than 0")
+
+        status = _text(row, 'Status').upper() or 'ACTIVE'
+        if status not in VALID_STATUSES:
+            errors.append(f"Invalid status. Must be one of: {VALID_STATUSES}")
+
+        revision = _text(row, 'Revision') or "1"
+        try:
+            revision = int(Decimal(revision))
+            if revision < 1:
+                raise InvalidOperation
+        except (InvalidOperation, ValueError):
+            errors.append("Revision must be a positive whole number")
+            revision = None
+
+        parsed.append({
+            "line": line_no,
+            "parent_code": parent_code,
+            "child_code": child_code,
+            "production_location_code": _text(row, 'Production Location'),
+            "storage_location_code": _text(row, 'Storage Location'),
+            "errors": errors,
+            "values": {
+                "bom_type": bom_type,
+                "quantity": quantity,
+                "percentage": _decimal(row, 'Percentage', errors),
+                "scrap_factor": _decimal(row, 'Scrap Factor', errors, Decimal("0")),
+                "is_optional": _flag(row, 'Is Optional', errors),
+                "is_byproduct": _flag(row, 'Is Byproduct', errors),
+                "remark": _text(row, 'Remark') or None,
+                "revision": revision,
+                "status": models.BOMStatus(status) if status in VALID_STATUSES else None,
+                "active_date": _date(row, 'Active Date', errors),
+                "inactive_date": _date(row, 'Inactive Date', errors)
+            }
+        })
+
+    # Resolve codes for the whole file in batches
+    item_ids = _resolve_codes(
+        db, models.MasterItem.item_code,
+        [p["parent_code"] for p in parsed if p["parent_code"]] + [p["child_code"] for p in parsed if p["child_code"]]
+    )
+    location_ids = _resolve_codes(
+        db, models.LocationMaster.location_code,
+        [code for p in parsed for code in (p["production_location_code"], p["storage_location_code"]) if code]
+    )
+
+    for p in parsed:
+        if p["parent_code"] and p["parent_code"] not in item_ids:
+            p["errors"].append(f"Parent item {p['parent_code']} not found")
+        if p["child_code"] and p["child_code"] not in item_ids:
+            p["errors"].append(f"Child item {p['child_code']} not found")
+        for key, column in (("production_location_code", 'Production Location'),
+                            ("storage_location_code", 'Storage Location')):
+            if p[key] and p[key] not in location_ids:
+                p["errors"].append(f"{column} {p[key]} not found")
+        p["parent_id"] = item_ids.get(p["parent_code"])
+        p["child_id"] = item_ids.get(p["child_code"])
+
+    # Duplicates within the file and against existing active lines
+    parent_ids = {p["parent_id"] for p in parsed if p["parent_id"]}
+    existing = set()
+    parent_list = sorted(parent_ids)
+    for start in range(0, len(parent_list), IMPORT_BATCH_SIZE):
+        existing.update(
+            (row.parent_item_id, row.child_item_id, row.revision) for row in db.query(
+                models.MasterBOM.parent_item_id,
+                models.MasterBOM.child_item_id,
+                models.MasterBOM.revision
+            ).filter(
+                models.MasterBOM.parent_item_id.in_(parent_list[start:start + IMPORT_BATCH_SIZE]),
+                models.MasterBOM.is_active == True
+            ).all()
+        )
+
+    seen: Dict[tuple, int] = {}
+    for p in parsed:
+        if not (p["parent_id"] and p["child_id"] and p["values"]["revision"]):
+            continue
+        key = (p["parent_id"], p["child_id"], p["values"]["revision"])
+        if key in existing:
+            p["errors"].append(f"This component already exists in revision {key[2]}")
+        elif key in seen:
+            p["errors"].append(f"Duplicate of line {seen[key]}")
+        else:
+            seen[key] = p["line"]
+
+    # Circular references, checked for the whole file at once
+    candidates = [p for p in parsed if not p["errors"]]
+    looped = low_level_codes.find_cycle_edges(db, [(p["parent_id"], p["child_id"]) for p in candidates])
+    for p in candidates:
+        if (p["parent_id"], p["child_id"]) in looped:
+            p["errors"].append("Circular BOM reference")
+
+    mappings = []
+    errors = []
+    for p in parsed:
+        if p["errors"]:
+            errors.append({
+                "line": p["line"],
+                "parent_item_code": p["parent_code"],
+                "child_item_code": p["child_code"],
+                "errors": p["errors"]
+            })
+            continue
+        mappings.append({
+            "parent_item_id": p["parent_id"],
+            "child_item_id": p["child_id"],
+            "production_location_id": location_ids.get(p["production_location_code"]),
+            "storage_location_id": location_ids.get(p["storage_location_code"]),
+            "is_template": True,
+            "is_active": True,
+            **p["values"]
+        })
+
+    return mappings, errors
+
+
+def insert_import_rows(db: Session, mappings: List[dict], user_id: int) -> List[int]:
+    """
+    Bulk insert validated BOM lines. Does not commit.
+
+    Returns:
+        List[int]: Parents whose BOM changed
+    """
+    for start in range(0, len(mappings), IMPORT_BATCH_SIZE):
+        batch = [dict(m, created_by=user_id) for m in mappings[start:start + IMPORT_BATCH_SIZE]]
+        db.execute(insert(models.MasterBOM), batch)
+
+    return sorted({m["parent_item_id"] for m in mappings})
@@ -0,0 +1,303 @@
+"""
+Capacity Requirements Planning
+Turns open work orders into per-machine, per-day load and proposes a finite
+schedule. A work order's routing is the machine lines of its item's active
+BOM revision: every machine is one operation, run in sequence_order, taking
+remaining qty / capacity_per_hour hours.
+
+The load profile spreads each work order's hours evenly over its own start
+and end dates (infinite capacity), which shows where machines are
+overloaded. The finite schedule then books work orders one at a time by
+priority into the hours each machine has left per day and reports the
+start and end dates they can actually make.
+"""
+from sqlalchemy.orm import Session
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+import math
+import models
+
+
+# Hours a machine runs per day unless the caller says otherwise
+CRP_HOURS_PER_DAY = 8
+# Days ahead the finite schedule looks for free capacity
+CRP_HORIZON_DAYS = 365
+
+OPEN_STATUSES = (models.JobStatus.PLANNED, models.JobStatus.IN_PROGRESS)
+
+
+def load_routings(db: Session, item_ids: Iterable[int]) -> Dict[int, List[tuple]]:
+    """
+    item_id -> [(machine_id, capacity_per_hour)] in operation order, from the
+    active revision (revision of the first ACTIVE line). Lines of one machine
+    form a single operation at the slowest rate given; lines without a rate are ignored.
+    """
+    rows_by_parent: Dict[int, list] = {}
+    for row in db.query(
+        models.MasterBOM.id,
+        models.MasterBOM.parent_item_id,
+        models.MasterBOM.revision,
+        models.MasterBOM.machine_id,
+        models.MasterBOM.capacity_per_hour,
+        models.MasterBOM.sequence_order
+    ).filter(
+        models.MasterBOM.parent_item_id.in_(item_ids),
+        models.MasterBOM.is_active == True,
+        models.MasterBOM.status == models.BOMStatus.ACTIVE
+    ).all():
+        rows_by_parent.setdefault(row.parent_item_id, []).append(row)
+
+    routings: Dict[int, List[tuple]] = {}
+    for parent_id, rows in rows_by_parent.items():
+        revision = min(rows, key=lambda row: row.id).revision
+        operations: Dict[int, list] = {}
+        for row in rows:
+            if row.revision != revision or row.machine_id is None or not row.capacity_per_hour:
+                continue
+            rate = float(row.capacity_per_hour)
+            if rate <= 0:
+                continue
+            sequence = row.sequence_order or 0
+            current = operations.get(row.machine_id)
+            if current is None:
+                operations[row.machine_id] = [sequence, rate]
+            else:
+                current[0] = min(current[0], sequence)
+                current[1] = min(current[1], rate)
+        if operations:
+            routings[parent_id] = [
+                (machine_id, rate) for machine_id, (sequence, rate)
+                in sorted(operations.items(), key=lambda entry: (entry[1][0], entry[0]))
+            ]
+    return routings
+
+
+class MachineCalendar:
+    """Daily capacity of one machine and the hours the finite schedule has booked"""
+
+    def __init__(self, machine, hours_per_day: float, today: date, horizon: int):
+        self.machine = machine
+        available = machine.status == models.MachineStatus.ACTIVE and machine.is_active
+        self.hours_per_day = hours_per_day if available else 0.0
+        # Planned maintenance takes the machine off the floor for the day
+        self.down_day = (
+            (machine.next_maintenance_date - today).days if machine.next_maintenance_date else None
+        )
+        self.horizon = horizon
+        self.booked: Dict[int, float] = {}
+        self.first_open = 0
+
+    def capacity(self, day: int) -> float:
+        return 0.0 if day == self.down_day else self.hours_per_day
+
+    def book(self, earliest: int, hours: float) -> Optional[tuple]:
+        """
+        Book hours from day `earliest` on, filling each day's free capacity.
+
+        Returns:
+            Optional[tuple]: (first day, last day) used, None if the horizon runs out
+        """
+        day = max(earliest, self.first_open)
+        first = None
+        while hours > 1e-9:
+            if day >= self.horizon:
+                return None
+            free = self.capacity(day) - self.booked.get(day, 0.0)
+            if free > 1e-9:
+                used = min(free, hours)
+                self.booked[day] = self.booked.get(day, 0.0) + used
+                hours -= used
+                if first is None:
+                    first = day
+            elif day == self.first_open:
+                self.first_open += 1
+            if hours > 1e-9:
+                day += 1
+        return (first if first is not None else day, day)
+
+
+def _priority(wo) -> tuple:
+    """Work already on the floor first, then earliest due date, then earliest planned start"""
+    return (
+        wo.status != models.JobStatus.IN_PROGRESS,
+        wo.end_date or date.max,
+        wo.start_date or date.max,
+        wo.id
+    )
+
+
+def plan_capacity(
+    db: Session,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    machine_ids: Optional[Iterable[int]] = None,
+    hours_per_day: float = CRP_HOURS_PER_DAY
+) -> dict:
+    """
+    Load profile, overloads and a finite schedule for open work orders.
+
+    Every open (PLANNED or IN_PROGRESS) work order is scheduled, so the
+    proposals reflect all competing work; the machine and date filters only
+    narrow what is reported.
+
+    Args:
+        db: Database session
+        date_from: First day of the reported load profile (today if None)
+        date_to: Last day of the reported load profile (date_from + 30 days if None)
+        machine_ids: Report only these machines (all machines with routed work if None)
+        hours_per_day: Hours each available machine runs per day
+
+    Returns:
+        dict: Per-machine daily load, overloaded days, proposed work order dates
+        and the number of open work orders without a machine routing
+    """
+    today = date.today()
+    date_from = date_from or today
+    date_to = date_to or date_from + timedelta(days=30)
+    if date_to < date_from:
+        raise ValueError("date_to must not be before date_from")
+    if hours_per_day <= 0 or hours_per_day > 24:
+        raise ValueError("hours_per_day must be between 0 and 24")
+    if machine_ids is not None:
+        machine_ids = set(machine_ids)
+
+    work_orders = db.query(
+        models.TrnJobOrderHead.id,
+        models.TrnJobOrderHead.job_no,
+        models.TrnJobOrderHead.item_id,
+        models.TrnJobOrderHead.qty_planned,
+        models.TrnJobOrderHead.qty_produced,
+        models.TrnJobOrderHead.start_date,
+        models.TrnJobOrderHead.end_date,
+        models.TrnJobOrderHead.status
+    ).filter(models.TrnJobOrderHead.status.in_(OPEN_STATUSES)).all()
+
+    routings = load_routings(db, {wo.item_id for wo in work_orders}) if work_orders else {}
+    used_machines = {machine_id for routing in routings.values() for machine_id, _ in routing}
+    machines = {
+        machine.id: machine for machine in db.query(models.MasterMachine).filter(
+            models.MasterMachine.id.in_(used_machines)
+        ).all()
+    } if used_machines else {}
+
+    horizon = max((date_to - today).days + 1, CRP_HORIZON_DAYS)
+    calendars = {
+        machine_id: MachineCalendar(machine, float(hours_per_day), today, horizon)
+        for machine_id, machine in machines.items()
+    }
+    load: Dict[int, Dict[int, float]] = {machine_id: {} for machine_id in machines}
+
+    unrouted = 0
+    schedule = []
+    for wo in sorted(work_orders, key=_priority):
+        remaining = float((wo.qty_planned or 0) - (wo.qty_produced or 0))
+        routing = [
+            (machine_id, rate) for machine_id, rate in routings.get(wo.item_id, [])
+            if machine_id in machines
+        ]
+        if not routing:
+            unrouted += 1
+            continue
+        if remaining <= 0:
+            continue
+
+        # Infinite load: each operation's hours spread over the order's own dates
+        start = max((wo.start_date - today).days if wo.start_date else 0, 0)
+        hours = [remaining / rate for _, rate in routing]
+        if wo.end_date is not None:
+            end = max((wo.end_date - today).days, start)
+        else:
+            end = start + max(math.ceil(sum(hours) / hours_per_day) - 1, 0)
+        days = end - start + 1
+        for (machine_id, _), operation_hours in zip(routing, hours):
+            machine_load = load[machine_id]
+            for day in range(start, end + 1):
+                machine_load[day] = machine_load.get(day, 0.0) + operation_hours / days
+
+        # Finite schedule: operations in sequence, each into its machine's free hours
+        earliest = 0 if wo.status == models.JobStatus.IN_PROGRESS else start
+        proposed_start = proposed_end = None
+        operations = []
+        for (machine_id, _), operation_hours in zip(routing, hours):
+            booked = calendars[machine_id].book(earliest, operation_hours)
+            if booked is None:
+                proposed_start = proposed_end = None
+                break
+            first, last = booked
+            operations.append({
+                "machine_id": machine_id,
+                "hours": round(operation_hours, 2),
+                "start_date": today + timedelta(days=first),
+                "end_date": today + timedelta(days=last)
+            })
+            proposed_start = first if proposed_start is None else proposed_start
+            proposed_end = last
+            earliest = last
+
+        if machine_ids is not None and not any(machine_id in machine_ids for machine_id, _ in routing):
+            continue
+        scheduled = proposed_end is not None
+        schedule.append({
+            "job_id": wo.id,
+            "job_no": wo.job_no,
+            "item_id": wo.item_id,
+            "status": wo.status.value,
+            "remaining_qty": remaining,
+            "start_date": wo.start_date,
+            "end_date": wo.end_date,
+            "proposed_start_date": today + timedelta(days=proposed_start) if scheduled else None,
+            "proposed_end_date": today + timedelta(days=proposed_end) if scheduled else None,
+            "late": (not scheduled) or (
+                wo.end_date is not None and today + timedelta(days=proposed_end) > wo.end_date
+            ),
+            "operations": operations if scheduled else []
+        })
+
+    report_from = (date_from - today).days
+    report_to = (date_to - today).days
+    profile = []
+    overloads = []
+    for machine_id in sorted(machines):
+        if machine_ids is not None and machine_id not in machine_ids:
+            continue
+        machine = machines[machine_id]
+        calendar = calendars[machine_id]
+        days = []
+        for day in range(report_from, report_to + 1):
+            day_date = today + timedelta(days=day)
+            capacity = calendar.capacity(day) if day >= 0 else 0.0
+            load_hours = load[machine_id].get(day, 0.0)
+            entry = {
+                "date": day_date,
+                "capacity_hours": round(capacity, 2),
+                "load_hours": round(load_hours, 2),
+                "scheduled_hours": round(calendar.booked.get(day, 0.0), 2),
+                "overloaded": load_hours > capacity + 1e-9
+            }
+            days.append(entry)
+            if entry["overloaded"]:
+                overloads.append({
+                    "machine_id": machine_id,
+                    "machine_code": machine.machine_code,
+                    "date": day_date,
+                    "load_hours": entry["load_hours"],
+                    "capacity_hours": entry["capacity_hours"],
+                    "excess_hours": round(load_hours - capacity, 2)
+                })
+        profile.append({
+            "machine_id": machine_id,
+            "machine_code": machine.machine_code,
+            "machine_name": machine.machine_name,
+            "status": machine.status.value if machine.status else None,
+            "days": days
+        })
+
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "hours_per_day": hours_per_day,
+        "machines": profile,
+        "overloads": overloads,
+        "schedule": schedule,
+        "unrouted_work_orders": unrouted
+    }
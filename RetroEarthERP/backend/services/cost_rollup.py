@@ -0,0 +1,167 @@
+"""
+Standard Cost Roll-up
+Computes the material cost of every assembly from its components' costs,
+BOM quantities and scrap factors, processing items from the deepest
+low-level code up so each component is costed before its parents.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import update
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+import models
+from services.bom_engine import unit_quantity
+from services.low_level_codes import get_low_level_codes
+
+
+# Stored precision of master_items.standard_cost
+COST_PLACES = Decimal("0.0001")
+
+
+def _load_cost_lines(db: Session, parent_item_ids: Iterable[int] = None) -> Dict[int, List[tuple]]:
+    """
+    Costing lines per parent: [(child_item_id, qty_per_parent)] of the active
+    revision (revision of the first ACTIVE line), optional and by-product lines excluded.
+    """
+    query = db.query(
+        models.MasterBOM.id,
+        models.MasterBOM.parent_item_id,
+        models.MasterBOM.child_item_id,
+        models.MasterBOM.revision,
+        models.MasterBOM.bom_type,
+        models.MasterBOM.quantity,
+        models.MasterBOM.percentage,
+        models.MasterBOM.scrap_factor,
+        models.MasterBOM.is_optional,
+        models.MasterBOM.is_byproduct
+    ).filter(
+        models.MasterBOM.is_active == True,
+        models.MasterBOM.status == models.BOMStatus.ACTIVE
+    )
+    if parent_item_ids is not None:
+        query = query.filter(models.MasterBOM.parent_item_id.in_(parent_item_ids))
+
+    rows_by_parent: Dict[int, list] = {}
+    for row in query.all():
+        rows_by_parent.setdefault(row.parent_item_id, []).append(row)
+
+    lines: Dict[int, List[tuple]] = {}
+    for parent_id, rows in rows_by_parent.items():
+        revision = min(rows, key=lambda row: row.id).revision
+        lines[parent_id] = [
+            (row.child_item_id, unit_quantity(row.bom_type, row.quantity, row.percentage, row.scrap_factor))
+            for row in rows
+            if row.revision == revision and not row.is_optional and not row.is_byproduct
+            and row.child_item_id != parent_id
+        ]
+    return lines
+
+
+def _load_costs(db: Session, item_ids: Iterable[int] = None) -> Dict[int, object]:
+    """item_id -> (id, item_code, item_name, standard_cost) row"""
+    query = db.query(
+        models.MasterItem.id,
+        models.MasterItem.item_code,
+        models.MasterItem.item_name,
+        models.MasterItem.standard_cost
+    )
+    if item_ids is not None:
+        query = query.filter(models.MasterItem.id.in_(item_ids))
+    return {row.id: row for row in query.all()}
+
+
+def _roll_up(
+    lines: Dict[int, List[tuple]],
+    items: Dict[int, object],
+    codes: Dict[int, int]
+) -> Dict[int, Decimal]:
+    """Rolled-up cost of every parent in lines, deepest low-level code first"""
+    costs = {
+        item_id: Decimal(str(row.standard_cost or 0)) for item_id, row in items.items()
+    }
+    rolled: Dict[int, Decimal] = {}
+    for parent_id in sorted(lines, key=lambda item_id: codes.get(item_id, 0), reverse=True):
+        cost = Decimal("0")
+        for child_id, qty_per in lines[parent_id]:
+            cost += qty_per * costs.get(child_id, Decimal("0"))
+        cost = cost.quantize(COST_PLACES)
+        costs[parent_id] = cost
+        rolled[parent_id] = cost
+    return rolled
+
+
+def _changes(rolled: Dict[int, Decimal], items: Dict[int, object]) -> List[dict]:
+    """Preview rows for parents whose rolled-up cost differs from the stored cost"""
+    changes = []
+    for item_id, new_cost in rolled.items():
+        item = items.get(item_id)
+        if item is None:
+            continue
+        current = Decimal(str(item.standard_cost or 0)).quantize(COST_PLACES)
+        if current == new_cost:
+            continue
+        changes.append({
+            "item_id": item_id,
+            "item_code": item.item_code,
+            "item_name": item.item_name,
+            "current_cost": float(current),
+            "rolled_up_cost": float(new_cost),
+            "difference": float(new_cost - current)
+        })
+    changes.sort(key=lambda change: change["item_code"])
+    return changes
+
+
+def roll_up_standard_costs(
+    db: Session,
+    component_item_ids: Optional[Iterable[int]] = None,
+    commit: bool = False
+) -> dict:
+    """
+    Roll up standard costs through the BOM.
+
+    With component_item_ids only the ancestors of those components (from
+    bom_closure) are recomputed, e.g. after a purchased part's cost changed;
+    otherwise the whole catalogue is rolled up in one pass.
+
+    Args:
+        db: Database session
+        component_item_ids: Changed components (None = full roll-up)
+        commit: Write the new costs to master_items (False = preview only)
+
+    Returns:
+        dict: Items evaluated, changed items and whether they were written
+    """
+    if component_item_ids is None:
+        lines = _load_cost_lines(db)
+        items = _load_costs(db)
+        codes = get_low_level_codes(db)
+    else:
+        component_item_ids = set(component_item_ids)
+        ancestors = {
+            ancestor_id for (ancestor_id,) in db.query(models.BOMClosure.ancestor_item_id).filter(
+                models.BOMClosure.descendant_item_id.in_(component_item_ids)
+            ).distinct().all()
+        } if component_item_ids else set()
+        lines = _load_cost_lines(db, ancestors) if ancestors else {}
+        needed = set(lines) | {child_id for parent_lines in lines.values() for child_id, _ in parent_lines}
+        items = _load_costs(db, needed) if needed else {}
+        codes = get_low_level_codes(db, set(lines))
+
+    rolled = _roll_up(lines, items, codes)
+    changes = _changes(rolled, items)
+
+    if commit and changes:
+        db.execute(update(models.MasterItem), [
+            {"id": change["item_id"], "standard_cost": rolled[change["item_id"]]}
+            for change in changes
+        ])
+        db.commit()
+
+    return {
+        "mode": "commit" if commit else "preview",
+        "incremental": component_item_ids is not None,
+        "assemblies_evaluated": len(rolled),
+        "changed_items": len(changes),
+        "committed": bool(commit and changes),
+        "changes": changes
+    }
@@ -0,0 +1,146 @@
+"""
+FIFO Cost Layers
+Consumes inventory_cost_layer rows oldest first when stock is issued. Open
+layers are read through the partial index ix_cost_layer_fifo_open in
+(receipt_date, id) order, a few at a time, and fetching stops as soon as
+the issue is covered, so an issue touches only the layers it consumes no
+matter how much layer history an item has.
+
+On PostgreSQL the fetched layers are locked with FOR UPDATE SKIP LOCKED, so
+concurrent issues of one item each take different layers instead of
+queueing. Every decrement is also a guarded UPDATE (qty_remaining >= taken),
+which keeps databases without row locks (SQLite) from consuming a layer twice.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import and_, or_, select, update
+from decimal import Decimal
+from datetime import date
+from typing import Optional, Tuple
+import models
+
+
+# Layers fetched by the first round trip of an issue; later rounds double it
+FIFO_BATCH_SIZE = 8
+FIFO_MAX_BATCH_SIZE = 256
+
+ZERO = Decimal("0")
+
+
+def _layer_filter(item_id: int, warehouse_id: int, location_id: Optional[int], lot_number: Optional[str]):
+    """Open layers of one stock key; NULL location and lot match NULL (IS NULL)"""
+    layer = models.InventoryCostLayer
+    return and_(
+        layer.item_id == item_id,
+        layer.warehouse_id == warehouse_id,
+        layer.location_id == location_id,
+        layer.lot_number == lot_number,
+        layer.qty_remaining > 0
+    )
+
+
+def _fetch_layers(db: Session, key_filter, after: Optional[tuple], limit: int) -> list:
+    """Next open layers after (receipt_date, id), oldest first"""
+    layer = models.InventoryCostLayer
+    query = select(layer.id, layer.receipt_date, layer.qty_remaining, layer.unit_cost).where(key_filter)
+    if after is not None:
+        receipt_date, layer_id = after
+        query = query.where(or_(
+            layer.receipt_date > receipt_date,
+            and_(layer.receipt_date == receipt_date, layer.id > layer_id)
+        ))
+    query = query.order_by(layer.receipt_date, layer.id).limit(limit)
+    if db.get_bind().dialect.name == "postgresql":
+        query = query.with_for_update(skip_locked=True)
+    return db.execute(query).all()
+
+
+def issue_fifo(
+    db: Session,
+    item_id: int,
+    warehouse_id: int,
+    location_id: Optional[int],
+    qty: Decimal,
+    lot_number: Optional[str] = None
+) -> Tuple[Decimal, Decimal]:
+    """
+    Consume cost layers oldest first for an issue. Does not commit.
+
+    Args:
+        db: Database session
+        item_id, warehouse_id, location_id, lot_number: Stock key issued from
+        qty: Quantity issued
+
+    Returns:
+        Tuple: (total cost, average unit cost) of the quantity issued
+
+    Raises:
+        ValueError: If the key has no open layers, or fewer than qty
+            (layers found are consumed all the same)
+    """
+    layer = models.InventoryCostLayer
+    key_filter = _layer_filter(item_id, warehouse_id, location_id, lot_number)
+    remaining = Decimal(qty)
+    total_cost = ZERO
+    found_any = False
+    after = None
+    batch_size = FIFO_BATCH_SIZE
+
+    while remaining > 0:
+        layers = _fetch_layers(db, key_filter, after, batch_size)
+        if not layers:
+            break
+        found_any = True
+        for row in layers:
+            if remaining <= 0:
+                break
+            take = min(row.qty_remaining, remaining)
+            taken = db.execute(
+                update(layer).where(
+                    layer.id == row.id,
+                    layer.qty_remaining >= take
+                ).values(qty_remaining=layer.qty_remaining - take).execution_options(synchronize_session=False)
+            ).rowcount
+            if not taken:
+                # Consumed concurrently since it was read: fetch again from this layer
+                break
+            total_cost += take * row.unit_cost
+            remaining -= take
+            after = (row.receipt_date, row.id)
+        else:
+            if len(layers) < batch_size:
+                break
+        batch_size = min(batch_size * 2, FIFO_MAX_BATCH_SIZE)
+
+    if not found_any:
+        raise ValueError("No cost layers available for FIFO calculation. Item may not have been received yet.")
+    if remaining > 0:
+        raise ValueError(f"Insufficient inventory for FIFO costing. Short by {remaining}")
+
+    avg_cost = total_cost / qty if qty > 0 else ZERO
+    return total_cost, avg_cost
+
+
+def add_layer(
+    db: Session,
+    item_id: int,
+    warehouse_id: int,
+    location_id: Optional[int],
+    qty: Decimal,
+    unit_cost: Decimal,
+    receipt_date: date,
+    transaction_id: Optional[int] = None,
+    lot_number: Optional[str] = None
+) -> models.InventoryCostLayer:
+    """Open a cost layer for received stock. Does not commit."""
+    cost_layer = models.InventoryCostLayer(
+        item_id=item_id,
+        warehouse_id=warehouse_id,
+        location_id=location_id,
+        receipt_date=receipt_date,
+        qty_remaining=qty,
+        unit_cost=unit_cost,
+        receipt_transaction_id=transaction_id,
+        lot_number=lot_number
+    )
+    db.add(cost_layer)
+    return cost_layer
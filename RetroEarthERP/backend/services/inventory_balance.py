@@ -0,0 +1,201 @@
+"""
+Inventory Balance Maintenance
+The one place inventory_balance rows are written. A balance is keyed by
+(item, warehouse, location, lot); location and lot may be NULL, so the
+unique key uq_inventory_balance_key indexes coalesce(location_id, 0) and
+coalesce(lot_number, '') to make NULL match NULL.
+
+On PostgreSQL and SQLite every change is an INSERT ... ON CONFLICT DO
+UPDATE that increments qty_on_hand (and folds received cost into avg_cost)
+inside the statement, so concurrent postings of one hot item neither race
+to create the row nor overwrite each other's quantity. Other databases
+fall back to a locked read-modify-write.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import case, delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Tuple
+import models
+from services import mrp_engine
+
+
+BALANCE_KEY_INDEX = "uq_inventory_balance_key"
+
+ZERO = Decimal("0")
+
+UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def balance_key(item_id: int, warehouse_id: int, location_id: Optional[int], lot_number: Optional[str]) -> tuple:
+    """Stock key of a balance row; a blank lot is no lot (the unique key treats them alike)"""
+    return (item_id, warehouse_id, location_id, lot_number or None)
+
+
+def _key_expressions() -> list:
+    table = models.InventoryBalance.__table__
+    index = next(index for index in table.indexes if index.name == BALANCE_KEY_INDEX)
+    return list(index.expressions)
+
+
+def _aggregate(changes: Iterable[Tuple[tuple, Decimal, Optional[Decimal]]]) -> Dict[tuple, list]:
+    """key -> [net qty, received value or None]; one row per key, as ON CONFLICT requires"""
+    totals: Dict[tuple, list] = {}
+    for key, qty, unit_cost in changes:
+        key = balance_key(*key)
+        entry = totals.setdefault(key, [ZERO, None])
+        entry[0] += qty
+        if unit_cost is not None:
+            entry[1] = (entry[1] or ZERO) + qty * unit_cost
+    return totals
+
+
+def _row(key: tuple, qty: Decimal, avg_cost: Decimal) -> dict:
+    return {
+        "item_id": key[0],
+        "warehouse_id": key[1],
+        "location_id": key[2],
+        "lot_number": key[3],
+        "qty_on_hand": qty,
+        "avg_cost": avg_cost
+    }
+
+
+def _upsert(db: Session, dialect_insert, totals: Dict[tuple, list]):
+    balance = models.InventoryBalance.__table__
+    key_expressions = _key_expressions()
+    costed = [
+        _row(key, qty, value / qty if qty else ZERO)
+        for key, (qty, value) in totals.items() if value is not None
+    ]
+    moved = [_row(key, qty, ZERO) for key, (qty, value) in totals.items() if value is None]
+
+    if costed:
+        statement = dialect_insert(balance)
+        new_qty = func.coalesce(balance.c.qty_on_hand, 0) + statement.excluded.qty_on_hand
+        db.execute(statement.on_conflict_do_update(
+            index_elements=key_expressions,
+            set_={
+                "qty_on_hand": new_qty,
+                "avg_cost": case(
+                    (new_qty > 0, (
+                        func.coalesce(balance.c.qty_on_hand, 0) * func.coalesce(balance.c.avg_cost, 0)
+                        + statement.excluded.qty_on_hand * statement.excluded.avg_cost
+                    ) / new_qty),
+                    else_=0
+                ),
+                "last_updated": func.now()
+            }
+        ), costed)
+    if moved:
+        statement = dialect_insert(balance)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=key_expressions,
+            set_={
+                "qty_on_hand": func.coalesce(balance.c.qty_on_hand, 0) + statement.excluded.qty_on_hand,
+                "last_updated": func.now()
+            }
+        ), moved)
+
+
+def _read_modify_write(db: Session, totals: Dict[tuple, list]):
+    """Fallback for databases without ON CONFLICT: lock the rows, then update or insert"""
+    balance = models.InventoryBalance
+    existing = {}
+    for row in db.execute(
+        select(balance.id, balance.item_id, balance.warehouse_id, balance.location_id,
+               balance.lot_number, balance.qty_on_hand, balance.avg_cost).where(
+            balance.item_id.in_({key[0] for key in totals}),
+            balance.warehouse_id.in_({key[1] for key in totals})
+        ).with_for_update()
+    ).all():
+        key = balance_key(row.item_id, row.warehouse_id, row.location_id, row.lot_number)
+        if key in totals:
+            existing[key] = row
+
+    updates, inserts = [], []
+    for key, (qty, value) in totals.items():
+        row = existing.get(key)
+        if row is None:
+            inserts.append(_row(key, qty, value / qty if value is not None and qty else ZERO))
+            continue
+        old_qty, old_avg = row.qty_on_hand or ZERO, row.avg_cost or ZERO
+        new_qty = old_qty + qty
+        if value is not None:
+            old_avg = (old_qty * old_avg + value) / new_qty if new_qty > 0 else ZERO
+        updates.append({"id": row.id, "qty_on_hand": new_qty, "avg_cost": old_avg})
+    if updates:
+        db.execute(update(balance), updates)
+    if inserts:
+        db.execute(insert(balance), inserts)
+
+
+def post_balance_changes(db: Session, changes: Iterable[Tuple[tuple, Decimal, Optional[Decimal]]]) -> int:
+    """
+    Add quantity to (or take it from) inventory balances. Does not commit.
+
+    Args:
+        db: Database session
+        changes: (balance key, qty, unit cost) entries; qty is negative for
+            issues. A unit cost marks received stock and is folded into the
+            moving average; None leaves avg_cost as it is. Entries of one key
+            are summed first, so a key should not mix both kinds in one call.
+
+    Returns:
+        int: Number of balance keys written
+    """
+    totals = _aggregate(changes)
+    if not totals:
+        return 0
+    dialect_insert = UPSERT_DIALECTS.get(db.get_bind().dialect.name)
+    if dialect_insert is not None:
+        _upsert(db, dialect_insert, totals)
+    else:
+        _read_modify_write(db, totals)
+    mrp_engine.mark_items_changed(db, {key[0] for key in totals})
+    return len(totals)
+
+
+def merge_duplicate_balances(db: Session) -> int:
+    """
+    Fold duplicate balance rows of one key into the oldest row (quantities
+    summed, average cost weighted by quantity) so the unique key can be
+    created on databases that predate it. Does not commit.
+
+    Returns:
+        int: Number of rows removed
+    """
+    balance = models.InventoryBalance
+    key_columns = _key_expressions()
+    duplicated = select(*key_columns).group_by(*key_columns).having(func.count() > 1).subquery()
+    rows = db.execute(
+        select(balance.id, balance.item_id, balance.warehouse_id, balance.location_id,
+               balance.lot_number, balance.qty_on_hand, balance.avg_cost).join(
+            duplicated, (balance.item_id == duplicated.c[0]) & (balance.warehouse_id == duplicated.c[1])
+        ).order_by(balance.id)
+    ).all()
+
+    groups: Dict[tuple, list] = {}
+    for row in rows:
+        groups.setdefault(balance_key(row.item_id, row.warehouse_id, row.location_id, row.lot_number), []).append(row)
+
+    updates, removed = [], []
+    merged_items = set()
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        qty = sum((row.qty_on_hand or ZERO for row in group), ZERO)
+        value = sum(((row.qty_on_hand or ZERO) * (row.avg_cost or ZERO) for row in group), ZERO)
+        updates.append({
+            "id": group[0].id,
+            "qty_on_hand": qty,
+            "avg_cost": value / qty if qty > 0 else (group[0].avg_cost or ZERO)
+        })
+        removed.extend(row.id for row in group[1:])
+        merged_items.add(group[0].item_id)
+
+    if updates:
+        db.execute(update(balance), updates)
+        db.execute(delete(balance).where(balance.id.in_(removed)).execution_options(synchronize_session=False))
+        mrp_engine.mark_items_changed(db, merged_items)
+    return len(removed)
@@ -0,0 +1,250 @@
+"""
+Period-end Inventory Snapshots
+Closing qty and value per (item, warehouse, location, lot) at the end of
+each month, so "what was on hand on date X" reads the latest snapshot on or
+before X and applies only the transactions dated after it, instead of
+replaying the whole transaction history.
+
+A snapshot is rolled forward the same way from the one before it (the first
+one replays the history once). Receipts add and issues subtract their qty at
+the transaction's unit cost; transactions posted without one are valued at
+the item's standard cost.
+
+Snapshots do not lock periods. A stock posting dated on or before a
+snapshot's period end drops that snapshot and every later one, so as-of
+queries fall back to the last snapshot still valid, and the scheduler
+writes the missing month ends again on its next run. A posting that commits
+while a snapshot of its period is being written can still be missed; drop
+that snapshot (DELETE /api/inventory/snapshots/{id}) to have it rebuilt.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import case, delete, func, insert
+from sqlalchemy.exc import IntegrityError
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+import os
+import models
+from utils.datetime_utils import get_utc_now
+
+
+# How often the scheduler checks for month ends without a snapshot
+SNAPSHOT_CHECK_SECONDS = 3600
+# Days into a new month the scheduler waits before snapshotting the previous one,
+# so late postings for it do not drop the snapshot right away
+PERIOD_CLOSE_DELAY_DAYS = int(os.getenv("INVENTORY_PERIOD_CLOSE_DELAY_DAYS", "3"))
+
+# Signed effect of each transaction type on stock; other types do not move stock
+TRANSACTION_SIGNS = {"receipt": 1, "issue": -1}
+
+ZERO = Decimal("0")
+
+
+def _period_boundary(day: date) -> datetime:
+    """First instant (UTC) after the end of day"""
+    return datetime.combine(day + timedelta(days=1), time.min, tzinfo=timezone.utc)
+
+
+def last_period_end(today: Optional[date] = None) -> date:
+    """End of the last closed period (month) before today"""
+    today = today or get_utc_now().date()
+    return today.replace(day=1) - timedelta(days=1)
+
+
+def _month_end(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+def latest_snapshot(db: Session, on_or_before: Optional[date] = None) -> Optional[models.InventorySnapshot]:
+    query = db.query(models.InventorySnapshot)
+    if on_or_before is not None:
+        query = query.filter(models.InventorySnapshot.period_end <= on_or_before)
+    return query.order_by(models.InventorySnapshot.period_end.desc()).first()
+
+
+def _movements(
+    db: Session,
+    after: Optional[datetime],
+    until: datetime,
+    item_id: Optional[int],
+    warehouse_id: Optional[int]
+) -> list:
+    """Net qty, value and transaction count per stock key for after <= transaction_date < until"""
+    txn = models.InventoryTransaction
+    sign = case(
+        *[(txn.transaction_type == txn_type, value) for txn_type, value in TRANSACTION_SIGNS.items()],
+        else_=0
+    )
+    lot_key = func.coalesce(txn.lot_number, '')
+    query = db.query(
+        txn.item_id,
+        txn.warehouse_id,
+        txn.location_id,
+        lot_key.label("lot_key"),
+        func.sum(sign * txn.qty).label("qty"),
+        func.sum(sign * txn.qty * func.coalesce(txn.unit_cost, models.MasterItem.standard_cost, 0)).label("value"),
+        func.count(txn.id).label("transactions")
+    ).join(
+        models.MasterItem, models.MasterItem.id == txn.item_id
+    ).filter(
+        txn.transaction_type.in_(TRANSACTION_SIGNS),
+        txn.transaction_date < until
+    )
+    if after is not None:
+        query = query.filter(txn.transaction_date >= after)
+    if item_id:
+        query = query.filter(txn.item_id == item_id)
+    if warehouse_id:
+        query = query.filter(txn.warehouse_id == warehouse_id)
+    return query.group_by(txn.item_id, txn.warehouse_id, txn.location_id, lot_key).all()
+
+
+def position_as_of(
+    db: Session,
+    as_of: date,
+    item_id: Optional[int] = None,
+    warehouse_id: Optional[int] = None
+) -> Tuple[Optional[models.InventorySnapshot], Dict[tuple, list], int]:
+    """
+    Stock position at the end of a day.
+
+    Args:
+        db: Database session
+        as_of: Day whose closing position is wanted
+        item_id, warehouse_id: Optional filters
+
+    Returns:
+        Tuple: (snapshot started from or None, {(item, warehouse, location, lot): [qty, value]},
+        number of transactions applied on top of the snapshot)
+    """
+    base = latest_snapshot(db, as_of)
+    position: Dict[tuple, list] = {}
+    if base is not None:
+        lines = db.query(
+            models.InventorySnapshotLine.item_id,
+            models.InventorySnapshotLine.warehouse_id,
+            models.InventorySnapshotLine.location_id,
+            models.InventorySnapshotLine.lot_number,
+            models.InventorySnapshotLine.qty,
+            models.InventorySnapshotLine.value
+        ).filter(models.InventorySnapshotLine.snapshot_id == base.id)
+        if item_id:
+            lines = lines.filter(models.InventorySnapshotLine.item_id == item_id)
+        if warehouse_id:
+            lines = lines.filter(models.InventorySnapshotLine.warehouse_id == warehouse_id)
+        for line in lines.all():
+            position[(line.item_id, line.warehouse_id, line.location_id, line.lot_number)] = [line.qty, line.value]
+
+    applied = 0
+    after = _period_boundary(base.period_end) if base is not None else None
+    for row in _movements(db, after, _period_boundary(as_of), item_id, warehouse_id):
+        entry = position.setdefault((row.item_id, row.warehouse_id, row.location_id, row.lot_key or None), [ZERO, ZERO])
+        entry[0] += row.qty or ZERO
+        entry[1] += row.value or ZERO
+        applied += row.transactions
+    return base, position, applied
+
+
+def create_snapshot(db: Session, period_end: date, user_id: Optional[int] = None) -> models.InventorySnapshot:
+    """
+    Write the closing position of a period. Does not commit.
+
+    Args:
+        db: Database session
+        period_end: Last day of the period
+        user_id: User closing the period (None for the scheduler)
+
+    Returns:
+        models.InventorySnapshot: The new snapshot (lines written in bulk)
+
+    Raises:
+        ValueError: If the period has not ended yet or already has a snapshot
+    """
+    if period_end >= get_utc_now().date():
+        raise ValueError("Only a past period can be snapshotted (period_end must be before today)")
+    if db.query(models.InventorySnapshot.id).filter(models.InventorySnapshot.period_end == period_end).first():
+        raise ValueError(f"Inventory snapshot for {period_end} already exists")
+
+    base, position, _ = position_as_of(db, period_end)
+    lines = [
+        {
+            "item_id": key[0],
+            "warehouse_id": key[1],
+            "location_id": key[2],
+            "lot_number": key[3],
+            "qty": qty,
+            "value": value
+        }
+        for key, (qty, value) in position.items() if qty or value
+    ]
+    snapshot = models.InventorySnapshot(
+        period_end=period_end,
+        base_period_end=base.period_end if base is not None else None,
+        line_count=len(lines),
+        total_qty=sum((line["qty"] for line in lines), ZERO),
+        total_value=sum((line["value"] for line in lines), ZERO),
+        created_by=user_id
+    )
+    db.add(snapshot)
+    db.flush()
+    if lines:
+        for line in lines:
+            line["snapshot_id"] = snapshot.id
+        db.execute(insert(models.InventorySnapshotLine), lines)
+    return snapshot
+
+
+def invalidate_from(db: Session, day: date) -> int:
+    """
+    Drop the snapshots of periods ending on or after day, which a stock
+    posting dated day makes stale. Does not commit.
+
+    Returns:
+        int: Number of snapshots dropped
+    """
+    snapshot_ids = [
+        snapshot_id for (snapshot_id,) in db.query(models.InventorySnapshot.id).filter(
+            models.InventorySnapshot.period_end >= day
+        ).all()
+    ]
+    if snapshot_ids:
+        drop_snapshots(db, snapshot_ids)
+    return len(snapshot_ids)
+
+
+def drop_snapshots(db: Session, snapshot_ids: List[int]):
+    """Delete snapshots and their lines. Does not commit."""
+    db.execute(
+        delete(models.InventorySnapshotLine).where(models.InventorySnapshotLine.snapshot_id.in_(snapshot_ids))
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        delete(models.InventorySnapshot).where(models.InventorySnapshot.id.in_(snapshot_ids))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def close_due_periods(db: Session) -> List[models.InventorySnapshot]:
+    """
+    Snapshot every month end after the latest snapshot (only the last one
+    when there is none yet) once PERIOD_CLOSE_DELAY_DAYS of the following
+    month have passed, committing each (scheduler task; a concurrent process
+    writing the same period wins).
+
+    Returns:
+        List[models.InventorySnapshot]: The snapshots written
+    """
+    last_end = last_period_end(get_utc_now().date() - timedelta(days=PERIOD_CLOSE_DELAY_DAYS))
+    latest = latest_snapshot(db)
+    period_end = _month_end(latest.period_end + timedelta(days=1)) if latest is not None else last_end
+
+    written = []
+    while period_end <= last_end:
+        try:
+            written.append(create_snapshot(db, period_end))
+            db.commit()
+        except (IntegrityError, ValueError):
+            # Written by another process meanwhile
+            db.rollback()
+        period_end = _month_end(period_end + timedelta(days=1))
+    return written
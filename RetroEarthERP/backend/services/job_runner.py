@@ -0,0 +1,408 @@
+"""
+Background Jobs
+Runs long planning and reporting operations outside the request. Jobs are
+rows in background_jobs; worker threads claim queued rows with a conditional
+UPDATE, so workers in the API process and in a separate
+`python -m services.job_runner` process can share the table without a broker.
+
+Running jobs refresh a heartbeat; a job whose heartbeat stops (worker killed
+or restarted) is put back in the queue, up to JOB_MAX_ATTEMPTS runs.
+
+Periodic tasks (register_periodic) run on a scheduler thread of the pool;
+with several worker processes each one runs them, so they must be idempotent.
+"""
+from sqlalchemy.orm import Session
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from typing import Callable, Dict, List, Optional, Tuple
+from datetime import timedelta
+import logging
+import os
+import socket
+import threading
+import time
+import models
+from database import SessionLocal
+from utils.datetime_utils import get_utc_now
+
+
+logger = logging.getLogger(__name__)
+
+# Worker threads started with the API (0 = run workers in a separate process only)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Seconds between queue polls when idle, and between heartbeat/progress writes
+JOB_POLL_SECONDS = 2
+# A running job without a heartbeat for this long is re-queued
+JOB_STALE_SECONDS = 60
+JOB_MAX_ATTEMPTS = 3
+# Where jobs write downloadable output files
+JOB_OUTPUT_DIR = os.getenv("JOB_OUTPUT_DIR", "job_output")
+
+FINISHED_STATUSES = (
+    models.BackgroundJobStatus.SUCCEEDED,
+    models.BackgroundJobStatus.FAILED,
+    models.BackgroundJobStatus.CANCELLED
+)
+
+_handlers: Dict[str, Callable] = {}
+_periodic: List[Tuple[Callable, int]] = []
+
+
+def register_job(job_type: str):
+    """
+    Register the function that runs a job type.
+
+    The handler is called as handler(db, params, context) with its own session
+    and returns a JSON-serializable result.
+    """
+    def decorator(func: Callable) -> Callable:
+        _handlers[job_type] = func
+        return func
+    return decorator
+
+
+def register_periodic(interval_seconds: int):
+    """
+    Register a function the worker pool calls as func(db) every
+    interval_seconds (first call when the pool starts). It gets its own
+    session and commits its own work.
+    """
+    def decorator(func: Callable) -> Callable:
+        _periodic.append((func, interval_seconds))
+        return func
+    return decorator
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when its job was cancelled"""
+
+
+class JobContext:
+    """Handed to a running handler: progress reporting, cancellation, output files"""
+
+    def __init__(self, job: models.BackgroundJob):
+        self.job_id = job.id
+        self.created_by = job.created_by
+        self.percent = 0
+        self.message: Optional[str] = None
+        self.output_file: Optional[str] = None
+        self.cancel_requested = False
+        self.dirty = False
+
+    def progress(self, percent: int, message: Optional[str] = None):
+        """
+        Record progress (written by the pool's heartbeat, so a handler holding
+        a write transaction never waits on it) and stop if cancelled.
+        """
+        self.percent = max(0, min(int(percent), 100))
+        self.message = message
+        self.dirty = True
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def output_path(self, filename: str) -> str:
+        """Path for a downloadable output file of this job"""
+        os.makedirs(JOB_OUTPUT_DIR, exist_ok=True)
+        self.output_file = f"{self.job_id}_{filename}"
+        return os.path.join(JOB_OUTPUT_DIR, self.output_file)
+
+
+# ==================== QUEUE ====================
+def submit_job(db: Session, job_type: str, params: dict, user_id: int) -> models.BackgroundJob:
+    """
+    Queue a job and commit.
+
+    Raises:
+        ValueError: If no handler is registered for job_type
+    """
+    if job_type not in _handlers:
+        raise ValueError(f"Unknown job type: {job_type}")
+    job = models.BackgroundJob(
+        job_type=job_type,
+        params=jsonable_encoder(params),
+        status=models.BackgroundJobStatus.QUEUED,
+        created_by=user_id
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    if _pool is not None:
+        _pool.wake()
+    return job
+
+
+def cancel_job(db: Session, job: models.BackgroundJob) -> models.BackgroundJob:
+    """Cancel a queued job at once; a running job stops at its next progress report"""
+    if job.status in FINISHED_STATUSES:
+        raise ValueError(f"Job is already {job.status.value}")
+    if job.status == models.BackgroundJobStatus.QUEUED:
+        updated = db.query(models.BackgroundJob).filter(
+            models.BackgroundJob.id == job.id,
+            models.BackgroundJob.status == models.BackgroundJobStatus.QUEUED
+        ).update({
+            models.BackgroundJob.status: models.BackgroundJobStatus.CANCELLED,
+            models.BackgroundJob.cancel_requested: True,
+            models.BackgroundJob.finished_at: get_utc_now()
+        }, synchronize_session=False)
+        if updated:
+            db.commit()
+            db.refresh(job)
+            return job
+    job.cancel_requested = True
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def requeue_stale_jobs(db: Session) -> int:
+    """Put running jobs whose worker stopped heart-beating back in the queue"""
+    cutoff = get_utc_now() - timedelta(seconds=JOB_STALE_SECONDS)
+    stale = db.query(models.BackgroundJob).filter(
+        models.BackgroundJob.status == models.BackgroundJobStatus.RUNNING,
+        models.BackgroundJob.heartbeat_at < cutoff
+    ).all()
+    for job in stale:
+        if job.cancel_requested:
+            job.status = models.BackgroundJobStatus.CANCELLED
+            job.finished_at = get_utc_now()
+        elif job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status = models.BackgroundJobStatus.FAILED
+            job.error = f"Worker stopped responding ({job.attempts} attempts)"
+            job.finished_at = get_utc_now()
+        else:
+            job.status = models.BackgroundJobStatus.QUEUED
+            job.worker_id = None
+    if stale:
+        db.commit()
+    return len(stale)
+
+
+def _claim_next(db: Session, worker_id: str) -> Optional[models.BackgroundJob]:
+    """Take the oldest queued job; the conditional UPDATE lets only one worker win it"""
+    while True:
+        candidate = db.query(models.BackgroundJob.id).filter(
+            models.BackgroundJob.status == models.BackgroundJobStatus.QUEUED
+        ).order_by(models.BackgroundJob.id).first()
+        if candidate is None:
+            return None
+        now = get_utc_now()
+        claimed = db.query(models.BackgroundJob).filter(
+            models.BackgroundJob.id == candidate.id,
+            models.BackgroundJob.status == models.BackgroundJobStatus.QUEUED
+        ).update({
+            models.BackgroundJob.status: models.BackgroundJobStatus.RUNNING,
+            models.BackgroundJob.worker_id: worker_id,
+            models.BackgroundJob.started_at: now,
+            models.BackgroundJob.heartbeat_at: now,
+            models.BackgroundJob.attempts: models.BackgroundJob.attempts + 1
+        }, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return db.query(models.BackgroundJob).filter(models.BackgroundJob.id == candidate.id).first()
+
+
+def _finish(job_id: int, **values):
+    db = SessionLocal()
+    try:
+        values["finished_at"] = get_utc_now()
+        db.query(models.BackgroundJob).filter(models.BackgroundJob.id == job_id).update(
+            {getattr(models.BackgroundJob, key): value for key, value in values.items()},
+            synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_job(job: models.BackgroundJob, context: JobContext):
+    """Execute a claimed job in its own session and store the outcome"""
+    handler = _handlers.get(job.job_type)
+    if handler is None:
+        _finish(job.id, status=models.BackgroundJobStatus.FAILED, error=f"Unknown job type: {job.job_type}")
+        return
+
+    db = SessionLocal()
+    try:
+        result = handler(db, job.params or {}, context)
+    except JobCancelled:
+        db.rollback()
+        _finish(job.id, status=models.BackgroundJobStatus.CANCELLED, progress_message="Cancelled")
+        return
+    except HTTPException as e:
+        db.rollback()
+        _finish(job.id, status=models.BackgroundJobStatus.FAILED, error=str(e.detail))
+        return
+    except Exception as e:
+        db.rollback()
+        logger.exception("Job %s (%s) failed", job.id, job.job_type)
+        _finish(job.id, status=models.BackgroundJobStatus.FAILED, error=str(e) or e.__class__.__name__)
+        return
+    finally:
+        db.close()
+
+    _finish(
+        job.id,
+        status=models.BackgroundJobStatus.SUCCEEDED,
+        progress=100,
+        progress_message=context.message,
+        result=jsonable_encoder(result),
+        output_file=context.output_file
+    )
+
+
+# ==================== WORKER POOL ====================
+class WorkerPool:
+    """Worker threads polling background_jobs plus one heartbeat and one scheduler thread"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self.running: Dict[int, JobContext] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(f"{self.worker_prefix}:{index}",),
+                                      name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        if _periodic:
+            thread = threading.Thread(target=self._schedule, name="job-scheduler", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout: float = 5):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def wake(self):
+        self.wakeup.set()
+
+    def _work(self, worker_id: str):
+        while not self.stopping.is_set():
+            db = SessionLocal()
+            try:
+                job = _claim_next(db, worker_id)
+                if job is not None:
+                    db.expunge(job)
+            except Exception:
+                logger.exception("Job worker %s could not poll the queue", worker_id)
+                job = None
+            finally:
+                db.close()
+
+            if job is None:
+                self.wakeup.wait(JOB_POLL_SECONDS)
+                self.wakeup.clear()
+                continue
+
+            context = JobContext(job)
+            with self.lock:
+                self.running[job.id] = context
+            try:
+                run_job(job, context)
+            finally:
+                with self.lock:
+                    self.running.pop(job.id, None)
+
+    def _heartbeat(self):
+        while not self.stopping.wait(JOB_POLL_SECONDS):
+            db = SessionLocal()
+            try:
+                with self.lock:
+                    contexts = dict(self.running)
+                if contexts:
+                    now = get_utc_now()
+                    for job_id, context in contexts.items():
+                        values = {models.BackgroundJob.heartbeat_at: now}
+                        if context.dirty:
+                            values[models.BackgroundJob.progress] = context.percent
+                            values[models.BackgroundJob.progress_message] = context.message
+                            context.dirty = False
+                        db.query(models.BackgroundJob).filter(
+                            models.BackgroundJob.id == job_id,
+                            models.BackgroundJob.status == models.BackgroundJobStatus.RUNNING
+                        ).update(values, synchronize_session=False)
+                    db.commit()
+                    for (job_id,) in db.query(models.BackgroundJob.id).filter(
+                        models.BackgroundJob.id.in_(contexts),
+                        models.BackgroundJob.cancel_requested == True
+                    ).all():
+                        contexts[job_id].cancel_requested = True
+                requeue_stale_jobs(db)
+            except Exception:
+                db.rollback()
+                logger.exception("Job heartbeat failed")
+            finally:
+                db.close()
+
+    def _schedule(self):
+        due = [0.0] * len(_periodic)
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for index, (func, interval) in enumerate(_periodic):
+                if now < due[index]:
+                    continue
+                due[index] = now + interval
+                db = SessionLocal()
+                try:
+                    func(db)
+                except Exception:
+                    db.rollback()
+                    logger.exception("Periodic task %s failed", func.__name__)
+                finally:
+                    db.close()
+            self.stopping.wait(max(min(due) - time.monotonic(), 1))
+
+
+_pool: Optional[WorkerPool] = None
+
+
+def start_workers(workers: int = JOB_WORKERS) -> Optional[WorkerPool]:
+    """Start the in-process worker pool (no-op with 0 workers or if already started)"""
+    global _pool
+    if workers <= 0 or _pool is not None:
+        return _pool
+    db = SessionLocal()
+    try:
+        requeue_stale_jobs(db)
+    finally:
+        db.close()
+    _pool = WorkerPool(workers)
+    _pool.start()
+    return _pool
+
+
+def stop_workers():
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
+
+
+if __name__ == "__main__":
+    # Standalone worker process: python -m services.job_runner [workers]
+    # This file runs as __main__ here; the routers register their job handlers and
+    # periodic tasks on the imported services.job_runner module, so run that one.
+    import sys
+    import main  # noqa: F401  (imports the routers, which register the job handlers)
+    from services import job_runner
+
+    logging.basicConfig(level=logging.INFO)
+    job_runner.start_workers(int(sys.argv[1]) if len(sys.argv) > 1 else max(JOB_WORKERS, 1))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        job_runner.stop_workers()
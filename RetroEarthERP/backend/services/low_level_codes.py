@@ -0,0 +1,345 @@
+"""
+Low-Level Codes
+Computes each item's low-level code (the deepest level it appears at in any
+ACTIVE BOM) with a topological pass over master_bom, keeps item_low_level_code
+in sync after BOM edits and detects circular references before they are written.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import insert
+from typing import Dict, Iterable, List, Optional, Tuple
+import models
+
+
+def _active_edges(db: Session, child_item_ids: Iterable[int] = None) -> List[Tuple[int, int]]:
+    """Distinct (parent_item_id, child_item_id) pairs of ACTIVE BOM lines"""
+    query = db.query(
+        models.MasterBOM.parent_item_id,
+        models.MasterBOM.child_item_id
+    ).filter(
+        models.MasterBOM.is_active == True,
+        models.MasterBOM.status == models.BOMStatus.ACTIVE,
+        models.MasterBOM.parent_item_id != models.MasterBOM.child_item_id
+    )
+    if child_item_ids is not None:
+        query = query.filter(models.MasterBOM.child_item_id.in_(child_item_ids))
+    return [(row.parent_item_id, row.child_item_id) for row in query.distinct().all()]
+
+
+def _topological_codes(
+    items: set,
+    edges: List[Tuple[int, int]],
+    base_codes: Dict[int, int]
+) -> Tuple[Dict[int, int], List[int]]:
+    """
+    Longest-path levels over a DAG with Kahn's algorithm.
+
+    Args:
+        items: Items to assign a code to
+        edges: (parent, child) pairs; parents outside items only raise base_codes
+        base_codes: Minimum code per item, from parents outside items
+
+    Returns:
+        Tuple: (codes for items, items left on a cycle)
+    """
+    children: Dict[int, List[int]] = {}
+    indegree = {item_id: 0 for item_id in items}
+    for parent_id, child_id in edges:
+        if parent_id in items and child_id in items:
+            children.setdefault(parent_id, []).append(child_id)
+            indegree[child_id] += 1
+
+    codes = {item_id: base_codes.get(item_id, 0) for item_id in items}
+    queue = [item_id for item_id, count in indegree.items() if count == 0]
+    while queue:
+        item_id = queue.pop()
+        for child_id in children.get(item_id, []):
+            codes[child_id] = max(codes[child_id], codes[item_id] + 1)
+            indegree[child_id] -= 1
+            if indegree[child_id] == 0:
+                queue.append(child_id)
+
+    cyclic = [item_id for item_id, count in indegree.items() if count > 0]
+    return codes, cyclic
+
+
+def compute_low_level_codes(lines: Dict[int, Iterable[int]]) -> Tuple[Dict[int, int], List[int]]:
+    """
+    Low-level codes of an in-memory BOM (e.g. a what-if overlay), nothing read or written.
+
+    Args:
+        lines: parent_item_id -> child item ids
+
+    Returns:
+        Tuple: (codes for every parent and child, items left on a cycle)
+    """
+    edges = [
+        (parent_id, child_id)
+        for parent_id, children in lines.items() for child_id in children if child_id != parent_id
+    ]
+    items = set(lines) | {child_id for _, child_id in edges}
+    return _topological_codes(items, edges, {})
+
+
+def _write_codes(db: Session, codes: Dict[int, int]):
+    """Insert non-zero codes; callers delete the rows being replaced first"""
+    mappings = [
+        {"item_id": item_id, "low_level_code": code}
+        for item_id, code in codes.items() if code > 0
+    ]
+    if mappings:
+        db.execute(insert(models.ItemLowLevelCode), mappings)
+
+
+def rebuild_low_level_codes(db: Session) -> dict:
+    """
+    Recompute every low-level code from master_bom and commit.
+
+    Args:
+        db: Database session
+
+    Returns:
+        dict: Number of items with a code, deepest level and items on circular BOMs
+    """
+    edges = _active_edges(db)
+    items = {item_id for edge in edges for item_id in edge}
+    codes, cyclic = _topological_codes(items, edges, {})
+
+    db.query(models.ItemLowLevelCode).delete(synchronize_session=False)
+    _write_codes(db, codes)
+    db.commit()
+
+    return {
+        "items": len([code for code in codes.values() if code > 0]),
+        "max_level": max(codes.values(), default=0),
+        "cyclic_item_ids": sorted(cyclic)
+    }
+
+
+def refresh_low_level_codes(db: Session, parent_item_ids: Iterable[int]) -> int:
+    """
+    Recompute the codes below parents whose BOM lines changed. Does not commit.
+    Must run after bom_closure has been refreshed for the same parents.
+
+    Only components of the parents (current and removed lines) and everything
+    below them can change level; they are re-levelled in topological order
+    starting from the stored codes of their other parents.
+
+    Args:
+        db: Database session
+        parent_item_ids: Parents whose BOM lines were created, changed or removed
+
+    Returns:
+        int: Number of items re-levelled
+    """
+    parent_item_ids = set(parent_item_ids)
+    if not parent_item_ids:
+        return 0
+
+    db.flush()
+
+    # Lines are soft-deleted, so removed components are still found here
+    components = {
+        child_id for (child_id,) in db.query(models.MasterBOM.child_item_id).filter(
+            models.MasterBOM.parent_item_id.in_(parent_item_ids)
+        ).distinct().all()
+    }
+    if not components:
+        return 0
+
+    region = components | {
+        descendant_id for (descendant_id,) in db.query(models.BOMClosure.descendant_item_id).filter(
+            models.BOMClosure.ancestor_item_id.in_(components)
+        ).distinct().all()
+    }
+
+    edges = _active_edges(db, region)
+    outside_parents = {parent_id for parent_id, _ in edges} - region
+    stored = get_low_level_codes(db, outside_parents)
+
+    base_codes: Dict[int, int] = {}
+    for parent_id, child_id in edges:
+        if parent_id not in region:
+            base_codes[child_id] = max(base_codes.get(child_id, 0), stored.get(parent_id, 0) + 1)
+
+    codes, _ = _topological_codes(region, edges, base_codes)
+
+    db.query(models.ItemLowLevelCode).filter(
+        models.ItemLowLevelCode.item_id.in_(region)
+    ).delete(synchronize_session=False)
+    _write_codes(db, codes)
+    return len(region)
+
+
+def ensure_low_level_codes(db: Session) -> Optional[dict]:
+    """Compute low-level codes if none are stored but active BOM lines exist"""
+    has_codes = db.query(models.ItemLowLevelCode.item_id).first()
+    has_bom = db.query(models.MasterBOM.id).filter(models.MasterBOM.is_active == True).first()
+    if has_codes or not has_bom:
+        return None
+    return rebuild_low_level_codes(db)
+
+
+def get_low_level_codes(db: Session, item_ids: Iterable[int] = None) -> Dict[int, int]:
+    """
+    Stored low-level codes; items without a row are level 0.
+
+    Args:
+        db: Database session
+        item_ids: Restrict to these items (all items with a code if None)
+
+    Returns:
+        Dict[int, int]: item_id -> low-level code
+    """
+    query = db.query(models.ItemLowLevelCode.item_id, models.ItemLowLevelCode.low_level_code)
+    if item_ids is not None:
+        item_ids = set(item_ids)
+        if not item_ids:
+            return {}
+        query = query.filter(models.ItemLowLevelCode.item_id.in_(item_ids))
+    codes = {row.item_id: row.low_level_code for row in query.all()}
+    if item_ids is not None:
+        for item_id in item_ids:
+            codes.setdefault(item_id, 0)
+    return codes
+
+
+def find_cycle(db: Session, parent_item_id: int, child_item_ids: Iterable[int]) -> Optional[List[int]]:
+    """
+    Check whether adding parent -> child lines would close a loop.
+
+    Walks down from the new children over every active BOM line (any revision
+    status, so activating a revision later cannot create a loop either),
+    one query per level.
+
+    Args:
+        db: Database session
+        parent_item_id: Parent receiving the new lines
+        child_item_ids: Components being added
+
+    Returns:
+        Optional[List[int]]: Item ids along the loop (starting and ending with
+        the parent), or None if there is no loop
+    """
+    child_item_ids = set(child_item_ids)
+    if parent_item_id in child_item_ids:
+        return [parent_item_id, parent_item_id]
+
+    came_from = {child_id: parent_item_id for child_id in child_item_ids}
+    frontier = child_item_ids
+    while frontier:
+        rows = db.query(
+            models.MasterBOM.parent_item_id,
+            models.MasterBOM.child_item_id
+        ).filter(
+            models.MasterBOM.is_active == True,
+            models.MasterBOM.parent_item_id.in_(frontier)
+        ).distinct().all()
+
+        next_frontier = set()
+        for row in rows:
+            if row.child_item_id == parent_item_id:
+                path = [parent_item_id]
+                node = row.parent_item_id
+                while node != parent_item_id:
+                    path.append(node)
+                    node = came_from[node]
+                path.append(parent_item_id)
+                path.reverse()
+                return path
+            if row.child_item_id not in came_from:
+                came_from[row.child_item_id] = row.parent_item_id
+                next_frontier.add(row.child_item_id)
+        frontier = next_frontier
+
+    return None
+
+
+def describe_cycle(db: Session, path: List[int]) -> str:
+    """Item codes along a loop, e.g. 'FG-01 -> SA-02 -> FG-01'"""
+    codes = dict(db.query(models.MasterItem.id, models.MasterItem.item_code).filter(
+        models.MasterItem.id.in_(set(path))
+    ).all())
+    return " -> ".join(codes.get(item_id, str(item_id)) for item_id in path)
+
+
+def _strongly_connected(graph: Dict[int, set], roots: Iterable[int]) -> Dict[int, int]:
+    """Iterative Tarjan: node -> id of its strongly connected component (reachable from roots)"""
+    index: Dict[int, int] = {}
+    low: Dict[int, int] = {}
+    component: Dict[int, int] = {}
+    stack: List[int] = []
+    on_stack = set()
+    counter = 0
+
+    for root in roots:
+        if root in index:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, pending = work[-1]
+            descended = False
+            for nxt in pending:
+                if nxt not in index:
+                    index[nxt] = low[nxt] = counter
+                    counter += 1
+                    stack.append(nxt)
+                    on_stack.add(nxt)
+                    work.append((nxt, iter(graph.get(nxt, ()))))
+                    descended = True
+                    break
+                if nxt in on_stack:
+                    low[node] = min(low[node], index[nxt])
+            if descended:
+                continue
+
+            work.pop()
+            if work:
+                caller = work[-1][0]
+                low[caller] = min(low[caller], low[node])
+            if low[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component[member] = node
+                    if member == node:
+                        break
+
+    return component
+
+
+def find_cycle_edges(db: Session, new_edges: Iterable[Tuple[int, int]]) -> set:
+    """
+    New (parent, child) lines that would sit on a BOM loop, checked as one batch.
+
+    Combines every active BOM line with the new lines and finds strongly
+    connected components; a new line is on a loop when both ends share one.
+
+    Args:
+        db: Database session
+        new_edges: (parent_item_id, child_item_id) pairs being added
+
+    Returns:
+        set: The offending (parent_item_id, child_item_id) pairs
+    """
+    new_edges = set(new_edges)
+    if not new_edges:
+        return set()
+
+    graph: Dict[int, set] = {}
+    for row in db.query(
+        models.MasterBOM.parent_item_id,
+        models.MasterBOM.child_item_id
+    ).filter(models.MasterBOM.is_active == True).distinct().all():
+        graph.setdefault(row.parent_item_id, set()).add(row.child_item_id)
+    for parent_id, child_id in new_edges:
+        graph.setdefault(parent_id, set()).add(child_id)
+
+    component = _strongly_connected(graph, {parent_id for parent_id, _ in new_edges})
+    return {
+        (parent_id, child_id) for parent_id, child_id in new_edges
+        if parent_id == child_id or component.get(parent_id) == component.get(child_id)
+    }
@@ -0,0 +1,1024 @@
+"""
+MRP Engine
+Multi-level, time-phased material requirements planning. Demand is bucketed
+by day or week, items are planned in low-level-code order so every parent's
+planned orders are exploded before a component is netted, and planned
+orders are offset by item and BOM production lead times.
+
+A net-change mode replans only the items whose inputs changed since the
+plan's last run (tracked in mrp_item_change, ordered by its id sequence)
+and their components, taking the demand of every other parent from its
+stored mrp_results.
+
+What-if scenarios run the same pass over a copy-on-write overlay of the
+plan's inputs (demand, inventory, BOM and item changes) and only report a
+summary; nothing is written until a scenario is applied to the plan.
+
+Bucket math uses one plain list per item and series (gross requirements,
+scheduled receipts, planned receipts); numpy is not a dependency of this
+project and the per-bucket netting loop is sequential anyway, so lists
+indexed by bucket keep a 20k-item, 52-bucket run to a few seconds.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import event, func, insert, inspect, select, text
+from decimal import Decimal, ROUND_UP
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import heapq
+import math
+import os
+import models
+from services.bom_engine import unit_quantity
+from services.low_level_codes import compute_low_level_codes, get_low_level_codes
+from utils.datetime_utils import get_utc_now
+
+
+# Stored precision of mrp_results quantities
+QTY_PLACES = Decimal("0.0001")
+
+BUCKET_DAYS = {"day": 1, "week": 7}
+
+ZERO = Decimal("0")
+
+
+# ==================== INPUTS ====================
+def load_plan_demands(
+    db: Session,
+    db_plan: models.ProductionPlan,
+    item_ids: Iterable[int] = None
+) -> List[dict]:
+    """
+    Independent demand of a plan: open sales order lines (ACTUAL) or plan
+    items (MANUAL/FORECAST), optionally restricted to some items.
+
+    Returns:
+        List[dict]: {'item_id', 'required_qty', 'required_date'} rows
+    """
+    if db_plan.source_type == 'ACTUAL':
+        remaining = models.TrnSalesOrderDetail.qty_ordered - func.coalesce(models.TrnSalesOrderDetail.qty_delivered, 0)
+        rows = db.query(
+            models.TrnSalesOrderDetail.item_id,
+            remaining.label("remaining_qty"),
+            func.coalesce(models.TrnSalesOrderHead.delivery_date, models.TrnSalesOrderHead.so_date).label("required_date")
+        ).join(
+            models.TrnSalesOrderHead, models.TrnSalesOrderHead.id == models.TrnSalesOrderDetail.so_id
+        ).filter(
+            models.TrnSalesOrderHead.status.in_(['CONFIRMED', 'PARTIAL_DELIVERED']),
+            remaining > 0
+        )
+        if item_ids is not None:
+            rows = rows.filter(models.TrnSalesOrderDetail.item_id.in_(item_ids))
+        rows = rows.order_by(models.TrnSalesOrderHead.id, models.TrnSalesOrderDetail.id).all()
+
+        return [{
+            'item_id': row.item_id,
+            'required_qty': Decimal(str(row.remaining_qty)),
+            'required_date': row.required_date
+        } for row in rows]
+
+    if db_plan.source_type in ('MANUAL', 'FORECAST'):
+        rows = db.query(
+            models.ProductionPlanItem.item_id,
+            models.ProductionPlanItem.quantity,
+            models.ProductionPlanItem.delivery_date
+        ).filter(
+            models.ProductionPlanItem.plan_id == db_plan.id
+        )
+        if item_ids is not None:
+            rows = rows.filter(models.ProductionPlanItem.item_id.in_(item_ids))
+        rows = rows.order_by(models.ProductionPlanItem.id).all()
+
+        return [{
+            'item_id': row.item_id,
+            'required_qty': Decimal(str(row.quantity)),
+            'required_date': row.delivery_date
+        } for row in rows]
+
+    return []
+
+
+def _load_items(db: Session, item_ids: Iterable[int] = None) -> Dict[int, object]:
+    """item_id -> (id, item_code, item_name, lead_time_days, safety_stock, standard_cost) row"""
+    query = db.query(
+        models.MasterItem.id,
+        models.MasterItem.item_code,
+        models.MasterItem.item_name,
+        models.MasterItem.lead_time_days,
+        models.MasterItem.safety_stock,
+        models.MasterItem.standard_cost
+    )
+    if item_ids is not None:
+        query = query.filter(models.MasterItem.id.in_(item_ids))
+    return {row.id: row for row in query.all()}
+
+
+def _load_planning_bom(
+    db: Session,
+    parent_item_ids: Iterable[int] = None
+) -> Tuple[Dict[int, List[tuple]], Dict[int, int], set]:
+    """
+    Planning structure from master_bom.
+
+    Returns:
+        Tuple: (parent -> [(child_item_id, qty_per_parent)] of the active revision
+        with optional and by-product lines excluded, parent -> production lead
+        time in days (longest line), parents with any active line)
+    """
+    query = db.query(
+        models.MasterBOM.id,
+        models.MasterBOM.parent_item_id,
+        models.MasterBOM.child_item_id,
+        models.MasterBOM.revision,
+        models.MasterBOM.status,
+        models.MasterBOM.bom_type,
+        models.MasterBOM.quantity,
+        models.MasterBOM.percentage,
+        models.MasterBOM.scrap_factor,
+        models.MasterBOM.is_optional,
+        models.MasterBOM.is_byproduct,
+        models.MasterBOM.production_lead_time_days
+    ).filter(models.MasterBOM.is_active == True)
+    if parent_item_ids is not None:
+        query = query.filter(models.MasterBOM.parent_item_id.in_(parent_item_ids))
+
+    rows_by_parent: Dict[int, list] = {}
+    makes = set()
+    for row in query.all():
+        makes.add(row.parent_item_id)
+        if row.status == models.BOMStatus.ACTIVE:
+            rows_by_parent.setdefault(row.parent_item_id, []).append(row)
+
+    lines: Dict[int, List[tuple]] = {}
+    production_days: Dict[int, int] = {}
+    for parent_id, rows in rows_by_parent.items():
+        revision = min(rows, key=lambda row: row.id).revision
+        rows = [row for row in rows if row.revision == revision]
+        lines[parent_id] = [
+            (row.child_item_id, unit_quantity(row.bom_type, row.quantity, row.percentage, row.scrap_factor))
+            for row in rows
+            if not row.is_optional and not row.is_byproduct and row.child_item_id != parent_id
+        ]
+        production_days[parent_id] = max(
+            (math.ceil(Decimal(str(row.production_lead_time_days or 0))) for row in rows), default=0
+        )
+    return lines, production_days, makes
+
+
+def _load_on_hand(db: Session, item_ids: Iterable[int] = None) -> Dict[int, Decimal]:
+    """Inventory on hand (all warehouses) per item"""
+    query = db.query(
+        models.InventoryBalance.item_id,
+        func.sum(models.InventoryBalance.qty_on_hand)
+    )
+    if item_ids is not None:
+        query = query.filter(models.InventoryBalance.item_id.in_(item_ids))
+    return {
+        item_id: Decimal(str(qty or 0))
+        for item_id, qty in query.group_by(models.InventoryBalance.item_id).all()
+    }
+
+
+def _load_open_po(db: Session, item_ids: Iterable[int] = None) -> Dict[int, List[tuple]]:
+    """item_id -> [(due date, open qty)] of purchase order lines not yet fully received"""
+    due = func.coalesce(models.TrnPurchaseOrderHead.delivery_date, models.TrnPurchaseOrderHead.po_date)
+    query = db.query(
+        models.TrnPurchaseOrderDetail.item_id,
+        due.label("due_date"),
+        func.sum(models.TrnPurchaseOrderDetail.qty_ordered - func.coalesce(models.TrnPurchaseOrderDetail.qty_received, 0))
+    ).join(
+        models.TrnPurchaseOrderHead, models.TrnPurchaseOrderHead.id == models.TrnPurchaseOrderDetail.po_id
+    ).filter(
+        models.TrnPurchaseOrderHead.status.notin_([models.POStatus.CANCELLED, models.POStatus.COMPLETED]),
+        models.TrnPurchaseOrderDetail.qty_ordered > func.coalesce(models.TrnPurchaseOrderDetail.qty_received, 0)
+    )
+    if item_ids is not None:
+        query = query.filter(models.TrnPurchaseOrderDetail.item_id.in_(item_ids))
+
+    receipts: Dict[int, List[tuple]] = {}
+    for item_id, due_date, qty in query.group_by(models.TrnPurchaseOrderDetail.item_id, due).all():
+        receipts.setdefault(item_id, []).append((due_date, Decimal(str(qty or 0))))
+    return receipts
+
+
+class PlanningInputs:
+    """Everything a pass reads besides demand: item master, BOM, on-hand, open POs, low-level codes"""
+
+    def __init__(self, items: Dict[int, object], lines: Dict[int, List[tuple]], production_days: Dict[int, int],
+                 makes: set, on_hand: Dict[int, Decimal], receipts: Dict[int, List[tuple]], codes: Dict[int, int]):
+        self.items = items
+        self.lines = lines
+        self.production_days = production_days
+        self.makes = makes
+        self.on_hand = on_hand
+        self.receipts = receipts
+        self.codes = codes
+
+
+def load_inputs(db: Session, item_ids: Iterable[int] = None) -> PlanningInputs:
+    """Planning inputs of the given items (all items if None)"""
+    if item_ids is not None:
+        item_ids = set(item_ids)
+    lines, production_days, makes = _load_planning_bom(db, item_ids)
+    return PlanningInputs(
+        _load_items(db, item_ids), lines, production_days, makes,
+        _load_on_hand(db, item_ids), _load_open_po(db, item_ids), get_low_level_codes(db, item_ids)
+    )
+
+
+def make_lead_days(db: Session, item_ids: Iterable[int]) -> Dict[int, int]:
+    """Planned order lead time in days per item, as the MRP run offsets it"""
+    item_ids = set(item_ids)
+    items = _load_items(db, item_ids)
+    _, production_days, makes = _load_planning_bom(db, item_ids)
+    return {
+        item_id: lead_days(item, item_id in makes, production_days.get(item_id, 0))
+        for item_id, item in items.items()
+    }
+
+
+# ==================== BUCKETS ====================
+class Buckets:
+    """Time buckets of a run: bucket 0 starts at start_date (past-due demand lands there)"""
+
+    def __init__(self, start_date: date, bucket: str, end_date: date):
+        self.bucket = bucket
+        self.days = BUCKET_DAYS[bucket]
+        self.start_date = self.bucket_start(start_date)
+        self.count = self.index(end_date) + 1
+        self.dates = [self.start_date + timedelta(days=index * self.days) for index in range(self.count)]
+
+    def bucket_start(self, day: date) -> date:
+        if self.days == 7:
+            return day - timedelta(days=day.weekday())
+        return day
+
+    def index(self, day: date) -> int:
+        """Bucket of a date, clamped to bucket 0 for past-due dates"""
+        return max((day - self.start_date).days // self.days, 0)
+
+    def bucket_date(self, index: int) -> date:
+        return self.dates[index]
+
+    def offset(self, lead_days: int) -> int:
+        """Lead time in whole buckets, rounded up"""
+        return -(-int(lead_days or 0) // self.days)
+
+
+def lead_days(item, is_made: bool, production_days: int) -> int:
+    """Planned order lead time: item lead time, plus BOM production time for made items"""
+    return int(item.lead_time_days or 0) + (production_days if is_made else 0)
+
+
+class ItemPlan:
+    """Time-phased record of one item: one list entry per bucket"""
+
+    def __init__(self, item_id: int, count: int, level: int):
+        self.item_id = item_id
+        self.level = level
+        self.gross = [ZERO] * count
+        self.receipts = [ZERO] * count
+        self.planned = [ZERO] * count
+        self.available = [ZERO] * count   # projected on hand entering each bucket
+        self.on_hand = ZERO
+        self.safety_stock = ZERO
+        self.action = models.SuggestedAction.BUY
+        self.lead_days = 0
+
+
+def net_item(plan: ItemPlan):
+    """
+    Lot-for-lot netting across buckets: whenever projected on hand would
+    fall below safety stock a planned receipt restores it. Planned quantities
+    are rounded up to the stored precision so what is exploded to the
+    components is exactly what is written to mrp_results.
+    """
+    projected = plan.on_hand
+    safety = plan.safety_stock
+    gross, receipts, planned, available = plan.gross, plan.receipts, plan.planned, plan.available
+    for index in range(len(gross)):
+        available[index] = projected
+        projected += receipts[index] - gross[index]
+        if projected < safety:
+            qty = (safety - projected).quantize(QTY_PLACES, rounding=ROUND_UP)
+            planned[index] = qty
+            projected += qty
+        else:
+            planned[index] = ZERO
+
+
+# ==================== RUN ====================
+class MRPRun:
+    """Result of an MRP run: item plans keyed by item id plus the bucket calendar"""
+
+    def __init__(self, buckets: Buckets, plans: Dict[int, ItemPlan], items: Dict[int, object], cyclic: List[int]):
+        self.buckets = buckets
+        self.plans = plans
+        self.items = items
+        self.cyclic = cyclic
+
+    def release_date(self, plan: ItemPlan, index: int) -> date:
+        """Planned order release date (due bucket less lead time, not before the horizon)"""
+        return self.buckets.bucket_date(max(index - self.buckets.offset(plan.lead_days), 0))
+
+    def result_rows(self, plan_id: int) -> List[dict]:
+        """mrp_results mappings: one row per item and bucket with demand or a planned order"""
+        rows = []
+        dates = self.buckets.dates
+        for item_id in sorted(self.plans, key=lambda item_id: (self.plans[item_id].level, item_id)):
+            plan = self.plans[item_id]
+            for index, (gross, planned) in enumerate(zip(plan.gross, plan.planned)):
+                if gross <= 0 and planned <= 0:
+                    continue
+                planned = planned.quantize(QTY_PLACES)
+                rows.append({
+                    'plan_id': plan_id,
+                    'item_id': item_id,
+                    'required_date': dates[index],
+                    'gross_requirement': gross.quantize(QTY_PLACES),
+                    'on_hand_qty': plan.available[index].quantize(QTY_PLACES),
+                    'open_po_qty': plan.receipts[index].quantize(QTY_PLACES),
+                    'net_requirement': planned,
+                    'suggested_action': plan.action if planned > 0 else models.SuggestedAction.NONE,
+                    'suggested_qty': planned
+                })
+        return rows
+
+
+def run_mrp(
+    db: Session,
+    demands: Iterable[dict],
+    bucket: str = "day",
+    start_date: Optional[date] = None,
+    progress: Optional[Callable[[int, str], None]] = None
+) -> MRPRun:
+    """
+    Regenerative MRP run over independent demand.
+
+    Args:
+        db: Database session
+        demands: {'item_id', 'required_qty', 'required_date'} rows
+        bucket: 'day' or 'week'
+        start_date: First bucket (today if None); earlier demand is past due
+        progress: Called with (percent, message) as each low-level code is reached
+
+    Returns:
+        MRPRun: Gross requirements, receipts and planned orders per item and bucket
+
+    Raises:
+        ValueError: If bucket is not 'day' or 'week'
+    """
+    if bucket not in BUCKET_DAYS:
+        raise ValueError(f"Invalid bucket. Must be one of: {list(BUCKET_DAYS)}")
+
+    demands = [demand for demand in demands if demand['required_qty'] and demand['required_qty'] > 0]
+    start_date = start_date or date.today()
+    last_date = max([demand['required_date'] for demand in demands], default=start_date)
+    buckets = Buckets(start_date, bucket, last_date)
+
+    gross = [
+        (demand['item_id'], buckets.index(demand['required_date']), demand['required_qty'])
+        for demand in demands
+    ]
+    return _plan(buckets, gross, load_inputs(db), progress)
+
+
+def _plan(
+    buckets: Buckets,
+    gross_requirements: Iterable[tuple],
+    inputs: PlanningInputs,
+    progress: Optional[Callable[[int, str], None]] = None
+) -> MRPRun:
+    """
+    Net and explode in low-level-code order.
+
+    Args:
+        buckets: Bucket calendar of the pass
+        gross_requirements: (item_id, bucket index, qty) demand not coming from
+            a parent planned in this pass
+        inputs: Planning data of every item that can receive demand in this pass
+        progress: Called with (percent of levels netted, message) before each
+            low-level code; a job's progress may raise to stop the pass there
+    """
+    items, lines, production_days, makes = inputs.items, inputs.lines, inputs.production_days, inputs.makes
+    on_hand, receipts, codes = inputs.on_hand, inputs.receipts, inputs.codes
+    plans: Dict[int, ItemPlan] = {}
+
+    def plan_for(item_id: int, level: int) -> ItemPlan:
+        plan = plans.get(item_id)
+        if plan is None:
+            item = items[item_id]
+            plan = ItemPlan(item_id, buckets.count, max(codes.get(item_id, 0), level))
+            plan.on_hand = on_hand.get(item_id, ZERO)
+            plan.safety_stock = Decimal(item.safety_stock or 0)
+            plan.lead_days = lead_days(item, item_id in makes, production_days.get(item_id, 0))
+            if item_id in makes:
+                plan.action = models.SuggestedAction.MAKE
+            for due_date, qty in receipts.get(item_id, []):
+                if due_date is None:
+                    continue
+                index = buckets.index(due_date)
+                if index < buckets.count:
+                    plan.receipts[index] += qty
+            plans[item_id] = plan
+            heapq.heappush(queue, (plan.level, item_id))
+        elif level > plan.level:
+            # Stale low-level code: hold the item back until this parent is netted
+            plan.level = level
+            heapq.heappush(queue, (plan.level, item_id))
+        return plan
+
+    queue: List[tuple] = []
+    for item_id, index, qty in gross_requirements:
+        if item_id not in items:
+            continue
+        plan_for(item_id, 0).gross[index] += qty
+    # Low-level-code order: all parents of an item are netted before it
+    netted = set()
+    cyclic = set()
+    last_level = max(codes.values(), default=0)
+    reported_level = -1
+    while queue:
+        level, item_id = heapq.heappop(queue)
+        if item_id in netted or level != plans[item_id].level:
+            continue
+        if progress is not None and level > reported_level:
+            reported_level = level
+            progress(min(level, last_level) * 100 // (last_level + 1), f"Netting low-level code {level}")
+        plan = plans[item_id]
+        net_item(plan)
+        netted.add(item_id)
+
+        components = lines.get(item_id)
+        if not components:
+            continue
+        orders = [(index, qty) for index, qty in enumerate(plan.planned) if qty > 0]
+        if not orders:
+            continue
+        offset = buckets.offset(plan.lead_days)
+        for child_id, qty_per in components:
+            if child_id not in items:
+                continue
+            if child_id in netted:
+                # Only possible on a circular BOM; the component is not re-planned
+                cyclic.add(child_id)
+                continue
+            child_gross = plan_for(child_id, plan.level + 1).gross
+            for index, qty in orders:
+                child_gross[max(index - offset, 0)] += qty * qty_per
+
+    return MRPRun(buckets, plans, items, sorted(cyclic))
+
+
+# ==================== NET CHANGE ====================
+# Rows whose item's on-hand, open supply or demand they change
+TRACKED_LINES = (
+    models.InventoryTransaction,
+    models.InventoryBalance,
+    models.TrnSalesOrderDetail,
+    models.TrnPurchaseOrderDetail
+)
+# Status or date changes on a head change the demand/supply of all its lines
+TRACKED_HEADS = (models.TrnSalesOrderHead, models.TrnPurchaseOrderHead)
+# Hours change records are kept at least, covering MRP runs still in progress
+MRP_CHANGE_RETENTION_HOURS = int(os.getenv("MRP_CHANGE_RETENTION_HOURS", "24"))
+# How often the scheduler prunes change records when no MRP run does
+MRP_CHANGE_PRUNE_SECONDS = 3600
+
+
+def _record_changes(db: Session, item_ids: Iterable[int]):
+    """One change row per item and transaction: its id orders it against runs, whenever it flushes"""
+    recorded = db.info.setdefault("mrp_changed_items", set())
+    item_ids = set(item_ids) - recorded
+    if not item_ids:
+        return
+    recorded |= item_ids
+    changed_at = get_utc_now()
+    db.add_all([models.MRPItemChange(item_id=item_id, changed_at=changed_at) for item_id in item_ids])
+
+
+def _changed_item_ids(session: Session) -> set:
+    """Items touched by the pending inserts, updates and deletes of tracked rows"""
+    item_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, TRACKED_LINES):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            item_ids.add(obj.item_id)
+            # A line moved to another item changes the old item too
+            item_ids.update(inspect(obj).attrs.item_id.history.deleted or ())
+        elif isinstance(obj, TRACKED_HEADS) and obj not in session.new:
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+                continue
+            item_ids.update(detail.item_id for detail in obj.details)
+    item_ids.discard(None)
+    return item_ids
+
+
+@event.listens_for(Session, "before_flush")
+def _track_mrp_changes(session, flush_context, instances):
+    item_ids = _changed_item_ids(session)
+    if item_ids:
+        _record_changes(session, item_ids)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _reset_recorded_changes(session, transaction):
+    # Each flush ends a subtransaction; only the real transaction (or a savepoint) resets
+    if transaction.parent is None or transaction.nested:
+        session.info.pop("mrp_changed_items", None)
+
+
+def change_mark(db: Session) -> int:
+    """
+    Highest change id a run starting now reflects: every change at or below
+    it is committed (or rolled back), so the data the run reads includes it.
+
+    A change row gets its id when it is inserted but becomes visible at
+    commit, so on PostgreSQL the mark is read under a SHARE lock, which waits
+    for transactions still holding uncommitted change rows; ids handed out
+    afterwards are all above the mark. SQLite has a single writer, so its
+    committed ids never skip an uncommitted lower one.
+    """
+    bind = db.get_bind()
+    highest = select(func.coalesce(func.max(models.MRPItemChange.id), 0))
+    if bind.dialect.name != "postgresql":
+        return db.execute(highest).scalar()
+    if db.info.get("mrp_changed_items"):
+        # This transaction holds change rows itself: lock here (they commit with the run)
+        db.execute(text("LOCK TABLE mrp_item_change IN SHARE MODE"))
+        return db.execute(highest).scalar()
+    # Separate short transaction, so writers are not blocked for the whole run
+    with bind.engine.connect() as connection, connection.begin():
+        connection.execute(text("LOCK TABLE mrp_item_change IN SHARE MODE"))
+        return connection.execute(highest).scalar()
+
+
+def mark_items_changed(db: Session, item_ids: Iterable[int]):
+    """Record stock or order changes written with bulk statements (they bypass the flush hook)"""
+    item_ids = set(item_ids)
+    item_ids.discard(None)
+    if item_ids:
+        _record_changes(db, item_ids)
+
+
+def mark_bom_changed(db: Session, parent_item_ids: Iterable[int]):
+    """
+    Record BOM edits for net-change MRP (bulk inserts bypass the flush hook).
+    The parents and all their components, including removed lines, change.
+    """
+    parent_item_ids = set(parent_item_ids)
+    if not parent_item_ids:
+        return
+    components = {
+        child_id for (child_id,) in db.query(models.MasterBOM.child_item_id).filter(
+            models.MasterBOM.parent_item_id.in_(parent_item_ids)
+        ).distinct().all()
+    }
+    _record_changes(db, parent_item_ids | components)
+
+
+def record_run(db: Session, db_plan: models.ProductionPlan, buckets: Buckets, run_type: str,
+               run_at, change_seq: int, items_planned: int):
+    """
+    Store the run parameters of a plan, change_seq being the change_mark
+    read before the run loaded its inputs, and prune change records
+    """
+    run = db_plan.last_run
+    if run is None:
+        run = models.MRPPlanRun(plan_id=db_plan.id)
+        db_plan.last_run = run
+    run.bucket = buckets.bucket
+    run.start_date = buckets.start_date
+    run.run_type = run_type
+    run.run_at = run_at
+    run.change_seq = change_seq
+    run.items_planned = items_planned
+    db.flush()
+    prune_changes(db)
+
+
+def prune_changes(db: Session) -> int:
+    """
+    Drop the change records no plan still needs: those at or below the
+    lowest change_seq of the calculated plans (the only ones net-change runs
+    accept), or all of them when no plan is calculated. Records younger than
+    MRP_CHANGE_RETENTION_HOURS are kept for runs still in progress, whose
+    marks are not stored yet. Does not commit.
+
+    Returns:
+        int: Number of records dropped
+    """
+    needed_from = db.query(func.min(models.MRPPlanRun.change_seq)).join(
+        models.ProductionPlan, models.ProductionPlan.id == models.MRPPlanRun.plan_id
+    ).filter(models.ProductionPlan.status == 'CALCULATED').scalar()
+    query = db.query(models.MRPItemChange).filter(
+        models.MRPItemChange.changed_at < get_utc_now() - timedelta(hours=MRP_CHANGE_RETENTION_HOURS)
+    )
+    if needed_from is not None:
+        query = query.filter(models.MRPItemChange.id <= needed_from)
+    return query.delete(synchronize_session=False)
+
+
+def run_regenerative(
+    db: Session,
+    db_plan: models.ProductionPlan,
+    bucket: str = "day",
+    progress: Optional[Callable[[int, str], None]] = None
+) -> Tuple[MRPRun, List[dict]]:
+    """
+    Full MRP run of a plan: replaces all its mrp_results and records the run. Does not commit.
+
+    Args:
+        progress: Called with (percent, message) between low-level codes and
+            before the results are written
+
+    Returns:
+        Tuple: (the run, result rows written)
+    """
+    run_at = get_utc_now()
+    change_seq = change_mark(db)
+    level_progress = None
+    if progress is not None:
+        def level_progress(percent: int, message: str):
+            progress(10 + percent * 8 // 10, message)
+    run = run_mrp(db, load_plan_demands(db, db_plan), bucket=bucket, progress=level_progress)
+    if progress is not None:
+        progress(90, "Writing MRP results")
+    return run, _replace_results(db, db_plan, run, "REGENERATIVE", run_at, change_seq)
+
+
+def _replace_results(db: Session, db_plan: models.ProductionPlan, run: MRPRun, run_type: str,
+                     run_at, change_seq: int) -> List[dict]:
+    """Replace all mrp_results of a plan with a run's rows and record the run"""
+    rows = run.result_rows(db_plan.id)
+
+    db.query(models.MRPResult).filter(
+        models.MRPResult.plan_id == db_plan.id
+    ).delete(synchronize_session=False)
+    if rows:
+        db.execute(insert(models.MRPResult), rows)
+
+    record_run(db, db_plan, run.buckets, run_type, run_at, change_seq, len(run.plans))
+    return rows
+
+
+def run_net_change(db: Session, db_plan: models.ProductionPlan) -> dict:
+    """
+    Replan the items changed since the plan's last run and everything below
+    them, keeping the stored mrp_results of all other items. Does not commit.
+
+    Components of unchanged parents get their dependent demand from the
+    parents' stored planned orders, so the result matches a regenerative run
+    on the same bucket calendar.
+
+    Args:
+        db: Database session
+        db_plan: A calculated plan with a recorded run
+
+    Returns:
+        dict: Changed and replanned item counts and result rows written
+    """
+    last_run = db_plan.last_run
+    run_at = get_utc_now()
+    change_seq = change_mark(db)
+    changed = {
+        item_id for (item_id,) in db.query(models.MRPItemChange.item_id).filter(
+            models.MRPItemChange.id > last_run.change_seq,
+            models.MRPItemChange.id <= change_seq
+        ).distinct().all()
+    }
+    affected = set(changed)
+    if changed:
+        affected |= {
+            descendant_id for (descendant_id,) in db.query(models.BOMClosure.descendant_item_id).filter(
+                models.BOMClosure.ancestor_item_id.in_(changed)
+            ).distinct().all()
+        }
+
+    demands = [
+        demand for demand in load_plan_demands(db, db_plan, affected)
+        if demand['required_qty'] and demand['required_qty'] > 0
+    ] if affected else []
+    stored_end = db.query(func.max(models.MRPResult.required_date)).filter(
+        models.MRPResult.plan_id == db_plan.id
+    ).scalar()
+    last_date = max([demand['required_date'] for demand in demands] + [stored_end or last_run.start_date])
+    buckets = Buckets(last_run.start_date, last_run.bucket, last_date)
+
+    gross = [
+        (demand['item_id'], buckets.index(demand['required_date']), demand['required_qty'])
+        for demand in demands
+    ]
+
+    # Dependent demand from parents that are not replanned
+    outside_parents = {
+        parent_id for (parent_id,) in db.query(models.MasterBOM.parent_item_id).filter(
+            models.MasterBOM.child_item_id.in_(affected),
+            models.MasterBOM.is_active == True,
+            models.MasterBOM.status == models.BOMStatus.ACTIVE
+        ).distinct().all()
+    } - affected if affected else set()
+    if outside_parents:
+        parent_items = _load_items(db, outside_parents)
+        parent_lines, parent_days, parent_makes = _load_planning_bom(db, outside_parents)
+        for parent_id, required_date, qty in db.query(
+            models.MRPResult.item_id,
+            models.MRPResult.required_date,
+            models.MRPResult.suggested_qty
+        ).filter(
+            models.MRPResult.plan_id == db_plan.id,
+            models.MRPResult.item_id.in_(outside_parents),
+            models.MRPResult.suggested_qty > 0
+        ).all():
+            components = [line for line in parent_lines.get(parent_id, []) if line[0] in affected]
+            if not components or parent_id not in parent_items:
+                continue
+            offset = buckets.offset(lead_days(
+                parent_items[parent_id], parent_id in parent_makes, parent_days.get(parent_id, 0)
+            ))
+            release = max(buckets.index(required_date) - offset, 0)
+            qty = Decimal(str(qty))
+            gross.extend((child_id, release, qty * qty_per) for child_id, qty_per in components)
+
+    rows = []
+    if affected:
+        run = _plan(buckets, gross, load_inputs(db, affected))
+        rows = run.result_rows(db_plan.id)
+        db.query(models.MRPResult).filter(
+            models.MRPResult.plan_id == db_plan.id,
+            models.MRPResult.item_id.in_(affected)
+        ).delete(synchronize_session=False)
+        if rows:
+            db.execute(insert(models.MRPResult), rows)
+
+    record_run(db, db_plan, buckets, "NET_CHANGE", run_at, change_seq, len(affected))
+    return {
+        "changed_items": len(changed),
+        "items_replanned": len(affected),
+        "results_written": len(rows)
+    }
+
+
+# ==================== SCENARIOS ====================
+# Summary figures compared against the baseline
+SUMMARY_FIGURES = (
+    "items_planned", "make_orders", "make_qty", "buy_orders", "buy_qty",
+    "planned_purchase_value", "past_due_orders"
+)
+
+
+def _load_scope(db: Session, root_item_ids: Iterable[int]) -> PlanningInputs:
+    """Planning inputs of the given items and every component below them, one BOM query per level"""
+    scope = set()
+    lines: Dict[int, List[tuple]] = {}
+    production_days: Dict[int, int] = {}
+    makes = set()
+    frontier = set(root_item_ids)
+    while frontier:
+        scope |= frontier
+        level_lines, level_days, level_makes = _load_planning_bom(db, frontier)
+        lines.update(level_lines)
+        production_days.update(level_days)
+        makes |= level_makes
+        frontier = {child_id for children in level_lines.values() for child_id, _ in children} - scope
+    return PlanningInputs(
+        _load_items(db, scope), lines, production_days, makes,
+        _load_on_hand(db, scope), _load_open_po(db, scope), get_low_level_codes(db, scope)
+    )
+
+
+def _overlay_item_ids(scenario: dict) -> set:
+    item_ids = {change['item_id'] for key in ('demand', 'inventory', 'items') for change in scenario.get(key) or []}
+    for change in scenario.get('bom') or []:
+        item_ids.update((change['parent_item_id'], change['child_item_id']))
+    return item_ids
+
+
+def apply_overlay(base: PlanningInputs, scenario: dict) -> PlanningInputs:
+    """
+    Planning inputs with a scenario's changes on top. Only the dicts a change
+    touches are copied, so base stays intact and can serve every scenario.
+
+    Args:
+        base: Inputs covering every item the scenario mentions
+        scenario: 'inventory' [{item_id, qty_change, receipt_date}] (no date =
+            on-hand adjustment, else a scheduled receipt), 'bom' [{parent_item_id,
+            child_item_id, qty_per}] (qty_per None removes the line), 'items'
+            [{item_id, lead_time_days, safety_stock, standard_cost}] (None keeps
+            the item master value)
+
+    Raises:
+        ValueError: If a change refers to an item that does not exist
+    """
+    missing = sorted(_overlay_item_ids(scenario) - set(base.items))
+    if missing:
+        raise ValueError(f"Items not found: {missing}")
+
+    inputs = PlanningInputs(
+        base.items, base.lines, base.production_days, base.makes,
+        base.on_hand, base.receipts, base.codes
+    )
+
+    if scenario.get('inventory'):
+        inputs.on_hand = dict(base.on_hand)
+        inputs.receipts = dict(base.receipts)
+        for change in scenario['inventory']:
+            item_id, qty = change['item_id'], Decimal(str(change['qty_change']))
+            if change.get('receipt_date') is None:
+                inputs.on_hand[item_id] = inputs.on_hand.get(item_id, ZERO) + qty
+            else:
+                inputs.receipts[item_id] = inputs.receipts.get(item_id, []) + [(change['receipt_date'], qty)]
+
+    if scenario.get('items'):
+        inputs.items = dict(base.items)
+        for change in scenario['items']:
+            item = SimpleNamespace(**inputs.items[change['item_id']]._asdict())
+            for field in ('lead_time_days', 'safety_stock', 'standard_cost'):
+                if change.get(field) is not None:
+                    setattr(item, field, change[field])
+            inputs.items[change['item_id']] = item
+
+    if scenario.get('bom'):
+        inputs.lines = dict(base.lines)
+        inputs.makes = set(base.makes)
+        for change in scenario['bom']:
+            parent_id, child_id = change['parent_item_id'], change['child_item_id']
+            parent_lines = [line for line in inputs.lines.get(parent_id, []) if line[0] != child_id]
+            if change.get('qty_per'):
+                parent_lines.append((child_id, Decimal(str(change['qty_per']))))
+                inputs.makes.add(parent_id)
+            inputs.lines[parent_id] = parent_lines
+        # Changed structure: codes from the overlay BOM, not the stored table
+        codes, _ = compute_low_level_codes({
+            parent_id: [child_id for child_id, _ in parent_lines]
+            for parent_id, parent_lines in inputs.lines.items()
+        })
+        inputs.codes = codes
+
+    return inputs
+
+
+def _scenario_gross(buckets: Buckets, demands: List[dict], changes: List[dict]) -> List[tuple]:
+    """Gross requirements per item and bucket after demand changes, never below zero"""
+    gross: Dict[tuple, Decimal] = {}
+    for item_id, required_date, qty in [
+        (demand['item_id'], demand['required_date'], demand['required_qty']) for demand in demands
+    ] + [
+        (change['item_id'], change['required_date'], Decimal(str(change['qty_change']))) for change in changes
+    ]:
+        key = (item_id, buckets.index(required_date))
+        gross[key] = gross.get(key, ZERO) + qty
+    return [
+        (item_id, index, qty) for (item_id, index), qty in gross.items()
+        if qty > 0 and index < buckets.count
+    ]
+
+
+def summarize_run(run: MRPRun, include_orders: bool = False) -> dict:
+    """Planned order totals of a run, optionally with the planned orders themselves"""
+    summary = {
+        "items_planned": len(run.plans),
+        "make_orders": 0,
+        "make_qty": ZERO,
+        "buy_orders": 0,
+        "buy_qty": ZERO,
+        "planned_purchase_value": ZERO,
+        "past_due_orders": 0,
+        "cyclic_items": run.cyclic
+    }
+    orders = []
+    dates = run.buckets.dates
+    for item_id in sorted(run.plans, key=lambda item_id: (run.plans[item_id].level, item_id)):
+        plan = run.plans[item_id]
+        item = run.items[item_id]
+        offset = run.buckets.offset(plan.lead_days)
+        for index, qty in enumerate(plan.planned):
+            if qty <= 0:
+                continue
+            if plan.action == models.SuggestedAction.MAKE:
+                summary["make_orders"] += 1
+                summary["make_qty"] += qty
+            else:
+                summary["buy_orders"] += 1
+                summary["buy_qty"] += qty
+                summary["planned_purchase_value"] += qty * Decimal(str(item.standard_cost or 0))
+            if index < offset:
+                summary["past_due_orders"] += 1
+            if include_orders:
+                orders.append({
+                    "item_id": item_id,
+                    "item_code": item.item_code,
+                    "action": plan.action.value,
+                    "quantity": float(qty.quantize(QTY_PLACES)),
+                    "due_date": dates[index].isoformat(),
+                    "release_date": run.release_date(plan, index).isoformat()
+                })
+    for key in ("make_qty", "buy_qty", "planned_purchase_value"):
+        summary[key] = float(summary[key].quantize(QTY_PLACES))
+    if include_orders:
+        summary["orders"] = orders
+    return summary
+
+
+def _scenario_buckets(bucket: str, demands: List[dict], scenarios: List[dict]) -> Buckets:
+    if bucket not in BUCKET_DAYS:
+        raise ValueError(f"Invalid bucket. Must be one of: {list(BUCKET_DAYS)}")
+    start_date = date.today()
+    dates = [demand['required_date'] for demand in demands] + [
+        change['required_date'] for scenario in scenarios for change in scenario.get('demand') or []
+        if change['qty_change'] > 0
+    ]
+    return Buckets(start_date, bucket, max(dates, default=start_date))
+
+
+def simulate_scenarios(
+    db: Session,
+    db_plan: models.ProductionPlan,
+    scenarios: List[dict],
+    bucket: str = "day",
+    include_baseline: bool = True,
+    include_orders: bool = False
+) -> List[dict]:
+    """
+    Run what-if scenarios of a plan in memory. Nothing is written.
+
+    The plan's demand and the planning inputs of every item it or any
+    scenario can reach are loaded once; each scenario then plans on its own
+    overlay of those inputs (see apply_overlay), on one shared bucket calendar.
+
+    Args:
+        db: Database session
+        db_plan: Plan whose demand the scenarios start from
+        scenarios: {'scenario_name', 'demand': [{item_id, required_date,
+            qty_change}], 'inventory', 'bom', 'items'} (see apply_overlay)
+        bucket: 'day' or 'week'
+        include_baseline: Also plan the unchanged inputs, and report every
+            scenario's difference to them
+        include_orders: Add the planned orders to each summary
+
+    Returns:
+        List[dict]: {'scenario_name', 'summary', 'vs_baseline'} per scenario,
+        the baseline (scenario_name None) first
+
+    Raises:
+        ValueError: If bucket is invalid or a change refers to an unknown item
+    """
+    demands = [
+        demand for demand in load_plan_demands(db, db_plan)
+        if demand['required_qty'] and demand['required_qty'] > 0
+    ]
+    buckets = _scenario_buckets(bucket, demands, scenarios)
+    roots = {demand['item_id'] for demand in demands}
+    for scenario in scenarios:
+        roots |= _overlay_item_ids(scenario)
+    base = _load_scope(db, roots)
+
+    results = []
+    baseline = None
+    if include_baseline:
+        baseline = summarize_run(_plan(buckets, _scenario_gross(buckets, demands, []), base), include_orders)
+        results.append({"scenario_name": None, "summary": baseline, "vs_baseline": None})
+    for scenario in scenarios:
+        inputs = apply_overlay(base, scenario)
+        summary = summarize_run(
+            _plan(buckets, _scenario_gross(buckets, demands, scenario.get('demand') or []), inputs),
+            include_orders
+        )
+        results.append({
+            "scenario_name": scenario.get('scenario_name'),
+            "summary": summary,
+            "vs_baseline": {
+                key: round(summary[key] - baseline[key], 4) for key in SUMMARY_FIGURES
+            } if baseline is not None else None
+        })
+    return results
+
+
+def run_scenario(
+    db: Session,
+    db_plan: models.ProductionPlan,
+    scenario: dict,
+    bucket: str = "day"
+) -> Tuple[MRPRun, List[dict]]:
+    """
+    Plan a scenario and store it as the plan's mrp_results, ready for
+    process_plan. Does not commit.
+
+    Returns:
+        Tuple: (the run, result rows written)
+    """
+    run_at = get_utc_now()
+    change_seq = change_mark(db)
+    demands = [
+        demand for demand in load_plan_demands(db, db_plan)
+        if demand['required_qty'] and demand['required_qty'] > 0
+    ]
+    buckets = _scenario_buckets(bucket, demands, [scenario])
+    base = _load_scope(db, {demand['item_id'] for demand in demands} | _overlay_item_ids(scenario))
+    run = _plan(
+        buckets,
+        _scenario_gross(buckets, demands, scenario.get('demand') or []),
+        apply_overlay(base, scenario)
+    )
+    return run, _replace_results(db, db_plan, run, "SCENARIO", run_at, change_seq)
@@ -0,0 +1,238 @@
+"""
+Production Calendar
+Per-day aggregates of production plans and work orders for the planning
+calendar: plan quantity of plans not yet processed, work order quantity and
+count, and overdue open work orders, grouped by item or by machine.
+
+Windows are served from an in-process cache keyed by a calendar version
+stamp. Session listeners bump the stamp after any committed write to
+production plans, plan items or work orders (ORM flushes and bulk
+statements alike), so writes made through this process show at once. The
+stamp is not shared between processes (several API workers, the standalone
+job worker), so entries also expire after CALENDAR_CACHE_SECONDS: writes
+made elsewhere show within that time.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import case, event, func, literal, select, union_all
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from itertools import chain
+from typing import Dict, List
+import os
+import threading
+import time
+import models
+from services import bom_engine
+from services.capacity_planning import load_routings
+
+
+# Windows kept in the cache (least recently used dropped first)
+CALENDAR_CACHE_SIZE = 64
+# Seconds a cached window is served; bounds staleness from writes of other processes
+CALENDAR_CACHE_SECONDS = int(os.getenv("PRODUCTION_CALENDAR_CACHE_SECONDS", "30"))
+# Longest window one request may ask for
+CALENDAR_MAX_DAYS = 366
+
+GROUP_BY = ("item", "machine")
+OPEN_STATUSES = (models.JobStatus.PLANNED, models.JobStatus.IN_PROGRESS)
+CALENDAR_MODELS = (models.ProductionPlan, models.ProductionPlanItem, models.TrnJobOrderHead)
+FIGURES = ("plan_qty", "wo_qty", "wo_count", "overdue_count")
+
+_cache_lock = threading.Lock()
+_calendar_version = 0
+_calendar_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+
+# ==================== INVALIDATION ====================
+def bump_calendar_version() -> int:
+    """Drop every cached window"""
+    global _calendar_version
+    with _cache_lock:
+        _calendar_version += 1
+        _calendar_cache.clear()
+        return _calendar_version
+
+
+@event.listens_for(Session, "before_flush")
+def _track_calendar_flush(session, flush_context, instances):
+    if any(isinstance(obj, CALENDAR_MODELS) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info["calendar_changed"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_calendar_statements(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and issubclass(mapper.class_, CALENDAR_MODELS):
+        orm_execute_state.session.info["calendar_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_calendar(session):
+    if session.info.pop("calendar_changed", False):
+        bump_calendar_version()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_calendar_changes(session):
+    session.info.pop("calendar_changed", None)
+
+
+# ==================== AGGREGATES ====================
+def _daily_item_totals(db: Session, date_from: date, date_to: date, today: date) -> list:
+    """(day, item_id, item_code, item_name, plan_qty, wo_qty, wo_count, overdue_count) rows"""
+    wo_day = func.coalesce(models.TrnJobOrderHead.end_date, models.TrnJobOrderHead.start_date)
+    work_orders = select(
+        wo_day.label("day"),
+        models.TrnJobOrderHead.item_id.label("item_id"),
+        literal(0).label("plan_qty"),
+        models.TrnJobOrderHead.qty_planned.label("wo_qty"),
+        literal(1).label("wo_count"),
+        case(
+            (models.TrnJobOrderHead.status.in_(OPEN_STATUSES) & (wo_day < today), 1),
+            else_=0
+        ).label("overdue_count")
+    ).where(
+        models.TrnJobOrderHead.status != models.JobStatus.CANCELLED,
+        wo_day.between(date_from, date_to)
+    )
+    plan_items = select(
+        models.ProductionPlanItem.delivery_date.label("day"),
+        models.ProductionPlanItem.item_id.label("item_id"),
+        models.ProductionPlanItem.quantity.label("plan_qty"),
+        literal(0).label("wo_qty"),
+        literal(0).label("wo_count"),
+        literal(0).label("overdue_count")
+    ).join(
+        models.ProductionPlan, models.ProductionPlan.id == models.ProductionPlanItem.plan_id
+    ).where(
+        models.ProductionPlan.status != 'PROCESSED',
+        models.ProductionPlanItem.delivery_date.between(date_from, date_to)
+    )
+    entries = union_all(work_orders, plan_items).subquery()
+
+    return db.execute(
+        select(
+            entries.c.day,
+            entries.c.item_id,
+            models.MasterItem.item_code,
+            models.MasterItem.item_name,
+            func.sum(entries.c.plan_qty),
+            func.sum(entries.c.wo_qty),
+            func.sum(entries.c.wo_count),
+            func.sum(entries.c.overdue_count)
+        ).join(
+            models.MasterItem, models.MasterItem.id == entries.c.item_id
+        ).group_by(
+            entries.c.day, entries.c.item_id, models.MasterItem.item_code, models.MasterItem.item_name
+        ).order_by(entries.c.day, models.MasterItem.item_code)
+    ).all()
+
+
+def _build_calendar(db: Session, date_from: date, date_to: date, group_by: str, today: date) -> dict:
+    rows = _daily_item_totals(db, date_from, date_to, today)
+
+    routings: Dict[int, List[tuple]] = {}
+    machines: Dict[int, object] = {}
+    if group_by == "machine" and rows:
+        routings = load_routings(db, {row[1] for row in rows})
+        machine_ids = {machine_id for routing in routings.values() for machine_id, _ in routing}
+        machines = {
+            machine.id: machine for machine in db.query(
+                models.MasterMachine.id, models.MasterMachine.machine_code, models.MasterMachine.machine_name
+            ).filter(models.MasterMachine.id.in_(machine_ids)).all()
+        } if machine_ids else {}
+
+    days: "OrderedDict[date, dict]" = OrderedDict()
+    for day, item_id, item_code, item_name, plan_qty, wo_qty, wo_count, overdue_count in rows:
+        values = {
+            "plan_qty": Decimal(str(plan_qty or 0)),
+            "wo_qty": Decimal(str(wo_qty or 0)),
+            "wo_count": int(wo_count or 0),
+            "overdue_count": int(overdue_count or 0)
+        }
+        entry = days.get(day)
+        if entry is None:
+            entry = days[day] = {"date": day, "groups": OrderedDict(), **{key: 0 for key in FIGURES}}
+        for key in FIGURES:
+            entry[key] += values[key]
+
+        if group_by == "item":
+            targets = [(item_id, item_code, item_name)]
+        else:
+            targets = [
+                (machine_id, machines[machine_id].machine_code, machines[machine_id].machine_name)
+                for machine_id, _ in routings.get(item_id, []) if machine_id in machines
+            ] or [(None, None, "Unassigned")]
+        for group_id, code, name in targets:
+            group = entry["groups"].get(group_id)
+            if group is None:
+                group = entry["groups"][group_id] = {
+                    "id": group_id, "code": code, "name": name, **{key: 0 for key in FIGURES}
+                }
+            for key in FIGURES:
+                group[key] += values[key]
+
+    for entry in days.values():
+        for target in chain([entry], entry["groups"].values()):
+            for key in ("plan_qty", "wo_qty"):
+                target[key] = float(target[key])
+        entry["groups"] = list(entry["groups"].values())
+
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "group_by": group_by,
+        "days": list(days.values())
+    }
+
+
+def get_calendar(db: Session, date_from: date, date_to: date, group_by: str = "item") -> dict:
+    """
+    Per-day plan and work order aggregates for a window, from cache when possible.
+
+    Args:
+        db: Database session
+        date_from: First day of the window
+        date_to: Last day of the window
+        group_by: 'item' or 'machine' (machines from the item's BOM routing;
+            an item on several machines counts on each)
+
+    Returns:
+        dict: Days with any plan or work order, each with totals and per-group figures
+
+    Raises:
+        ValueError: If the window or group_by is invalid
+    """
+    if group_by not in GROUP_BY:
+        raise ValueError(f"Invalid group_by. Must be one of: {list(GROUP_BY)}")
+    if date_to < date_from:
+        raise ValueError("date_to must not be before date_from")
+    if (date_to - date_from).days + 1 > CALENDAR_MAX_DAYS:
+        raise ValueError(f"Window cannot exceed {CALENDAR_MAX_DAYS} days")
+
+    today = date.today()
+    # Read the versions before loading so a concurrent write can only make this entry stale
+    version = _calendar_version
+    bom_version = bom_engine.get_bom_version() if group_by == "machine" else None
+    key = (version, bom_version, today, date_from, date_to, group_by)
+    with _cache_lock:
+        cached = _calendar_cache.get(key)
+        if cached is not None:
+            expires_at, calendar = cached
+            if time.monotonic() < expires_at:
+                _calendar_cache.move_to_end(key)
+                return calendar
+            del _calendar_cache[key]
+
+    expires_at = time.monotonic() + CALENDAR_CACHE_SECONDS
+    calendar = _build_calendar(db, date_from, date_to, group_by, today)
+
+    with _cache_lock:
+        if version == _calendar_version:
+            _calendar_cache[key] = (expires_at, calendar)
+            while len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+                _calendar_cache.popitem(last=False)
+    return calendar
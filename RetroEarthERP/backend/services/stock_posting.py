@@ -0,0 +1,236 @@
+"""
+Stock Transaction Posting
+Posts a receipt or issue document with a fixed number of queries however
+many lines it has: item, warehouse and location codes are resolved with one
+query each, all affected inventory_balance rows are prefetched with one
+keyed query, every line is validated before anything is written, and
+transactions and cost layers are written with bulk statements. Balances
+are upserted through services/inventory_balance.py and issues consume FIFO
+cost layers through services/fifo_engine.py.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import insert, or_
+from decimal import Decimal
+from typing import Dict, List, Tuple
+import models
+from services import fifo_engine, inventory_balance, inventory_snapshot
+
+
+TRANSACTION_TYPES = ('receipt', 'issue')
+
+ZERO = Decimal("0")
+
+
+class StockPostingError(ValueError):
+    """Lines of a stock document failed validation; nothing was posted"""
+
+    def __init__(self, errors: List[dict]):
+        self.errors = errors
+        super().__init__(f"Transaction rejected: {len(errors)} line(s) have errors")
+
+
+def _resolve_items(db: Session, codes: List[str]) -> Tuple[Dict[str, object], Dict[int, object]]:
+    """Items by code and by id (the stock form sends item ids as codes), one query"""
+    ids = {int(code) for code in codes if code.isdigit()}
+    query = db.query(
+        models.MasterItem.id,
+        models.MasterItem.item_code,
+        models.MasterItem.lot_control,
+        models.MasterItem.standard_cost
+    )
+    condition = models.MasterItem.item_code.in_(set(codes))
+    if ids:
+        condition = or_(condition, models.MasterItem.id.in_(ids))
+    rows = query.filter(condition).all()
+    return {row.item_code: row for row in rows}, {row.id: row for row in rows}
+
+
+def _load_balances(db: Session, keys: set) -> Dict[tuple, object]:
+    """Existing balance rows of the given keys, one query"""
+    balances: Dict[tuple, object] = {}
+    if not keys:
+        return balances
+    for row in db.query(
+        models.InventoryBalance.id,
+        models.InventoryBalance.item_id,
+        models.InventoryBalance.warehouse_id,
+        models.InventoryBalance.location_id,
+        models.InventoryBalance.lot_number,
+        models.InventoryBalance.qty_on_hand,
+        models.InventoryBalance.avg_cost
+    ).filter(
+        models.InventoryBalance.item_id.in_({key[0] for key in keys}),
+        models.InventoryBalance.warehouse_id.in_({key[1] for key in keys})
+    ).order_by(models.InventoryBalance.id).all():
+        key = inventory_balance.balance_key(row.item_id, row.warehouse_id, row.location_id, row.lot_number)
+        if key in keys:
+            balances[key] = row
+    return balances
+
+
+def validate_lines(db: Session, transaction) -> Tuple[List[dict], List[dict], Dict[tuple, object]]:
+    """
+    Resolve and validate every line of a stock document.
+
+    Args:
+        db: Database session
+        transaction: schemas.StockTransactionCreate
+
+    Returns:
+        Tuple: (resolved lines, per-line error entries, balances by key read for an issue)
+    """
+    lines = transaction.items
+    items_by_code, items_by_id = _resolve_items(db, [line.item_code for line in lines])
+    warehouses = {
+        row.warehouse_code: row.id for row in db.query(
+            models.MasterWarehouse.id, models.MasterWarehouse.warehouse_code
+        ).filter(models.MasterWarehouse.warehouse_code.in_({line.warehouse_code for line in lines})).all()
+    }
+    location_codes = {line.location_code for line in lines if line.location_code}
+    locations = {
+        (row.warehouse_id, row.location_code): row.id for row in db.query(
+            models.LocationMaster.id, models.LocationMaster.warehouse_id, models.LocationMaster.location_code
+        ).filter(
+            models.LocationMaster.location_code.in_(location_codes),
+            models.LocationMaster.warehouse_id.in_(set(warehouses.values()))
+        ).all()
+    } if location_codes and warehouses else {}
+
+    resolved = []
+    errors = []
+    for line_no, line in enumerate(lines, start=1):
+        line_errors = []
+        item = items_by_code.get(line.item_code)
+        if item is None and line.item_code.isdigit():
+            item = items_by_id.get(int(line.item_code))
+        if item is None:
+            line_errors.append(f"Item not found: {line.item_code}")
+        warehouse_id = warehouses.get(line.warehouse_code)
+        if warehouse_id is None:
+            line_errors.append(f"Warehouse not found: {line.warehouse_code}")
+        location_id = None
+        if line.location_code and warehouse_id is not None:
+            location_id = locations.get((warehouse_id, line.location_code))
+            if location_id is None:
+                line_errors.append(f"Location not found: {line.location_code} in warehouse {line.warehouse_code}")
+        if item is not None and item.lot_control and not line.lot_number:
+            line_errors.append(f"Item {line.item_code} requires Lot Number")
+        if line.qty <= 0:
+            line_errors.append("Quantity must be greater than 0")
+
+        if line_errors:
+            errors.append({"line": line_no, "item_code": line.item_code, "errors": line_errors})
+            continue
+        resolved.append({
+            "line": line_no,
+            "item": item,
+            "key": inventory_balance.balance_key(item.id, warehouse_id, location_id, line.lot_number),
+            "qty": line.qty
+        })
+
+    # Issues: running availability per key, so two lines cannot issue the same stock
+    balances = {}
+    if transaction.type == 'issue':
+        balances = _load_balances(db, {line["key"] for line in resolved})
+        available = {key: balance.qty_on_hand or ZERO for key, balance in balances.items()}
+        for line in resolved:
+            on_hand = available.get(line["key"], ZERO)
+            if on_hand < line["qty"]:
+                errors.append({
+                    "line": line["line"],
+                    "item_code": line["item"].item_code,
+                    "errors": [f"Insufficient inventory. Available: {on_hand}, Requested: {line['qty']}"]
+                })
+            else:
+                available[line["key"]] = on_hand - line["qty"]
+        errors.sort(key=lambda error: error["line"])
+
+    return resolved, errors, balances
+
+
+def post_stock_transaction(db: Session, transaction, user_id: int) -> dict:
+    """
+    Validate and post a receipt or issue document. Does not commit.
+
+    Receipts open a cost layer at the item's standard cost and update the
+    balance's moving average; issues consume FIFO layers (a shortfall in
+    layers does not block the issue) and reduce the balance. Every
+    transaction records its unit cost for period snapshots.
+
+    Args:
+        db: Database session
+        transaction: schemas.StockTransactionCreate
+        user_id: Posting user
+
+    Returns:
+        dict: Lines posted and transaction ids
+
+    Raises:
+        ValueError: If the transaction type is unknown
+        StockPostingError: If any line fails validation (all lines are reported)
+    """
+    if transaction.type not in TRANSACTION_TYPES:
+        raise ValueError(f"Invalid transaction type. Must be one of: {list(TRANSACTION_TYPES)}")
+
+    resolved, errors, balances = validate_lines(db, transaction)
+    if errors:
+        raise StockPostingError(errors)
+    if not resolved:
+        return {"lines_posted": 0, "transaction_ids": []}
+
+    transaction_date = transaction.transaction_date
+    receipt_date = transaction_date.date() if hasattr(transaction_date, 'date') else transaction_date
+    # A backdated posting makes the snapshots of its period and later ones stale
+    inventory_snapshot.invalidate_from(db, receipt_date)
+
+    # Receipts cost the item's standard cost; issues what FIFO consumed
+    changes = []
+    unit_costs = []
+    for line in resolved:
+        key, qty = line["key"], line["qty"]
+        if transaction.type == 'receipt':
+            unit_cost = line["item"].standard_cost or ZERO
+            changes.append((key, qty, unit_cost))
+        else:
+            try:
+                _, unit_cost = fifo_engine.issue_fifo(db, key[0], key[1], key[2], qty, key[3])
+            except ValueError:
+                # No or too few cost layers: the quantity is issued all the same, at the moving average
+                unit_cost = balances[key].avg_cost if key in balances else None
+            changes.append((key, -qty, None))
+        unit_costs.append(unit_cost)
+
+    transaction_ids = list(db.scalars(
+        insert(models.InventoryTransaction).returning(
+            models.InventoryTransaction.id, sort_by_parameter_order=True
+        ),
+        [{
+            "transaction_date": transaction_date,
+            "item_id": line["key"][0],
+            "warehouse_id": line["key"][1],
+            "location_id": line["key"][2],
+            "lot_number": line["key"][3],
+            "transaction_type": transaction.type,
+            "reference_no": transaction.reference_no,
+            "qty": line["qty"],
+            "unit_cost": unit_cost,
+            "created_by": user_id
+        } for line, unit_cost in zip(resolved, unit_costs)]
+    ))
+
+    if transaction.type == 'receipt':
+        db.execute(insert(models.InventoryCostLayer), [
+            {
+                "item_id": line["key"][0],
+                "warehouse_id": line["key"][1],
+                "location_id": line["key"][2],
+                "lot_number": line["key"][3],
+                "receipt_date": receipt_date,
+                "qty_remaining": line["qty"],
+                "unit_cost": unit_cost,
+                "receipt_transaction_id": transaction_id
+            }
+            for line, unit_cost, transaction_id in zip(resolved, unit_costs, transaction_ids)
+        ])
+    inventory_balance.post_balance_changes(db, changes)
+    return {"lines_posted": len(resolved), "transaction_ids": transaction_ids}
@@ -0,0 +1,111 @@
+"""
+Shared fixtures: the app on a throwaway SQLite database, reset for every test
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# Must be set before database.py is imported
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+import main
+import models
+from auth import create_access_token
+from database import Base, SessionLocal, engine
+
+
+@pytest.fixture(autouse=True)
+def fresh_database():
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    yield
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def client():
+    # Not entered as a context manager: startup hooks (job workers) stay off
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def admin_headers(db):
+    db.add(models.User(
+        username="admin", email="admin@example.com", password_hash="x",
+        full_name="Admin", role=models.UserRole.ADMIN
+    ))
+    db.commit()
+    return {"Authorization": f"Bearer {create_access_token({'sub': 'admin'})}"}
+
+
+@pytest.fixture
+def count_queries():
+    """Context manager yielding a one-item list that holds the number of statements run inside it"""
+    @contextmanager
+    def counter():
+        count = [0]
+
+        def before_cursor_execute(*args):
+            count[0] += 1
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield count
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return counter
+
+
+def add_items(db, count: int, prefix: str = "IT") -> list:
+    items = [
+        models.MasterItem(
+            item_code=f"{prefix}{n:04d}", item_name=f"Item {prefix}{n}",
+            item_type=models.ItemType.COMPONENT, unit_of_measure="PCS", standard_cost=Decimal(1)
+        )
+        for n in range(count)
+    ]
+    db.add_all(items)
+    db.flush()
+    return items
+
+
+def add_bom_line(db, parent, child, **fields) -> models.MasterBOM:
+    line = models.MasterBOM(
+        parent_item_id=parent.id, child_item_id=child.id, quantity=Decimal(1),
+        revision=1, status=models.BOMStatus.ACTIVE, is_active=True, **fields
+    )
+    db.add(line)
+    return line
+
+
+def calculated_plan(client, headers, db) -> tuple:
+    """A MANUAL plan for a made item with one bought component, calculated through the API"""
+    finished, component = add_items(db, 2)
+    add_bom_line(db, finished, component)
+    plan = models.ProductionPlan(plan_name="Test plan", source_type="MANUAL", created_by=1)
+    db.add(plan)
+    db.flush()
+    db.add(models.ProductionPlanItem(
+        plan_id=plan.id, item_id=finished.id, quantity=Decimal(10), delivery_date=date.today() + timedelta(days=14)
+    ))
+    db.commit()
+    response = client.post(f"/api/planning/{plan.id}/calculate", headers=headers)
+    assert response.status_code == 200, response.text
+    return plan, finished, component
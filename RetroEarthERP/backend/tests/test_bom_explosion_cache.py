@@ -0,0 +1,47 @@
+"""
+Explosion cache invalidation: item master edits in this process drop
+cached explosions at once, writes made elsewhere show once entries expire.
+"""
+from sqlalchemy import text
+import models
+from services import bom_engine
+from conftest import add_bom_line, add_items
+
+
+def child_names(db, parent) -> list:
+    return [line["item_name"] for line in bom_engine.get_explosion(db, parent.id).lines(1)]
+
+
+def test_item_edit_invalidates_cached_explosions(db):
+    parent, child = add_items(db, 2)
+    add_bom_line(db, parent, child)
+    db.commit()
+    assert child_names(db, parent) == [child.item_name]
+
+    child.item_name = "Renamed"
+    db.commit()
+    assert child_names(db, parent) == ["Renamed"]
+
+    db.query(models.MasterItem).filter(models.MasterItem.id == child.id).update(
+        {"item_name": "Bulk renamed"}, synchronize_session=False
+    )
+    db.commit()
+    assert child_names(db, parent) == ["Bulk renamed"]
+
+
+def test_writes_of_other_processes_show_after_expiry(db, monkeypatch):
+    parent, child = add_items(db, 2)
+    add_bom_line(db, parent, child)
+    db.commit()
+    assert child_names(db, parent) == [child.item_name]
+
+    # Another process: plain SQL on its own connection, unseen by this process's listeners
+    with db.get_bind().begin() as connection:
+        connection.execute(text("UPDATE master_items SET item_name = 'Elsewhere' WHERE id = :id"), {"id": child.id})
+    assert child_names(db, parent) == [child.item_name]
+
+    now = bom_engine.time.monotonic()
+    monkeypatch.setattr(bom_engine.time, "monotonic", lambda: now + bom_engine.EXPLOSION_CACHE_SECONDS + 1)
+    db.expire_all()
+    assert child_names(db, parent) == ["Elsewhere"]
+    assert bom_engine.get_explosions(db, [(parent.id, None)])[0].lines(1)[0]["item_name"] == "Elsewhere"
@@ -0,0 +1,84 @@
+"""
+Statements per request for the paged BOM endpoints: referenced items and
+locations are loaded per page, so the count must not grow with page size
+or with the number of BOM lines.
+"""
+import pytest
+import models
+from conftest import add_bom_line, add_items
+
+
+def seed_boms(db, parents: int, children: int, prefix: str = "P") -> list:
+    """parents x children BOM lines, each line with its own child item and locations"""
+    warehouse = models.MasterWarehouse(warehouse_code=f"WH{prefix}", warehouse_name="Main")
+    db.add(warehouse)
+    db.flush()
+    parent_items = add_items(db, parents, prefix)
+    child_items = add_items(db, parents * children, f"{prefix}C")
+    locations = [
+        models.LocationMaster(warehouse_id=warehouse.id, location_code=f"{prefix}L{n}", zone_type="STORE")
+        for n in range(len(child_items))
+    ]
+    db.add_all(locations)
+    db.flush()
+    for n, child in enumerate(child_items):
+        add_bom_line(
+            db, parent_items[n // children], child, sequence_order=n % children,
+            production_location_id=locations[n].id, storage_location_id=locations[-1 - n].id
+        )
+    db.commit()
+    return parent_items
+
+
+def statements(client, headers, count_queries, method: str, path: str, **kwargs) -> tuple:
+    with count_queries() as count:
+        response = client.request(method, path, headers=headers, **kwargs)
+    assert response.status_code == 200, response.text
+    return count[0], response
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/api/bom/", {}),
+    ("/api/bom/search", {"child_search": "PC"}),
+])
+def test_list_pages_run_a_constant_number_of_statements(client, admin_headers, db, count_queries, path, params):
+    seed_boms(db, parents=20, children=5)
+
+    counts = set()
+    for limit in (1, 10, 100):
+        count, response = statements(client, admin_headers, count_queries, "GET", path, params={**params, "limit": limit})
+        assert len(response.json()) == limit
+        counts.add(count)
+    # Paging through every line page by page
+    for skip in range(0, 100, 25):
+        count, response = statements(
+            client, admin_headers, count_queries, "GET", path, params={**params, "skip": skip, "limit": 25}
+        )
+        assert len(response.json()) == 25
+        assert all(row["child_item_code"] and row["production_location_code"] for row in response.json())
+        counts.add(count)
+    assert len(counts) == 1, counts
+
+
+def test_parent_lines_run_a_constant_number_of_statements(client, admin_headers, db, count_queries):
+    small, = seed_boms(db, parents=1, children=1, prefix="S")
+    large, = seed_boms(db, parents=1, children=60, prefix="L")
+
+    small_count, response = statements(client, admin_headers, count_queries, "GET", f"/api/bom/parent/{small.id}")
+    assert len(response.json()) == 1
+    large_count, response = statements(client, admin_headers, count_queries, "GET", f"/api/bom/parent/{large.id}")
+    assert len(response.json()) == 60
+    assert small_count == large_count
+
+
+def test_export_runs_a_constant_number_of_statements(client, admin_headers, db, count_queries):
+    small, = seed_boms(db, parents=1, children=2, prefix="S")
+    seed_boms(db, parents=30, children=5, prefix="L")
+
+    small_count, response = statements(
+        client, admin_headers, count_queries, "POST", "/api/bom/export", json={"parent_item_ids": [small.id]}
+    )
+    assert len(response.text.splitlines()) == 1 + 2
+    all_count, response = statements(client, admin_headers, count_queries, "POST", "/api/bom/export", json={})
+    assert len(response.text.splitlines()) == 1 + 2 + 150
+    assert small_count == all_count
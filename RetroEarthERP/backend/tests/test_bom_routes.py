@@ -0,0 +1,33 @@
+"""
+BOM routes that share a prefix with GET /api/bom/{bom_id}
+"""
+from conftest import add_bom_line, add_items
+
+
+def test_low_level_codes_is_not_captured_by_bom_id(client, admin_headers, db):
+    top, middle, bottom = add_items(db, 3)
+    add_bom_line(db, top, middle)
+    add_bom_line(db, middle, bottom)
+    db.commit()
+
+    rebuilt = client.post("/api/bom/low-level-codes/rebuild", headers=admin_headers)
+    assert rebuilt.status_code == 200
+
+    response = client.get("/api/bom/low-level-codes", headers=admin_headers)
+    assert response.status_code == 200
+    codes = {row["item_code"]: row["low_level_code"] for row in response.json()}
+    assert codes == {top.item_code: 0, middle.item_code: 1, bottom.item_code: 2}
+
+    response = client.get("/api/bom/low-level-codes", params={"min_level": 2}, headers=admin_headers)
+    assert [row["item_code"] for row in response.json()] == [bottom.item_code]
+
+
+def test_bom_id_route_still_resolves(client, admin_headers, db):
+    parent, child = add_items(db, 2)
+    line = add_bom_line(db, parent, child)
+    db.commit()
+
+    response = client.get(f"/api/bom/{line.id}", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.json()["id"] == line.id
+    assert client.get("/api/bom/999999", headers=admin_headers).status_code == 404
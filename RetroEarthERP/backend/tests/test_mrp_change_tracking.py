@@ -0,0 +1,64 @@
+"""
+Net-change MRP bookkeeping: changes are ordered by their sequence id, not
+by when they were stamped, and change records do not pile up.
+"""
+from datetime import timedelta
+import models
+from services import mrp_engine
+from utils.datetime_utils import get_utc_now
+from conftest import add_items, calculated_plan
+
+
+def test_change_stamped_before_a_run_and_committed_after_it_is_replanned(client, admin_headers, db):
+    plan, finished, _ = calculated_plan(client, admin_headers, db)
+    run_at = db.get(models.MRPPlanRun, plan.id).run_at
+
+    # Flushed (and stamped) before the run started, committed only after it
+    db.add(models.MRPItemChange(item_id=finished.id, changed_at=run_at - timedelta(minutes=5)))
+    db.commit()
+
+    response = client.post(f"/api/planning/{plan.id}/net-change", headers=admin_headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["changed_items"] == 1
+    response = client.post(f"/api/planning/{plan.id}/net-change", headers=admin_headers)
+    assert response.json()["changed_items"] == 0
+
+
+def test_one_change_record_per_item_and_transaction(db):
+    item, = add_items(db, 1)
+    db.commit()
+
+    mrp_engine.mark_items_changed(db, [item.id])
+    db.flush()
+    mrp_engine.mark_items_changed(db, [item.id])
+    db.commit()
+    assert db.query(models.MRPItemChange).filter_by(item_id=item.id).count() == 1
+
+    mrp_engine.mark_items_changed(db, [item.id])
+    db.commit()
+    assert db.query(models.MRPItemChange).filter_by(item_id=item.id).count() == 2
+
+
+def test_prune_without_calculated_plans_drops_expired_records(db):
+    item, = add_items(db, 1)
+    expired = get_utc_now() - timedelta(hours=mrp_engine.MRP_CHANGE_RETENTION_HOURS + 1)
+    db.add_all([models.MRPItemChange(item_id=item.id, changed_at=expired) for _ in range(3)])
+    db.add(models.MRPItemChange(item_id=item.id, changed_at=get_utc_now()))
+    db.commit()
+
+    assert mrp_engine.prune_changes(db) == 3
+    db.commit()
+    assert db.query(models.MRPItemChange).count() == 1
+
+
+def test_prune_keeps_records_a_calculated_plan_has_not_consumed(client, admin_headers, db):
+    plan, finished, _ = calculated_plan(client, admin_headers, db)
+    change_seq = db.get(models.MRPPlanRun, plan.id).change_seq
+    expired = get_utc_now() - timedelta(hours=mrp_engine.MRP_CHANGE_RETENTION_HOURS + 1)
+    db.add(models.MRPItemChange(item_id=finished.id, changed_at=expired))
+    db.commit()
+
+    mrp_engine.prune_changes(db)
+    db.commit()
+    assert db.query(models.MRPItemChange).filter(models.MRPItemChange.id > change_seq).count() == 1
+    assert db.query(models.MRPItemChange).filter(models.MRPItemChange.id <= change_seq).count() == 0
@@ -0,0 +1,73 @@
+"""
+Processing a plan while another processing takes the same work order numbers
+"""
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import insert
+import models
+from routers import planning
+from conftest import calculated_plan
+
+
+def add_vendor_and_warehouse(db):
+    db.add(models.MasterBusinessPartner(
+        partner_code="V1", partner_name="Vendor", partner_type=models.PartnerType.VENDOR
+    ))
+    db.add(models.MasterWarehouse(warehouse_code="WH1", warehouse_name="Main", warehouse_type="Main"))
+    db.commit()
+
+
+def take_job_numbers(session, job_nos):
+    """
+    Work orders of another processing that took our numbers after they were
+    allocated. Written in the processing's own transaction: SQLite has a
+    single writer, so another connection could not commit meanwhile.
+    """
+    session.execute(insert(models.TrnJobOrderHead), [{
+        "job_no": job_no, "item_id": 1, "qty_planned": Decimal(1), "start_date": date.today(),
+        "status": models.JobStatus.PLANNED, "warehouse_id": 1, "created_by": 1
+    } for job_no in job_nos])
+
+
+def test_taken_job_numbers_are_allocated_again(client, admin_headers, db, monkeypatch):
+    add_vendor_and_warehouse(db)
+    plan, _, _ = calculated_plan(client, admin_headers, db)
+    allocate = planning._allocate_job_numbers
+    calls = []
+
+    def racing_allocate(session, date_code, count):
+        job_nos = allocate(session, date_code, count)
+        if not calls:
+            take_job_numbers(session, job_nos)
+        calls.append(job_nos)
+        return job_nos
+
+    monkeypatch.setattr(planning, "_allocate_job_numbers", racing_allocate)
+    response = client.post(f"/api/planning/{plan.id}/process", headers=admin_headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["status"] == 'PROCESSED'
+
+    assert len(calls) == 2 and set(calls[0]).isdisjoint(calls[1])
+    job_nos = {job_no for (job_no,) in db.query(models.TrnJobOrderHead.job_no).all()}
+    assert job_nos == set(calls[0]) | set(calls[1])
+    # The PRs inserted before the rejected batch survive its savepoint
+    assert db.query(models.DraftPurchaseRequisition).filter_by(plan_id=plan.id).count() == 1
+
+
+def test_processing_gives_up_after_repeated_clashes(client, admin_headers, db, monkeypatch):
+    add_vendor_and_warehouse(db)
+    plan, _, _ = calculated_plan(client, admin_headers, db)
+    allocate = planning._allocate_job_numbers
+
+    def always_taken(session, date_code, count):
+        job_nos = allocate(session, date_code, count)
+        take_job_numbers(session, job_nos)
+        return job_nos
+
+    monkeypatch.setattr(planning, "_allocate_job_numbers", always_taken)
+    response = client.post(f"/api/planning/{plan.id}/process", headers=admin_headers)
+    assert response.status_code == 409
+
+    db.expire_all()
+    assert db.get(models.ProductionPlan, plan.id).status == 'CALCULATED'
+    assert db.query(models.DraftPurchaseRequisition).count() == 0